@@ -0,0 +1,415 @@
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import scipy
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pathway_assessor as pa
+from pathway_assessor import profiling
+
+# Benchmarks of pathway_assessor on synthetic expression matrices.
+#
+#   python benchmarks/run_benchmarks.py                      run the quick preset
+#   python benchmarks/run_benchmarks.py --preset full --output results.json
+#   python benchmarks/run_benchmarks.py --save-baseline      store benchmarks/baselines/{preset}.json
+#   python benchmarks/run_benchmarks.py --compare            compare against the stored baseline
+#   python benchmarks/run_benchmarks.py --n-jobs 1 2 4 8     also time n_jobs scaling of the batched pass
+#
+# Every case is timed at every point of three sweeps (gene count, sample count
+# and database, the other two held at the preset's base values), each point in
+# a fresh process so that its peak RSS is its own. Throughput is given in
+# expression cells (genes x samples) per second for the whole-table cases and
+# in contingency tables (pathway genes x samples) per second for the pathway
+# stages. Scaling exponents are the slopes of log(seconds) over log(size) of
+# the gene and sample sweeps. With --compare the run exits with status 1 if a
+# point got slower (or larger) than the baseline by more than the tolerance.
+# With --n-jobs, `all` on the base genes and the largest sample count of the
+# preset is also timed at every n_jobs, with its speedup over the first one;
+# the report records the CPU count, as the speedup cannot exceed it.
+
+baselines_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+presets = {
+    'quick': {
+        'genes': [2000, 4000, 8000],
+        'samples': [4, 8, 16],
+        'dbs': ['kegg', 'hallmark'],
+        'base_genes': 4000,
+        'base_samples': 8,
+    },
+    'full': {
+        'genes': [5000, 10000, 20000, 40000],
+        'samples': [10, 40, 160, 640],
+        'dbs': ['kegg', 'hallmark', 'reactome', 'hmdb_smpdb', 'wikipathways'],
+        'base_genes': 20000,
+        'base_samples': 40,
+    },
+}
+
+# The legacy stage functions work on dicts of DataFrames and call fisher_exact
+# once per table, so they are timed on the first few pathways of the database
+legacy_pathways = 3
+
+
+# genes x samples table of log-normal expression over symbols of the db
+# vocabulary padded with made-up ones. nan_rate of the values are missing,
+# zero_rate are exact zeros (ties) and duplicate_rate of the rows repeat the
+# symbol of another row, as in tables with several probes per gene.
+def synthetic_expression(
+        n_genes,
+        n_samples,
+        db='kegg',
+        nan_rate=0.05,
+        zero_rate=0.1,
+        duplicate_rate=0.05,
+        seed=0
+):
+    rng = np.random.default_rng(seed)
+    vocabulary = np.asarray(pa.db_pathways(db).genes, dtype=str)
+    n_unique = max(1, int(round(n_genes * (1 - duplicate_rate))))
+    symbols = rng.permutation(vocabulary)[:n_unique].tolist()
+    symbols += ['SYNTH{}'.format(i) for i in range(n_unique - len(symbols))]
+    genes = symbols + rng.choice(symbols, n_genes - n_unique).tolist()
+
+    values = np.round(rng.lognormal(2, 1.5, (n_genes, n_samples)), 3)
+    values[rng.random((n_genes, n_samples)) < zero_rate] = 0.
+    values[rng.random((n_genes, n_samples)) < nan_rate] = np.nan
+    return pd.DataFrame(
+        values,
+        index=pd.Index(rng.permutation(genes)),
+        columns=['sample_{}'.format(i) for i in range(n_samples)]
+    )
+
+
+def legacy_frames(expression_ranks_df, pathways, rank_method='max'):
+    bg_genes_df = pa.bg_genes(expression_ranks_df)
+    frames = []
+    for genes in list(pa.gene_sets_dict(pathways).values())[:legacy_pathways]:
+        pathway_ranks_df = pa.pathway_ranks(genes, expression_ranks_df, rank_method=rank_method)
+        b_df = pa.b(expression_ranks_df, pathway_ranks_df)
+        c_df = pa.c(pa.effective_pathway(pathway_ranks_df), pathway_ranks_df)
+        d_df = pa.d(bg_genes_df, pathway_ranks_df, b_df, c_df)
+        frames.append((pathway_ranks_df, b_df, c_df, d_df))
+    return frames
+
+
+def sample_2x2_tables(frames):
+    return [
+        pa.sample_2x2(*(frame.to_dict() for frame in pathway_frames))
+        for pathway_frames in frames
+    ]
+
+
+# Each case returns (run, units, unit): run() is the timed call, everything
+# before it is setup
+def all_case(expression_table, db):
+    pathways = pa.db_pathways(db)
+
+    def run():
+        pa.all(expression_table.copy(), pathways=pathways)
+    return run, expression_table.size, 'cells'
+
+
+def pa_stats_case(expression_table, db):
+    pathways = pa.db_pathways(db)
+
+    def run():
+        pa.pa_stats(expression_table.copy(), 'harmonic', pathways=pathways)
+    return run, expression_table.size, 'cells'
+
+
+def expression_ranks_case(expression_table, db):
+    expression_table_df = pa.processed_expression_table(expression_table.copy())
+
+    def run():
+        pa.expression_ranks(expression_table_df, ascending=True)
+    return run, expression_table.size, 'cells'
+
+
+def pathway_ranks_case(expression_table, db):
+    expression_ranks_df = pa.expression_ranks(pa.processed_expression_table(expression_table.copy()), ascending=True)
+    pathway_genes = list(pa.gene_sets_dict(pa.db_pathways(db)).values())
+    tables = sum(
+        pa.pathway_ranks(genes, expression_ranks_df, 'max').size for genes in pathway_genes
+    )
+
+    def run():
+        for genes in pathway_genes:
+            pa.pathway_ranks(genes, expression_ranks_df, 'max')
+    return run, tables, 'tables'
+
+
+def sample_2x2_case(expression_table, db):
+    expression_ranks_df = pa.expression_ranks(pa.processed_expression_table(expression_table.copy()), ascending=True)
+    frames = legacy_frames(expression_ranks_df, pa.db_pathways(db))
+
+    def run():
+        sample_2x2_tables(frames)
+    return run, sum(pathway_frames[0].size for pathway_frames in frames), 'tables'
+
+
+def p_values_case(expression_table, db):
+    expression_ranks_df = pa.expression_ranks(pa.processed_expression_table(expression_table.copy()), ascending=True)
+    tables = sample_2x2_tables(legacy_frames(expression_ranks_df, pa.db_pathways(db)))
+
+    def run():
+        for sample_2x2_df in tables:
+            pa.p_values(sample_2x2_df)
+    return run, sum(sample_2x2_df.size for sample_2x2_df in tables), 'tables'
+
+
+cases = {
+    'all': all_case,
+    'pa_stats': pa_stats_case,
+    'expression_ranks': expression_ranks_case,
+    'pathway_ranks': pathway_ranks_case,
+    'sample_2x2': sample_2x2_case,
+    'p_values': p_values_case,
+}
+
+
+def validate_case(case):
+    if case not in cases:
+        raise ValueError("{} not recognized. Available cases: {}".format(case, ",".join(cases)))
+    return True
+
+
+def measure(case, db, n_genes, n_samples, repeats):
+    expression_table = synthetic_expression(n_genes, n_samples, db=db)
+    run, units, unit = cases[case](expression_table, db)
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+    best = min(seconds)
+    return {
+        'case': case,
+        'db': db,
+        'genes': n_genes,
+        'samples': n_samples,
+        'seconds': best,
+        'median_seconds': float(np.median(seconds)),
+        'units': int(units),
+        'unit': unit,
+        'throughput': units / best if best > 0 else None,
+        'peak_rss': profiling.peak_rss(),
+    }
+
+
+def measure_n_jobs(db, n_genes, n_samples, n_jobs, repeats):
+    expression_table = synthetic_expression(n_genes, n_samples, db=db)
+    pathways = pa.db_pathways(db)
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        pa.all(expression_table.copy(), pathways=pathways, n_jobs=n_jobs)
+        seconds.append(time.perf_counter() - start)
+    return {'n_jobs': n_jobs, 'seconds': min(seconds), 'median_seconds': float(np.median(seconds))}
+
+
+def n_jobs_scaling(preset, n_jobs_values, repeats):
+    settings = presets[preset]
+    db, n_genes, n_samples = settings['dbs'][0], settings['base_genes'], max(settings['samples'])
+    results = []
+    for n_jobs in n_jobs_values:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context('spawn')
+        ) as executor:
+            result = executor.submit(measure_n_jobs, db, n_genes, n_samples, n_jobs, repeats).result()
+        result.update({'db': db, 'genes': n_genes, 'samples': n_samples})
+        result['speedup'] = results[0]['seconds'] / result['seconds'] if results else 1.
+        result['efficiency'] = result['speedup'] * n_jobs_values[0] / n_jobs
+        results.append(result)
+        profiling.logger.info('all n_jobs=%d: %.4f s', n_jobs, result['seconds'])
+    return results
+
+
+def sweep_points(preset):
+    settings = presets[preset]
+    db = settings['dbs'][0]
+    points = [('genes', db, n_genes, settings['base_samples']) for n_genes in settings['genes']]
+    points += [('samples', db, settings['base_genes'], n_samples) for n_samples in settings['samples']]
+    points += [('db', other_db, settings['base_genes'], settings['base_samples']) for other_db in settings['dbs']]
+    return points
+
+
+# slope of log(seconds) over log(size) for every case and size sweep
+def scaling_exponents(results):
+    exponents = []
+    for case in dict.fromkeys(result['case'] for result in results):
+        for sweep in ('genes', 'samples'):
+            points = sorted(
+                (result[sweep], result['seconds']) for result in results
+                if result['case'] == case and sweep in result['sweeps'] and result['seconds'] > 0
+            )
+            if len({size for size, seconds in points}) < 2:
+                continue
+            sizes, seconds = zip(*points)
+            slope = np.polyfit(np.log(sizes), np.log(seconds), 1)[0]
+            exponents.append({'case': case, 'sweep': sweep, 'exponent': float(slope)})
+    return exponents
+
+
+def run_benchmarks(preset='quick', selected_cases=None, repeats=5, isolate=True, n_jobs_values=None):
+    if preset not in presets:
+        raise ValueError("{} not recognized. Available presets: {}".format(preset, ",".join(presets)))
+    selected_cases = list(cases) if selected_cases is None else selected_cases
+    for case in selected_cases:
+        validate_case(case)
+
+    # one point can be in several sweeps (the base sizes are in all of them)
+    points = {}
+    for sweep, db, n_genes, n_samples in sweep_points(preset):
+        points.setdefault((db, n_genes, n_samples), []).append(sweep)
+
+    results = []
+    for case in selected_cases:
+        for (db, n_genes, n_samples), sweeps in points.items():
+            if isolate:
+                with concurrent.futures.ProcessPoolExecutor(
+                        max_workers=1, mp_context=multiprocessing.get_context('spawn')
+                ) as executor:
+                    result = executor.submit(measure, case, db, n_genes, n_samples, repeats).result()
+            else:
+                result = measure(case, db, n_genes, n_samples, repeats)
+            result['sweeps'] = sweeps
+            results.append(result)
+            profiling.logger.info(
+                '%s %s %dx%d: %.4f s', case, db, n_genes, n_samples, result['seconds']
+            )
+
+    report = {
+        'preset': preset,
+        'repeats': repeats,
+        'isolated': isolate,
+        'platform': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'scipy': scipy.__version__,
+        },
+        'results': results,
+        'exponents': scaling_exponents(results),
+    }
+    if n_jobs_values:
+        report['n_jobs'] = n_jobs_scaling(preset, n_jobs_values, repeats)
+    return report
+
+
+def result_key(result):
+    return result['case'], result['db'], result['genes'], result['samples']
+
+
+# Points of `current` that are slower than in `baseline` by more than
+# `tolerance` (0.25 = 25%) or whose peak RSS grew by more than rss_tolerance.
+# Points that took less than min_seconds in the baseline are too noisy to
+# time and are only judged by their RSS.
+def compare(current, baseline, tolerance=0.25, rss_tolerance=0.25, min_seconds=0.01):
+    baseline_results = {result_key(result): result for result in baseline['results']}
+    rows = []
+    for result in current['results']:
+        base = baseline_results.get(result_key(result))
+        if base is None:
+            continue
+        ratio = result['seconds'] / base['seconds'] if base['seconds'] > 0 else float('inf')
+        rss_ratio = None
+        if result['peak_rss'] and base['peak_rss']:
+            rss_ratio = result['peak_rss'] / base['peak_rss']
+        slower = ratio > 1 + tolerance and base['seconds'] >= min_seconds
+        rows.append({
+            'key': result_key(result),
+            'seconds': result['seconds'],
+            'baseline_seconds': base['seconds'],
+            'ratio': ratio,
+            'rss_ratio': rss_ratio,
+            'regression': slower or (rss_ratio is not None and rss_ratio > 1 + rss_tolerance),
+        })
+    return rows
+
+
+def print_results(report):
+    print('{:<18} {:<14} {:>7} {:>7} {:>10} {:>14} {:>10}'.format(
+        'case', 'db', 'genes', 'samples', 'seconds', 'throughput', 'rss MiB'
+    ))
+    for result in report['results']:
+        print('{:<18} {:<14} {:>7} {:>7} {:>10.4f} {:>10.3g} {:<5} {:>8.1f}'.format(
+            result['case'], result['db'], result['genes'], result['samples'], result['seconds'],
+            result['throughput'] or 0, result['unit'][:5], (result['peak_rss'] or 0) / 2 ** 20
+        ))
+    print()
+    for exponent in report['exponents']:
+        print('{:<18} seconds ~ {}^{:.2f}'.format(exponent['case'], exponent['sweep'], exponent['exponent']))
+    if report.get('n_jobs'):
+        first = report['n_jobs'][0]
+        print()
+        print('all on {} {}x{} ({} cpus)'.format(
+            first['db'], first['genes'], first['samples'], report['platform']['cpus']
+        ))
+        print('{:>7} {:>10} {:>8} {:>10}'.format('n_jobs', 'seconds', 'speedup', 'efficiency'))
+        for result in report['n_jobs']:
+            print('{:>7} {:>10.4f} {:>8.2f} {:>10.2f}'.format(
+                result['n_jobs'], result['seconds'], result['speedup'], result['efficiency']
+            ))
+
+
+def print_comparison(rows):
+    print()
+    print('{:<18} {:<14} {:>7} {:>7} {:>10} {:>10} {:>7} {:>7}'.format(
+        'case', 'db', 'genes', 'samples', 'seconds', 'baseline', 'ratio', 'rss'
+    ))
+    for row in rows:
+        case, db, n_genes, n_samples = row['key']
+        print('{:<18} {:<14} {:>7} {:>7} {:>10.4f} {:>10.4f} {:>7.2f} {:>7} {}'.format(
+            case, db, n_genes, n_samples, row['seconds'], row['baseline_seconds'], row['ratio'],
+            '{:.2f}'.format(row['rss_ratio']) if row['rss_ratio'] is not None else '-',
+            'REGRESSION' if row['regression'] else ''
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark pathway_assessor on synthetic expression tables')
+    parser.add_argument('--preset', default='quick', choices=list(presets))
+    parser.add_argument('--cases', nargs='+', choices=list(cases), default=None)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--no-isolate', action='store_true', help='measure in this process (peak RSS is cumulative)')
+    parser.add_argument('--output', help='write the report as JSON')
+    parser.add_argument('--save-baseline', action='store_true', help='store the report as the preset baseline')
+    parser.add_argument('--compare', nargs='?', const='', default=None, metavar='BASELINE',
+                        help='compare against a baseline report (default: the stored preset baseline)')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--rss-tolerance', type=float, default=0.25)
+    parser.add_argument('--min-seconds', type=float, default=0.01)
+    parser.add_argument('--n-jobs', type=int, nargs='+', help='also time `all` at every n_jobs (e.g. 1 2 4 8)')
+    args = parser.parse_args()
+
+    report = run_benchmarks(
+        args.preset, args.cases, args.repeats, isolate=not args.no_isolate, n_jobs_values=args.n_jobs
+    )
+    print_results(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.save_baseline:
+        os.makedirs(baselines_dir, exist_ok=True)
+        with open(os.path.join(baselines_dir, '{}.json'.format(args.preset)), 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.compare is not None:
+        baseline_f = args.compare or os.path.join(baselines_dir, '{}.json'.format(args.preset))
+        with open(baseline_f) as f:
+            rows = compare(report, json.load(f), args.tolerance, args.rss_tolerance, args.min_seconds)
+        print_comparison(rows)
+        if any(row['regression'] for row in rows):
+            sys.exit(1)
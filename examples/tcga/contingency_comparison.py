@@ -0,0 +1,80 @@
+import os
+import time
+import tracemalloc
+
+import pandas as pd
+
+import pathway_assessor as pa
+
+
+def pathway_frames(expression_ranks_df, bg_genes_df, pathway_genes, rank_method):
+    pathway_ranks_df = pa.pathway_ranks(pathway_genes, expression_ranks_df, rank_method=rank_method)
+    effective_pathway_df = pa.effective_pathway(pathway_ranks_df)
+    b_df = pa.b(expression_ranks_df, pathway_ranks_df)
+    c_df = pa.c(effective_pathway_df, pathway_ranks_df)
+    d_df = pa.d(bg_genes_df, pathway_ranks_df, b_df, c_df)
+    return pathway_ranks_df, b_df, c_df, d_df
+
+
+def dict_round_trip(frames):
+    pathway_ranks_df, b_df, c_df, d_df = frames
+    sample_2x2_df = pa.sample_2x2(
+        pathway_ranks_df.to_dict(),
+        b_df.to_dict(),
+        c_df.to_dict(),
+        d_df.to_dict()
+    )
+    return pa.p_values(sample_2x2_df)
+
+
+def dict_round_trip_tables(frames):
+    pathway_ranks_df, b_df, c_df, d_df = frames
+    return pa.sample_2x2(
+        pathway_ranks_df.to_dict(),
+        b_df.to_dict(),
+        c_df.to_dict(),
+        d_df.to_dict()
+    )
+
+
+def contingency(frames):
+    return pa.contingency_p_values(pa.contingency_tables(*frames))
+
+
+def contingency_only_tables(frames):
+    return pa.contingency_tables(*frames)
+
+
+def measure(f, all_frames):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for frames in all_frames:
+        f(frames)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == '__main__':
+    examples_dir = os.path.dirname(os.path.abspath(__file__))
+    expression_table = pd.read_csv('{}/blca_normal_slim'.format(examples_dir), sep='\t', index_col=0)
+    rank_method = 'max'
+
+    expression_table_df = pa.processed_expression_table(expression_table)
+    expression_ranks_df = pa.expression_ranks(expression_table_df, ascending=True, rank_method=rank_method)
+    bg_genes_df = pa.bg_genes(expression_ranks_df)
+    pathways = pa.db_pathways_dict('kegg')
+    all_frames = [
+        pathway_frames(expression_ranks_df, bg_genes_df, genes, rank_method)
+        for genes in pathways.values()
+    ]
+
+    for label, f in [
+        ('sample_2x2 tables', dict_round_trip_tables),
+        ('contingency tables', contingency_only_tables),
+        ('sample_2x2 + fisher_exact p-values', dict_round_trip),
+        ('contingency + hypergeom p-values', contingency),
+    ]:
+        elapsed, peak = measure(f, all_frames)
+        print('{:<36} {:>8.3f} s {:>10.1f} KiB peak'.format(label, elapsed, peak / 1024))
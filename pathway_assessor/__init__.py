@@ -1,3 +1,12 @@
 from .pathway_assessor import *
+from .dedup import dedup_methods
+from .genesets import combine_gene_sets, compile_gene_sets, load_gene_sets, read_gene_set_file
+from .sparse_expression import SparseExpression
+from .streaming import ExpressionSource, expression_source, stream_scores
+from .incremental import ScoreUpdate, gene_universe_fingerprint, load_score_set, update_scores
+from .store import ResultStore, checkpointed_all
+from .profiling import Profiler
+from .permutation import NullCache, permutation_all
+from .service import ScoringService, request_events, service_scores
 
 name = "pathway_assessor"
@@ -0,0 +1,156 @@
+import numpy as np
+import scipy.stats as stats
+
+# Aggregation of the gene p-values of each pathway into one score per sample.
+# Every aggregate is computed from per-segment statistics of the log p-values
+# that are shared between aggregates, so any set of aggregates costs one
+# reduction per statistic. NaN p-values are skipped, an all-NaN segment gives
+# NaN and a zero p-value (log p-value of -inf) makes the harmonic, geometric,
+# min and Fisher aggregates zero.
+
+default_aggregates = ('harmonic', 'geometric', 'min')
+
+
+# Float values are reduced in float64 (so float32 values are summed in
+# float64) unless dtype is given; empty segments give NaN, or 0 for integers
+def segment_reduce(ufunc, values, indptr, dtype=None):
+    if dtype is None:
+        dtype = float if values.dtype.kind == 'f' else values.dtype
+    starts = indptr[:-1]
+    nonempty = indptr[1:] > starts
+    reduced = np.full((len(starts),) + values.shape[1:], np.nan if np.dtype(dtype).kind == 'f' else 0, dtype=dtype)
+    if nonempty.any():
+        reduced[nonempty] = ufunc.reduceat(values, starts[nonempty], axis=0, dtype=dtype)
+    return reduced
+
+
+def count_statistic(log_p_values, valid, indptr, statistics):
+    return segment_reduce(np.add, valid.astype(float), indptr)
+
+
+def min_statistic(log_p_values, valid, indptr, statistics):
+    return segment_reduce(np.fmin, log_p_values, indptr)
+
+
+def log_sum_statistic(log_p_values, valid, indptr, statistics):
+    return segment_reduce(np.add, np.where(valid, log_p_values, 0), indptr)
+
+
+# log(SUM 1/Pk), shifted by the smallest log p-value so no term overflows
+def reciprocal_statistic(log_p_values, valid, indptr, statistics):
+    segments = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    shift = statistics['min'].astype(log_p_values.dtype, copy=False)[segments]
+    with np.errstate(invalid='ignore'):
+        terms = np.where(valid & np.isfinite(shift), np.exp(shift - log_p_values), 0)
+    return np.log(segment_reduce(np.add, terms, indptr)) - statistics['min']
+
+
+# SUM tan((0.5 - Pk) * pi), written as cot(Pk * pi) to keep small p-values
+# exact. Taken in float64 whatever the dtype, as cot(Pk * pi) is ill
+# conditioned for p-values near 1.
+def cauchy_statistic(log_p_values, valid, indptr, statistics):
+    return segment_reduce(
+        np.add, np.where(valid, 1 / np.tan(np.pi * np.exp(log_p_values, dtype=float)), 0), indptr
+    )
+
+
+# name: (required statistics, function). Statistics are computed in this
+# order, so a statistic may use the ones listed before it.
+statistic_functions = {
+    'count': count_statistic,
+    'min': min_statistic,
+    'log_sum': log_sum_statistic,
+    'reciprocal': reciprocal_statistic,
+    'cauchy': cauchy_statistic,
+}
+
+
+# Each aggregate returns the log of the combined p-value
+def log_harmonic(statistics):
+    log_harmonic_values = np.log(statistics['count']) - statistics['reciprocal']
+    return np.where(statistics['min'] == -np.inf, -np.inf, log_harmonic_values)
+
+
+def log_geometric(statistics):
+    return statistics['log_sum'] / statistics['count']
+
+
+def log_min(statistics):
+    return statistics['min']
+
+
+# Fisher's method: -2 SUM log(Pk) ~ chi2 with 2N degrees of freedom
+def log_fisher(statistics):
+    return stats.chi2.logsf(-2 * statistics['log_sum'], 2 * statistics['count'])
+
+
+# Cauchy combination: T = 1/N SUM tan((0.5 - Pk) * pi) ~ standard Cauchy
+def log_cauchy(statistics):
+    return np.log(np.arctan2(1, statistics['cauchy'] / statistics['count']) / np.pi)
+
+
+aggregate_functions = {
+    'harmonic': (('count', 'min', 'reciprocal'), log_harmonic),
+    'geometric': (('count', 'log_sum'), log_geometric),
+    'min': (('min',), log_min),
+    'fisher': (('count', 'log_sum'), log_fisher),
+    'cauchy': (('count', 'cauchy'), log_cauchy),
+}
+
+
+def validate_aggregates(aggregates):
+    unknown = [aggregate for aggregate in aggregates if aggregate not in aggregate_functions]
+    if unknown:
+        raise ValueError(
+            "{} not recognized. Available aggregates: {}".format(
+                ",".join(unknown), ",".join(aggregate_functions)
+            )
+        )
+    return True
+
+
+# Scores (-log of the aggregated p-values) from the statistics the aggregates
+# require (see required_statistics); a zero count gives NaN
+def statistics_scores(statistics, aggregates=default_aggregates):
+    scores = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for aggregate in aggregates:
+            score = -aggregate_functions[aggregate][1](statistics)
+            if 'count' in statistics:
+                score = np.where(statistics['count'] > 0, score, np.nan)
+            scores[aggregate] = score
+    return scores
+
+
+def required_statistics(aggregates):
+    required = {statistic for aggregate in aggregates for statistic in aggregate_functions[aggregate][0]}
+    if 'reciprocal' in required:
+        required.add('min')
+    return required
+
+
+# Scores of every segment of rows of log_p_values, as
+# {aggregate: segments x samples array}. Without indptr all rows form one
+# segment and the scores have one value per sample. float32 log p-values are
+# kept in float32, with their sums taken in float64.
+def aggregate_scores(log_p_values, indptr=None, aggregates=default_aggregates):
+    validate_aggregates(aggregates)
+    log_p_values = np.asarray(log_p_values)
+    if log_p_values.dtype != np.float32:
+        log_p_values = log_p_values.astype(float, copy=False)
+    single_segment = indptr is None
+    if single_segment:
+        indptr = np.array([0, log_p_values.shape[0]])
+
+    required = required_statistics(aggregates)
+    valid = ~np.isnan(log_p_values)
+    statistics = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for statistic, statistic_function in statistic_functions.items():
+            if statistic in required:
+                statistics[statistic] = statistic_function(log_p_values, valid, indptr, statistics)
+
+    scores = statistics_scores(statistics, aggregates)
+    if single_segment:
+        return {aggregate: score[0] for aggregate, score in scores.items()}
+    return scores
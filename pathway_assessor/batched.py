@@ -0,0 +1,547 @@
+import numpy as np
+import scipy.sparse as sparse
+
+from . import profiling
+from .aggregation import aggregate_scores, default_aggregates, segment_reduce, validate_aggregates
+from .dedup import gene_index
+
+# Upper bound on gathered (pathway gene, sample) cells held in memory at once
+BLOCK_CELLS = 2 ** 22
+
+
+# membership: pathways x genes CSR matrix; row i holds the positions in
+# `genes` of the genes of the i-th pathway. Genes missing from `genes` are
+# dropped and duplicated genes are counted once.
+def membership_matrix(pathways, genes):
+    genes = gene_index(genes)
+    pathway_genes = [list(pathway) for pathway in pathways.values()]
+    sizes = [len(pathway) for pathway in pathway_genes]
+    rows = np.repeat(np.arange(len(pathway_genes)), sizes)
+    cols = genes.get_indexer([gene for pathway in pathway_genes for gene in pathway])
+    present = cols >= 0
+
+    membership = sparse.csr_matrix(
+        (np.ones(present.sum(), dtype=np.int8), (rows[present], cols[present])),
+        shape=(len(pathway_genes), len(genes))
+    )
+    membership.sum_duplicates()
+    membership.data[:] = 1
+    return membership
+
+
+# Pathways with the same set of present genes are scored once: returns the
+# membership of the distinct rows (in order of first appearance) and the
+# distinct row of every row
+def unique_membership(membership):
+    if not membership.has_sorted_indices:
+        membership = membership.sorted_indices()
+    indptr, indices = membership.indptr, membership.indices
+    rows = {}
+    inverse = np.array(
+        [rows.setdefault(indices[indptr[i]:indptr[i + 1]].tobytes(), len(rows)) for i in range(membership.shape[0])],
+        dtype=np.intp
+    )
+    if len(rows) == membership.shape[0]:
+        return membership, inverse
+    return membership[np.unique(inverse, return_index=True)[1]], inverse
+
+
+# Split the rows of a CSR matrix into consecutive blocks of at most
+# max_cells gathered cells (a pathway larger than the budget gets its own block)
+def pathway_blocks(indptr, n_samples, max_cells=BLOCK_CELLS):
+    max_rows = max(max_cells // max(n_samples, 1), 1)
+    blocks = []
+    start = 0
+    n_pathways = len(indptr) - 1
+    while start < n_pathways:
+        stop = np.searchsorted(indptr, indptr[start] + max_rows, side='right') - 1
+        stop = min(max(stop, start + 1), n_pathways)
+        blocks.append((start, stop))
+        start = stop
+    return blocks
+
+
+rank_methods = ('average', 'min', 'max', 'first', 'dense')
+
+# precision='single' keeps rank matrices and contingency counts as int32
+# (float32 for rank_method='average', whose ranks are half-integers) with 0
+# in place of missing values, which are tracked in separate masks, and gene
+# p-values as float32. Sums over the genes of a pathway are still taken in
+# float64 and scores are float64.
+precisions = ('double', 'single')
+
+
+def validate_rank_method(rank_method):
+    if rank_method not in rank_methods:
+        raise ValueError(
+            "{} not recognized. Available rank methods: {}".format(rank_method, ",".join(rank_methods))
+        )
+    return True
+
+
+def validate_precision(precision):
+    if precision not in precisions:
+        raise ValueError(
+            "{} not recognized. Available precisions: {}".format(precision, ",".join(precisions))
+        )
+    return True
+
+
+def rank_dtype(rank_method, precision='double'):
+    if precision == 'double':
+        return np.float64
+    return np.float32 if rank_method == 'average' else np.int32
+
+
+def p_value_dtype(precision='double'):
+    return np.float64 if precision == 'double' else np.float32
+
+
+def index_dtype(precision='double'):
+    return np.int64 if precision == 'double' else np.int32
+
+
+# One stable sort of `values` (rows x samples) within each segment of rows.
+# `segments` holds the non-decreasing segment id of each row. Returns the sort
+# order and, for every sorted position, its 0-based position within its
+# segment (pos), the first and last positions of its tie group (lo, hi), the
+# number of values in its segment (count), its 1-based tie group number (group)
+# and the number of tie groups in its segment (n_groups). Missing values (NaN,
+# or the cells flagged in `missing`) sort last. Positions are of dtype
+# `positions_dtype`.
+def segment_sort(values, segments, missing=None, positions_dtype=np.int64):
+    n = values.shape[0]
+    nan_missing = missing is None
+    if missing is None:
+        missing = np.isnan(values)
+    present_values = values[~missing]
+    offset = present_values.min() if present_values.size else 0
+    span = present_values.max() - offset + 1 if present_values.size else 1
+    # one key of segment and value sorts exactly when the values are ranks
+    # (multiples of 1/2) and the keys fit the float mantissa; other values are
+    # sorted by value and then, stably, by segment
+    if (segments.max(initial=0) + 1) * span < 2 ** 51 and (
+            values.dtype.kind in 'iu' or np.array_equal(present_values * 2, np.floor(present_values * 2))
+    ):
+        keys = segments[:, None] * span + (values - offset)
+        keys[missing] = np.inf if keys.dtype.kind == 'f' else np.iinfo(keys.dtype).max
+        order = np.argsort(keys, axis=0, kind='stable')
+    else:
+        # NaN sorts last, so a single segment with NaN missing needs one sort;
+        # otherwise missing cells take a segment past the last one
+        order = np.argsort(values, axis=0, kind='stable')
+        if not nan_missing or (n and segments[0] != segments[-1]):
+            segment_keys = np.where(missing, segments.max(initial=0) + 1, segments[:, None])
+            order = np.take_along_axis(
+                order, np.argsort(np.take_along_axis(segment_keys, order, axis=0), axis=0, kind='stable'), axis=0
+            )
+    order = order.astype(positions_dtype, copy=False)
+    sorted_values = np.take_along_axis(values, order, axis=0)
+    sorted_segments = segments[order]
+    valid = ~np.take_along_axis(missing, order, axis=0)
+    positions = np.broadcast_to(np.arange(n, dtype=positions_dtype)[:, None], values.shape)
+
+    new_segment = np.ones(values.shape, dtype=bool)
+    new_segment[1:] = sorted_segments[1:] != sorted_segments[:-1]
+    segment_start = np.maximum.accumulate(np.where(new_segment, positions, 0), axis=0)
+    last_in_segment = valid.copy()
+    last_in_segment[:-1] &= new_segment[1:] | ~valid[1:]
+    segment_end = np.minimum.accumulate(np.where(last_in_segment, positions, n)[::-1], axis=0)[::-1]
+
+    new_group = np.ones(values.shape, dtype=bool)
+    new_group[1:] = (sorted_values[1:] != sorted_values[:-1]) & valid[1:] | (valid[1:] != valid[:-1]) | new_segment[1:]
+    group_start = np.maximum.accumulate(np.where(new_group, positions, 0), axis=0)
+    last_in_group = np.ones(values.shape, dtype=bool)
+    last_in_group[:-1] = new_group[1:]
+    group_end = np.minimum.accumulate(np.where(last_in_group, positions, n)[::-1], axis=0)[::-1]
+    groups = np.cumsum(new_group, axis=0, dtype=positions_dtype)
+    first_group = np.take_along_axis(groups, segment_start, axis=0)
+
+    with np.errstate(invalid='ignore'):
+        segment_end = np.minimum(segment_end, n - 1)
+        return order, valid, {
+            'pos': positions - segment_start,
+            'lo': group_start - segment_start,
+            'hi': group_end - segment_start,
+            'count': segment_end - segment_start + 1,
+            'group': groups - first_group + 1,
+            'n_groups': np.take_along_axis(groups, segment_end, axis=0) - first_group + 1,
+        }
+
+
+def sorted_ranks(sort, rank_method, ascending=True, dtype=np.float64):
+    pos, lo, hi, count = sort['pos'], sort['lo'], sort['hi'], sort['count']
+    if rank_method == 'average':
+        half = (lo + hi).astype(dtype) / 2
+        return half + 1 if ascending else count.astype(dtype) - half
+    if ascending:
+        ranks = {
+            'first': lambda: pos + 1,
+            'min': lambda: lo + 1,
+            'max': lambda: hi + 1,
+            'dense': lambda: sort['group'],
+        }
+    else:
+        # ties keep their order of appearance, as DataFrame.rank(ascending=False)
+        ranks = {
+            'first': lambda: count - hi + pos - lo,
+            'min': lambda: count - hi,
+            'max': lambda: count - lo,
+            'dense': lambda: sort['n_groups'] - sort['group'] + 1,
+        }
+    return ranks[rank_method]().astype(dtype, copy=False)
+
+
+def unsort(order, valid, values, missing_value=np.nan):
+    values = np.where(valid, values, missing_value)
+    unsorted = np.empty_like(values)
+    np.put_along_axis(unsorted, order, values, axis=0)
+    return unsorted
+
+
+def empty_ranks(values, rank_method, precision):
+    return np.empty(values.shape, dtype=rank_dtype(rank_method, precision))
+
+
+# Ranks of `values` within each segment of rows for every sample, matching
+# DataFrame.rank on each segment; NaN values (or the cells flagged in
+# `missing`) get NaN ranks, or 0 with precision='single'
+def segment_ranks(values, segments, rank_method='max', ascending=True, missing=None, precision='double'):
+    validate_rank_method(rank_method)
+    values = np.asarray(values) if missing is not None else np.asarray(values, dtype=float)
+    if not values.shape[0]:
+        return empty_ranks(values, rank_method, precision)
+    order, valid, sort = segment_sort(values, segments, missing=missing, positions_dtype=index_dtype(precision))
+    return unsort(
+        order,
+        valid,
+        sorted_ranks(sort, rank_method, ascending=ascending, dtype=rank_dtype(rank_method, precision)),
+        missing_value=np.nan if precision == 'double' else 0
+    )
+
+
+# Ascending and descending ranks from the same sort
+def segment_ranks_both(values, segments, rank_method='max', precision='double'):
+    validate_rank_method(rank_method)
+    values = np.asarray(values, dtype=float)
+    if not values.shape[0]:
+        return empty_ranks(values, rank_method, precision), empty_ranks(values, rank_method, precision)
+    order, valid, sort = segment_sort(values, segments, positions_dtype=index_dtype(precision))
+    return tuple(
+        unsort(
+            order,
+            valid,
+            sorted_ranks(sort, rank_method, ascending=ascending, dtype=rank_dtype(rank_method, precision)),
+            missing_value=np.nan if precision == 'double' else 0
+        )
+        for ascending in (True, False)
+    )
+
+
+# Ranks of a genes x samples scipy.sparse matrix whose zeros are implicit:
+# only the stored values are sorted, and the zeros of a sample share the tied
+# rank that follows from how many values rank before them and how many zeros
+# there are. Indexing with gene positions gathers those rows as a dense array
+# with the zero ranks filled in, in the dtype of `precision` (0 for missing
+# ranks with 'single'), so a pathway block is the only dense part. Zeros
+# ranked 'first' each get their own rank, so that method is not supported.
+sparse_rank_methods = ('average', 'min', 'max', 'dense')
+
+
+def validate_sparse_rank_method(rank_method):
+    if rank_method not in sparse_rank_methods:
+        raise ValueError(
+            "{} not recognized. Available rank methods for sparse expression: {}".format(
+                rank_method, ",".join(sparse_rank_methods)
+            )
+        )
+    return True
+
+
+class SparseRanks:
+
+    def __init__(self, ranks, zero_ranks, rank_method='max', precision='double'):
+        # ranks: CSR ranks of the stored values (at least 1, NaN if missing)
+        self.ranks = ranks
+        self.zero_ranks = zero_ranks
+        self.rank_method = rank_method
+        self.precision = precision
+        self.dtype = np.dtype(rank_dtype(rank_method, precision))
+
+    @property
+    def shape(self):
+        return self.ranks.shape
+
+    # SparseRanks of the given samples
+    def columns(self, columns):
+        return SparseRanks(self.ranks[:, columns], self.zero_ranks[columns], self.rank_method, self.precision)
+
+    def __getitem__(self, rows):
+        ranks = self.ranks[rows].toarray()
+        ranks = np.where(ranks == 0, self.zero_ranks, ranks)
+        if self.precision == 'double':
+            return ranks
+        ranks[np.isnan(ranks)] = 0
+        return ranks.astype(self.dtype)
+
+
+def sparse_bg_genes(matrix):
+    matrix = sparse.csc_matrix(matrix)
+    missing = np.isnan(matrix.data)
+    columns = np.repeat(np.arange(matrix.shape[1]), np.diff(matrix.indptr))
+    return matrix.shape[0] - np.bincount(columns[missing], minlength=matrix.shape[1])
+
+
+# SparseRanks of every sample (column) of a scipy.sparse matrix, as
+# DataFrame.rank of the dense matrix
+def sparse_expression_ranks(matrix, ascending=True, rank_method='max', precision='double'):
+    validate_sparse_rank_method(rank_method)
+    validate_precision(precision)
+    matrix = sparse.csc_matrix(matrix, dtype=np.float64, copy=True)
+    matrix.eliminate_zeros()
+    n_genes, n_samples = matrix.shape
+    columns = np.repeat(np.arange(n_samples), np.diff(matrix.indptr))
+    values = matrix.data
+
+    # ranks among the stored values of each sample
+    ranks = segment_ranks(values[:, None], columns, rank_method=rank_method, ascending=ascending)[:, 0]
+    before = values < 0 if ascending else values > 0
+    after = ~before & ~np.isnan(values)
+    zeros = n_genes - np.diff(matrix.indptr)
+    if rank_method == 'dense':
+        n_before = np.zeros(n_samples)
+        np.maximum.at(n_before, columns[before], ranks[before])
+        zero_ranks = n_before + 1
+        ranks[after] += zeros[columns[after]] > 0
+    else:
+        n_before = np.bincount(columns[before], minlength=n_samples)
+        zero_ranks = {
+            'min': n_before + 1,
+            'max': n_before + zeros,
+            'average': n_before + (zeros + 1) / 2,
+        }[rank_method]
+        ranks[after] += zeros[columns[after]]
+
+    matrix.data = ranks
+    return SparseRanks(matrix.tocsr(), zero_ranks.astype(np.float64), rank_method=rank_method, precision=precision)
+
+
+# b/c/d from the ranks of the block genes and their ranks within their
+# pathways; with a missing mask, missing ranks are 0
+def contingency_counts(ranks, pathway_ranks, bg, indptr, segments, missing=None):
+    if missing is None:
+        effective_pathway = segment_reduce(np.fmax, pathway_ranks, indptr)[segments]
+    else:
+        effective_pathway = segment_reduce(np.maximum, pathway_ranks, indptr, dtype=pathway_ranks.dtype)[segments]
+    b = ranks - pathway_ranks
+    c = effective_pathway - pathway_ranks
+    d = bg - ranks - effective_pathway + pathway_ranks
+    if missing is None:
+        return pathway_ranks, b, c, d
+    return pathway_ranks, b, c, d, missing
+
+
+# a/b/c/d for every gene of every pathway in a CSR block: the same values as
+# pathway_ranks, b, c and d, stacked pathway after pathway. With
+# precision='single' the counts come with the mask of missing cells as a
+# fifth array.
+def block_contingency(expression_ranks, bg, indptr, indices, rank_method='max', precision='double'):
+    segments = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    missing = None
+    with profiling.stage('pathway_ranks'):
+        ranks = expression_ranks[indices]
+        if precision != 'double':
+            missing = ranks == 0
+        pathway_ranks = segment_ranks(ranks, segments, rank_method=rank_method, missing=missing, precision=precision)
+
+    with profiling.stage('contingency'):
+        return contingency_counts(ranks, pathway_ranks, bg, indptr, segments, missing)
+
+
+# a/b/c/d of the ascending and of the descending ranks from one gather and
+# one sort of the expression values of the block. Ranking the values within a
+# pathway orders them as ranking their expression ranks would.
+def block_contingency_both(
+        expression_values, ascending_ranks, descending_ranks, bg, indptr, indices, rank_method='max',
+        precision='double'
+):
+    segments = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    missing = None
+    with profiling.stage('pathway_ranks'):
+        values = expression_values[indices]
+        if precision != 'double':
+            missing = np.isnan(values)
+        pathway_ranks_both = segment_ranks_both(values, segments, rank_method=rank_method, precision=precision)
+        del values
+
+    with profiling.stage('contingency'):
+        return tuple(
+            contingency_counts(expression_ranks[indices], pathway_ranks, bg, indptr, segments, missing)
+            for expression_ranks, pathway_ranks in zip((ascending_ranks, descending_ranks), pathway_ranks_both)
+        )
+
+
+def contingency_scores(contingency, p_value_function, indptr, aggregates=default_aggregates, log_p=False):
+    with profiling.stage('p_values'):
+        if len(contingency) == 4:
+            p_values = p_value_function(*contingency)
+        else:
+            # only the cells that are not missing are passed on
+            *counts, missing = contingency
+            present = ~missing
+            present_p_values = p_value_function(*(count[present] for count in counts))
+            p_values = np.full(missing.shape, np.nan, dtype=present_p_values.dtype)
+            p_values[present] = present_p_values
+    with profiling.stage('aggregation'):
+        if log_p:
+            log_p_values = p_values
+        else:
+            with np.errstate(divide='ignore'):
+                log_p_values = np.log(p_values)
+        return aggregate_scores(log_p_values, indptr, aggregates=aggregates)
+
+
+# Scores (-log of the aggregated p-values) for one CSR block of pathways
+def block_scores(
+        expression_ranks,
+        bg,
+        indptr,
+        indices,
+        p_value_function,
+        rank_method='max',
+        aggregates=default_aggregates,
+        log_p=False,
+        precision='double'
+):
+    return contingency_scores(
+        block_contingency(expression_ranks, bg, indptr, indices, rank_method=rank_method, precision=precision),
+        p_value_function,
+        indptr,
+        aggregates=aggregates,
+        log_p=log_p
+    )
+
+
+# Ascending and descending scores for one CSR block of pathways
+def block_scores_both(
+        expression_values,
+        ascending_ranks,
+        descending_ranks,
+        bg,
+        indptr,
+        indices,
+        p_value_function,
+        rank_method='max',
+        aggregates=default_aggregates,
+        log_p=False,
+        precision='double'
+):
+    return tuple(
+        contingency_scores(contingency, p_value_function, indptr, aggregates=aggregates, log_p=log_p)
+        for contingency in block_contingency_both(
+            expression_values, ascending_ranks, descending_ranks, bg, indptr, indices, rank_method=rank_method,
+            precision=precision
+        )
+    )
+
+
+def block_membership(indptr, indices, start, stop):
+    return indptr[start:stop + 1] - indptr[start], indices[indptr[start]:indptr[stop]]
+
+
+# Scores for every pathway of a membership matrix and every sample, as
+# {aggregate: pathways x samples array}. p_value_function maps aligned
+# a/b/c/d arrays to p-values, or to log p-values when log_p is set. With
+# precision='single' expression_ranks hold 0 for missing values.
+# expression_ranks may be SparseRanks.
+def pathway_scores(
+        expression_ranks,
+        bg,
+        membership,
+        p_value_function,
+        rank_method='max',
+        aggregates=default_aggregates,
+        log_p=False,
+        max_cells=BLOCK_CELLS,
+        precision='double'
+):
+    validate_aggregates(aggregates)
+    validate_precision(precision)
+    if not isinstance(expression_ranks, SparseRanks):
+        expression_ranks = np.asarray(expression_ranks, dtype=rank_dtype(rank_method, precision))
+    bg = np.asarray(bg, dtype=rank_dtype(rank_method, precision))
+    n_pathways = membership.shape[0]
+    n_samples = expression_ranks.shape[1]
+
+    scores = {
+        aggregate: np.full((n_pathways, n_samples), np.nan)
+        for aggregate in aggregates
+    }
+    for start, stop in pathway_blocks(membership.indptr, n_samples, max_cells=max_cells):
+        indptr, indices = block_membership(membership.indptr, membership.indices, start, stop)
+        block = block_scores(
+            expression_ranks,
+            bg,
+            indptr,
+            indices,
+            p_value_function,
+            rank_method=rank_method,
+            aggregates=aggregates,
+            log_p=log_p,
+            precision=precision
+        )
+        for aggregate, values in block.items():
+            scores[aggregate][start:stop] = values
+    return scores
+
+
+# Expression values and the two rank matrices in the dtypes of `precision`
+def score_matrices(expression_values, ascending_ranks, descending_ranks, rank_method, precision='double'):
+    return [np.asarray(expression_values, dtype=float)] + [
+        np.asarray(ranks, dtype=rank_dtype(rank_method, precision)) for ranks in (ascending_ranks, descending_ranks)
+    ]
+
+
+# pathway_scores for both directions: (ascending scores, descending scores).
+# Every block gathers and sorts the expression values of its pathways once.
+def pathway_scores_both(
+        expression_values,
+        ascending_ranks,
+        descending_ranks,
+        bg,
+        membership,
+        p_value_function,
+        rank_method='max',
+        aggregates=default_aggregates,
+        log_p=False,
+        max_cells=BLOCK_CELLS,
+        precision='double'
+):
+    validate_aggregates(aggregates)
+    validate_precision(precision)
+    matrices = score_matrices(expression_values, ascending_ranks, descending_ranks, rank_method, precision)
+    bg = np.asarray(bg, dtype=rank_dtype(rank_method, precision))
+    n_pathways = membership.shape[0]
+    n_samples = matrices[0].shape[1]
+
+    scores = tuple(
+        {aggregate: np.full((n_pathways, n_samples), np.nan) for aggregate in aggregates}
+        for _ in range(2)
+    )
+    for start, stop in pathway_blocks(membership.indptr, n_samples, max_cells=max_cells):
+        indptr, indices = block_membership(membership.indptr, membership.indices, start, stop)
+        blocks = block_scores_both(
+            *matrices,
+            bg,
+            indptr,
+            indices,
+            p_value_function,
+            rank_method=rank_method,
+            aggregates=aggregates,
+            log_p=log_p,
+            precision=precision
+        )
+        for direction_scores, block in zip(scores, blocks):
+            for aggregate, values in block.items():
+                direction_scores[aggregate][start:stop] = values
+    return scores
@@ -0,0 +1,347 @@
+import argparse
+import concurrent.futures
+import importlib.util
+import json
+import logging
+import os
+import re
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from . import pathway_assessor
+from .batched import BLOCK_CELLS, validate_rank_method
+from .genesets import combine_gene_sets, gene_sets_from_dict, load_gene_sets, read_gene_set_file
+from .parallel import process_pool
+from .pathway_assessor import (
+    PreparedExpression,
+    db_pathways,
+    directions,
+    validate_aggregates,
+    validate_p_value_method
+)
+from .profiling import logger
+from .streaming import expression_source, infer_source_format, result_frames, sample_chunks
+
+# `pathway-assessor manifest.json` scores every cohort of a JSON manifest
+# against every database in every direction:
+#
+#   {
+#     "cohorts": {"blca": "blca.tsv", "luad": {"path": "luad.npy", "genes": "luad_genes.txt"}},
+#     "dbs": ["kegg", "reactome", "my_pathways.gmt"],
+#     "directions": ["suppression", "activation"],
+#     "output_dir": "scores",
+#     "output_format": "tsv",
+#     "memory_budget": "8G",
+#     "workers": 2,
+#     "settings": {"rank_method": "max", "geometric": true}
+#   }
+#
+# A cohort is a path or a dict with the path and the expression_source
+# arguments (format, genes, samples, dataset; genes and samples may name text
+# files with one name per line). A db is the name of an included database, a
+# compiled gene-set directory or a TSV, GMT or user CSV gene-set file. Relative
+# paths are resolved against the manifest's directory. settings are passed on
+# to pathway_assessor.all.
+#
+# Each cohort is read once by one worker, which then runs all of its jobs on
+# the same prepared ranks (both directions share one sort and all dbs are
+# scored in one pass, so a gene set found in several dbs is scored once).
+# Cohorts run in `workers` processes as long as their estimated memory fits
+# in memory_budget; a cohort that does not fit on its own is scored alone, in
+# sample chunks small enough to fit.
+#
+# Output, per cohort and db, named {direction}_{result}:
+#   tsv      {output_dir}/{cohort}/{db}/{direction}_{result}.tsv
+#   parquet  {output_dir}/{cohort}/{db}/{direction}_{result}.parquet
+#   npz      {output_dir}/{cohort}/{db}.npz, with `pathways` and `samples`
+
+output_formats = ('tsv', 'parquet', 'npz')
+manifest_keys = (
+    'cohorts', 'dbs', 'directions', 'output_dir', 'output_format', 'memory_budget', 'workers', 'n_jobs', 'settings'
+)
+settings_keys = (
+    'geometric', 'min_p_val', 'rank_method', 'p_value_method', 'extra_aggregates', 'log_p', 'precision', 'backend'
+)
+cohort_keys = ('path', 'format', 'genes', 'samples', 'dataset')
+
+# Peak memory of scoring a cohort, measured on both directions of kegg:
+# about 96 bytes per expression cell on top of the working set of the
+# batched pathway blocks
+cohort_cell_bytes = 96
+job_bytes = 160 * BLOCK_CELLS
+
+memory_units = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def validate_output_format(output_format):
+    if output_format not in output_formats:
+        raise ValueError(
+            "{} not recognized. Available output formats: {}".format(output_format, ",".join(output_formats))
+        )
+    # fail before scoring when pyarrow is missing
+    if output_format == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        raise ImportError("pyarrow is required for the parquet output format")
+    return True
+
+
+def validate_keys(keys, available, kind):
+    for key in keys:
+        if key not in available:
+            raise ValueError("{} not recognized. Available {}: {}".format(key, kind, ",".join(available)))
+    return True
+
+
+# bytes, or a string such as '512M' or '1.5G'
+def parse_memory(memory):
+    if memory is None or isinstance(memory, int):
+        return memory
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?)I?B?\s*', str(memory).upper())
+    if match is None:
+        raise ValueError("{} not recognized. Memory budgets are bytes or a number with K, M, G or T".format(memory))
+    return int(float(match.group(1)) * memory_units[match.group(2)])
+
+
+def resolve_path(path, base_dir):
+    return path if os.path.isabs(path) else os.path.join(base_dir, path)
+
+
+def read_names(names, base_dir):
+    if not isinstance(names, str):
+        return names
+    with open(resolve_path(names, base_dir)) as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def load_manifest(f):
+    with open(f) as f_in:
+        manifest = json.load(f_in)
+    base_dir = os.path.dirname(os.path.abspath(f))
+    validate_keys(manifest, manifest_keys, 'manifest keys')
+
+    cohorts = {}
+    for name, cohort in manifest.get('cohorts', {}).items():
+        cohort = {'path': cohort} if isinstance(cohort, str) else dict(cohort)
+        validate_keys(cohort, cohort_keys, 'cohort keys')
+        cohort['path'] = resolve_path(cohort['path'], base_dir)
+        for axis in ('genes', 'samples'):
+            if axis in cohort:
+                cohort[axis] = read_names(cohort[axis], base_dir)
+        cohorts[name] = cohort
+
+    dbs = {}
+    for db in manifest.get('dbs', ['kegg']):
+        path = resolve_path(db, base_dir)
+        if os.path.exists(path):
+            dbs[os.path.splitext(os.path.basename(os.path.normpath(db)))[0]] = path
+        else:
+            dbs[db.lower()] = db
+
+    return {
+        'cohorts': cohorts,
+        'dbs': dbs,
+        'directions': manifest.get('directions', ['suppression']),
+        'output_dir': resolve_path(manifest.get('output_dir', 'scores'), base_dir),
+        'output_format': manifest.get('output_format', 'tsv'),
+        'memory_budget': parse_memory(manifest.get('memory_budget')),
+        'workers': manifest.get('workers', 1),
+        'n_jobs': manifest.get('n_jobs', 1),
+        'settings': manifest.get('settings', {}),
+    }
+
+
+def validate_manifest(manifest):
+    if not manifest['cohorts']:
+        raise ValueError("The manifest has no cohorts")
+    if not manifest['directions']:
+        raise ValueError("The manifest has no directions")
+    validate_keys(manifest['directions'], list(directions), 'directions')
+    validate_keys(manifest['settings'], settings_keys, 'settings')
+    validate_rank_method(manifest['settings'].get('rank_method', 'max'))
+    validate_p_value_method(manifest['settings'].get('p_value_method', 'hypergeom'))
+    validate_aggregates(manifest['settings'].get('extra_aggregates', ()))
+    validate_output_format(manifest['output_format'])
+    if manifest['workers'] < 1:
+        raise ValueError("workers must be at least 1")
+    return True
+
+
+# Name of an included database, a compiled directory or a gene-set file
+def manifest_pathways(db):
+    if os.path.isdir(db):
+        return load_gene_sets(db)
+    if os.path.exists(db):
+        return gene_sets_from_dict(read_gene_set_file(db))
+    return db_pathways(db)
+
+
+# genes x samples of a cohort without loading it. TSV rows are counted.
+def cohort_shape(cohort):
+    source_format = cohort.get('format') or infer_source_format(cohort['path'])
+    if source_format == 'tsv':
+        with open(cohort['path']) as f:
+            n_samples = len(f.readline().rstrip('\n').split('\t')) - 1
+            n_genes = sum(1 for _ in f)
+        return n_genes, n_samples
+    source = cohort_source(cohort, None)
+    return len(source.genes), len(source.samples)
+
+
+def cohort_source(cohort, spill_dir):
+    return expression_source(
+        cohort['path'],
+        source_format=cohort.get('format'),
+        genes=cohort.get('genes'),
+        samples=cohort.get('samples'),
+        dataset=cohort.get('dataset', 'expression'),
+        spill_dir=spill_dir
+    )
+
+
+def cohort_bytes(n_genes, n_samples):
+    return n_genes * n_samples * cohort_cell_bytes + job_bytes
+
+
+# Samples per chunk so that scoring a chunk fits in memory_budget
+def chunk_size(n_genes, n_samples, memory_budget):
+    if memory_budget is None or cohort_bytes(n_genes, n_samples) <= memory_budget:
+        return max(n_samples, 1)
+    return int(min(max((memory_budget - job_bytes) // max(n_genes * cohort_cell_bytes, 1), 1), n_samples))
+
+
+def write_scores(out_dir, db_name, frames, output_format):
+    os.makedirs(out_dir, exist_ok=True)
+    if output_format == 'npz':
+        f = os.path.join(out_dir, '{}.npz'.format(db_name))
+        first = next(iter(frames.values()))
+        np.savez_compressed(
+            f,
+            pathways=np.array(first.index, dtype=str),
+            samples=np.array(first.columns, dtype=str),
+            **{name: frame.values for name, frame in frames.items()}
+        )
+        return [f]
+
+    db_dir = os.path.join(out_dir, db_name)
+    os.makedirs(db_dir, exist_ok=True)
+    files = []
+    for name, frame in frames.items():
+        f = os.path.join(db_dir, '{}.{}'.format(name, output_format))
+        if output_format == 'tsv':
+            frame.to_csv(f, sep='\t')
+        else:
+            frame.rename(columns=str).to_parquet(f)
+        files.append(f)
+    return files
+
+
+# Scores one cohort against every db in job_directions, reading it once and
+# scoring it in chunks of samples that fit in memory_budget. Returns
+# {db: written files}.
+def score_cohort(name, cohort, dbs, job_directions, settings, output_dir, output_format, memory_budget=None, n_jobs=1):
+    direction = 'both' if len(set(job_directions)) > 1 else job_directions[0]
+    pathways = {db_name: manifest_pathways(db) for db_name, db in dbs.items()}
+    chunks = {db_name: [] for db_name in dbs}
+    # every db is scored in one pass, so gene sets shared by dbs are scored once
+    combined = combine_gene_sets(list(pathways.values()))
+    bounds = np.cumsum([0] + [len(gene_sets.names) for gene_sets in pathways.values()])
+
+    with tempfile.TemporaryDirectory() as spill:
+        source = cohort_source(cohort, spill)
+        size = chunk_size(len(source.genes), len(source.samples), memory_budget)
+        for start, stop in sample_chunks(len(source.samples), size):
+            logger.info('%s: samples %d-%d of %d', name, start, stop, len(source.samples))
+            prepared = PreparedExpression(source.chunk(start, stop))
+            results = pathway_assessor.all(prepared, pathways=combined, direction=direction, n_jobs=n_jobs, **settings)
+            if direction != 'both':
+                results = {direction: results}
+            frames = result_frames(results)
+            for db_name, start, stop in zip(pathways, bounds[:-1], bounds[1:]):
+                chunks[db_name].append({key: frame.iloc[start:stop] for key, frame in frames.items()})
+
+    files = {}
+    for db_name, db_chunks in chunks.items():
+        if not db_chunks:
+            continue
+        frames = {key: pd.concat([chunk[key] for chunk in db_chunks], axis=1) for key in db_chunks[0]}
+        files[db_name] = write_scores(os.path.join(output_dir, name), db_name, frames, output_format)
+        logger.info('finished: %s %s', name, db_name)
+    return files
+
+
+# Runs every job of a manifest (a path or the result of load_manifest).
+# Returns {cohort: {db: written files}}.
+def run_manifest(manifest):
+    if not isinstance(manifest, dict):
+        manifest = load_manifest(manifest)
+    validate_manifest(manifest)
+    memory_budget = manifest['memory_budget']
+
+    def submit(submit_function, name, budget):
+        return submit_function(
+            score_cohort, name, manifest['cohorts'][name], manifest['dbs'], manifest['directions'],
+            manifest['settings'], manifest['output_dir'], manifest['output_format'], budget, manifest['n_jobs']
+        )
+
+    files = {}
+    if manifest['workers'] == 1:
+        for name in manifest['cohorts']:
+            files[name] = submit(lambda f, *args: f(*args), name, memory_budget)
+        return files
+
+    # cohorts start in manifest order while their estimates fit in the budget
+    pending = [(name, cohort_bytes(*cohort_shape(cohort))) for name, cohort in manifest['cohorts'].items()]
+    running = {}
+    names = {}
+    with process_pool(manifest['workers']) as executor:
+        while pending or running:
+            used = sum(running.values())
+            while pending and len(running) < manifest['workers']:
+                name, estimate = pending[0]
+                if memory_budget is not None and running and used + estimate > memory_budget:
+                    break
+                pending.pop(0)
+                budget = None if memory_budget is None else memory_budget - used
+                future = submit(executor.submit, name, budget)
+                running[future] = estimate if budget is None else min(estimate, budget)
+                used += running[future]
+                names[future] = name
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                files[names.pop(future)] = future.result()
+    return {name: files[name] for name in manifest['cohorts']}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pathway-assessor',
+        description='Score every cohort of a JSON manifest against every database in every direction'
+    )
+    parser.add_argument('manifest')
+    parser.add_argument('--output-dir', help='overrides output_dir of the manifest')
+    parser.add_argument('--output-format', choices=output_formats, help='overrides output_format of the manifest')
+    parser.add_argument('--memory-budget', help="e.g. 8G; overrides memory_budget of the manifest")
+    parser.add_argument('--workers', type=int, help='cohorts scored at once; overrides workers of the manifest')
+    parser.add_argument('--n-jobs', type=int, help='processes per job; overrides n_jobs of the manifest')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO if args.verbose else logging.WARNING)
+    manifest = load_manifest(args.manifest)
+    for key in ('output_dir', 'output_format', 'workers', 'n_jobs'):
+        if getattr(args, key) is not None:
+            manifest[key] = getattr(args, key)
+    if args.memory_budget is not None:
+        manifest['memory_budget'] = parse_memory(args.memory_budget)
+
+    for cohort_files in run_manifest(manifest).values():
+        for db_files in cohort_files.values():
+            for f in db_files:
+                print(f)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,124 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+
+# Deduplication of the expression table: rows sharing a gene label are
+# combined into one row per gene, rows without a label are dropped and the
+# values become float64.
+#   mean          mean of the rows of a gene, skipping NaN
+#   median        median of the rows of a gene, skipping NaN
+#   max_variance  the row of a gene with the largest variance across samples
+#                 (the first one on ties; rows with fewer than two values
+#                 come last)
+# An index that is already unique is only sorted when needed; duplicated
+# labels are resolved with one hash of the index (pd.factorize) and combined
+# without sorting the values.
+dedup_methods = ('mean', 'median', 'max_variance')
+
+
+def validate_dedup(dedup):
+    if dedup not in dedup_methods:
+        raise ValueError(
+            "{} not recognized. Available dedup methods: {}".format(dedup, ",".join(dedup_methods))
+        )
+    return True
+
+
+# Reuse a pandas Index as is, so that its hash table (built on the first
+# lookup) is shared by every lookup against the same genes
+def gene_index(genes):
+    return genes if isinstance(genes, pd.Index) else pd.Index(genes)
+
+
+# codes: gene position of every row (-1 for rows without a label)
+def gene_codes(index, sort=True):
+    codes, genes = pd.factorize(index, sort=sort)
+    return codes, pd.Index(genes, name='genes')
+
+
+# Sums and counts of the present values of every gene by sparse products.
+# The product reads the dense operand row-major, so values (column-major when
+# taken from a data frame) are copied once into row order and zeroed there.
+def segment_mean(values, codes, n_genes):
+    indicator = sparse.csr_matrix(
+        (np.ones(len(codes)), (codes, np.arange(len(codes)))), shape=(n_genes, len(codes))
+    )
+    values = np.array(values, order='C')
+    missing = np.isnan(values)
+    if missing.any():
+        np.copyto(values, 0., where=missing)
+        counts = indicator @ (~missing).view(np.uint8)
+    else:
+        counts = np.bincount(codes, minlength=n_genes)[:, None]
+    sums = indicator @ values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+# Genes with the same number of rows are stacked into one
+# (genes, rows, samples) array, sorted along the rows (NaN last) and the
+# middle present values are averaged. One or two rows need no sort.
+def segment_median(values, codes, n_genes):
+    counts = np.bincount(codes, minlength=n_genes)
+    order = np.argsort(codes, kind='stable')
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    medians = np.empty((n_genes, values.shape[1]))
+    for count in np.unique(counts[counts > 0]):
+        genes = np.flatnonzero(counts == count)
+        rows = order[starts[genes][:, None] + np.arange(count)]
+        if count == 1:
+            medians[genes] = values[rows[:, 0]]
+            continue
+        if count == 2:
+            first, second = values[rows[:, 0]], values[rows[:, 1]]
+            medians[genes] = np.where(np.isnan(first), second, np.where(np.isnan(second), first, (first + second) / 2))
+            continue
+        stack = values[rows]
+        stack.sort(axis=1)
+        present = (~np.isnan(stack)).sum(axis=1)
+        lower = np.take_along_axis(stack, np.maximum((present - 1) // 2, 0)[:, None], axis=1)[:, 0]
+        upper = np.take_along_axis(stack, np.minimum(present // 2, count - 1)[:, None], axis=1)[:, 0]
+        medians[genes] = np.where(present > 0, (lower + upper) / 2, np.nan)
+    return medians
+
+
+def max_variance_rows(values, codes, n_genes):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        variance = np.nanvar(values, axis=1, ddof=1)
+    variance[np.isnan(variance)] = -np.inf
+    best = np.full(n_genes, -np.inf)
+    np.maximum.at(best, codes, variance)
+    candidates = np.flatnonzero(variance == best[codes])
+    rows = np.full(n_genes, len(codes), dtype=np.intp)
+    np.minimum.at(rows, codes[candidates], candidates)
+    return rows
+
+
+def combine_rows(values, codes, n_genes, dedup):
+    if dedup == 'max_variance':
+        return values[max_variance_rows(values, codes, n_genes)]
+    if dedup == 'median':
+        return segment_median(values, codes, n_genes)
+    return segment_mean(values, codes, n_genes)
+
+
+# Expression table with one float64 row per gene, in sorted gene order with
+# sort=True and in order of first appearance otherwise. The index is named
+# 'genes'.
+def dedup_expression_table(df, dedup='mean', sort=True):
+    validate_dedup(dedup)
+    index = df.index
+    if index.is_unique and not index.hasnans:
+        if sort and not index.is_monotonic_increasing:
+            df = df.sort_index()
+        return df.astype(np.float64).rename_axis('genes')
+
+    codes, genes = gene_codes(index, sort=sort)
+    values = df.to_numpy(dtype=np.float64)
+    labelled = codes >= 0
+    if not labelled.all():
+        values, codes = values[labelled], codes[labelled]
+    return pd.DataFrame(combine_rows(values, codes, len(genes), dedup), index=genes, columns=df.columns)
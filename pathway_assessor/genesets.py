@@ -0,0 +1,146 @@
+import csv
+import functools
+import os
+
+from collections import namedtuple
+
+import numpy as np
+import scipy.sparse as sparse
+
+from .dedup import gene_index
+
+# Compiled gene-set databases: a directory of four .npy arrays that are
+# memory-mapped on load, so opening a database costs no parsing at all.
+#   names.npy    pathway names, in pathway order
+#   genes.npy    gene vocabulary (sorted, unique)
+#   offsets.npy  CSR row pointer; pathway i owns indices[offsets[i]:offsets[i + 1]]
+#   indices.npy  positions in the vocabulary of the genes of every pathway
+GeneSets = namedtuple('GeneSets', ['names', 'genes', 'offsets', 'indices'])
+
+gene_set_arrays = GeneSets._fields
+compiled_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'databases', 'compiled')
+gene_set_formats = ('tsv', 'gmt', 'csv')
+
+
+def gene_sets_from_dict(pathways):
+    names = list(pathways)
+    pathway_genes = [sorted({str(gene) for gene in pathways[name]}) for name in names]
+    genes = np.array(sorted({gene for pathway in pathway_genes for gene in pathway}), dtype=str)
+    indices = np.searchsorted(genes, [gene for pathway in pathway_genes for gene in pathway]).astype(np.int32)
+    offsets = np.concatenate([[0], np.cumsum([len(pathway) for pathway in pathway_genes])]).astype(np.int64)
+    return GeneSets(np.array(names, dtype=str), genes, offsets, indices)
+
+
+# Gene sets of several databases as one, pathways in the given order, over the
+# union of their vocabularies
+def combine_gene_sets(gene_sets_list):
+    genes = np.unique(np.concatenate([np.asarray(gene_sets.genes, dtype=str) for gene_sets in gene_sets_list]))
+    indices = [
+        np.searchsorted(genes, np.asarray(gene_sets.genes, dtype=str))[np.asarray(gene_sets.indices)]
+        for gene_sets in gene_sets_list
+    ]
+    starts = np.cumsum([0] + [len(gene_set_indices) for gene_set_indices in indices[:-1]])
+    offsets = [np.zeros(1, dtype=np.int64)] + [
+        np.asarray(gene_sets.offsets[1:]) + start for gene_sets, start in zip(gene_sets_list, starts)
+    ]
+    return GeneSets(
+        np.concatenate([np.asarray(gene_sets.names, dtype=str) for gene_sets in gene_sets_list]),
+        genes,
+        np.concatenate(offsets).astype(np.int64),
+        np.concatenate(indices).astype(np.int32)
+    )
+
+
+def gene_sets_dict(gene_sets):
+    genes = gene_sets.genes.tolist()
+    indices = gene_sets.indices.tolist()
+    offsets = gene_sets.offsets.tolist()
+    return {
+        name: {genes[i] for i in indices[offsets[row]:offsets[row + 1]]}
+        for row, name in enumerate(gene_sets.names.tolist())
+    }
+
+
+def validate_gene_set_format(file_format):
+    if file_format not in gene_set_formats:
+        raise ValueError(
+            "{} not recognized. Available gene set formats: {}".format(file_format, ",".join(gene_set_formats))
+        )
+    return True
+
+
+# tsv: name, genes... (pathway_tables/wikipathways.tsv)
+# gmt: name, description, genes...
+# csv: name, db, genes... (the user_pathways format)
+def read_gene_set_file(f, file_format=None):
+    if file_format is None:
+        extension = os.path.splitext(f)[1].lower()
+        file_format = {'.gmt': 'gmt', '.csv': 'csv', '.txt': 'csv'}.get(extension, 'tsv')
+    validate_gene_set_format(file_format)
+
+    first_gene = {'tsv': 1, 'gmt': 2, 'csv': 2}[file_format]
+    pathways = {}
+    with open(f, 'r', newline='') as f_in:
+        reader = csv.reader(f_in, delimiter=',' if file_format == 'csv' else '\t')
+        for row in reader:
+            if not row or not row[0]:
+                continue
+            pathways.setdefault(row[0], set()).update(gene for gene in row[first_gene:] if gene)
+    return pathways
+
+
+def save_gene_sets(gene_sets, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    for array_name, array in zip(gene_set_arrays, gene_sets):
+        np.save(os.path.join(out_dir, '{}.npy'.format(array_name)), array, allow_pickle=False)
+    return out_dir
+
+
+# Compile a dict of pathways or a TSV, GMT or user CSV gene-set file into out_dir
+def compile_gene_sets(pathways, out_dir, file_format=None):
+    if not isinstance(pathways, dict):
+        pathways = read_gene_set_file(pathways, file_format=file_format)
+    save_gene_sets(gene_sets_from_dict(pathways), out_dir)
+    load_gene_sets.cache_clear()
+    return out_dir
+
+
+# Memory-mapped compiled database, loaded once per process and directory
+@functools.lru_cache(maxsize=None)
+def load_gene_sets(path):
+    return GeneSets(*(
+        np.load(os.path.join(path, '{}.npy'.format(array_name)), mmap_mode='r', allow_pickle=False)
+        for array_name in gene_set_arrays
+    ))
+
+
+def db_gene_sets(db_name):
+    return load_gene_sets(os.path.join(compiled_dir, db_name.lower()))
+
+
+# pathways x genes CSR membership matrix of a compiled database. The
+# vocabulary is matched against `genes` once; pathway rows are then pure
+# integer lookups. Genes missing from `genes` are dropped.
+def gene_sets_membership(gene_sets, genes):
+    vocabulary_positions = gene_index(genes).get_indexer(gene_sets.genes)
+    cols = vocabulary_positions[gene_sets.indices]
+    present = cols >= 0
+    indptr = np.concatenate([[0], np.cumsum(present)])[gene_sets.offsets]
+
+    membership = sparse.csr_matrix(
+        (np.ones(present.sum(), dtype=np.int8), cols[present], indptr),
+        shape=(len(gene_sets.names), len(genes))
+    )
+    membership.sort_indices()
+    return membership
+
+
+# Pathways start:stop of a compiled database, sharing its vocabulary
+def gene_sets_slice(gene_sets, start, stop):
+    offsets = gene_sets.offsets[start:stop + 1]
+    return GeneSets(
+        gene_sets.names[start:stop],
+        gene_sets.genes,
+        np.asarray(offsets) - offsets[0],
+        gene_sets.indices[offsets[0]:offsets[-1]]
+    )
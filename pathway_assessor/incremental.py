@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from . import pathway_assessor
+from .pathway_assessor import GeneSets, db_pathways, validate_pathways
+from .streaming import result_frames
+
+# Incremental scoring of a growing cohort. Ranks and background gene counts
+# are per sample, so the scores of a sample do not change when columns are
+# added, as long as the gene universe (the genes left after
+# processed_expression_table) and the scoring settings stay the same. A score
+# set is saved as one TSV per result plus score_set.json, which records the
+# samples, the gene universe fingerprint and the settings it was scored with.
+
+ScoreUpdate = namedtuple('ScoreUpdate', ['results', 'new_samples', 'recomputed'])
+
+score_set_file = 'score_set.json'
+
+
+# Genes of processed_expression_table(expression_table): the unique, sorted
+# non-null index labels
+def gene_universe(expression_table):
+    return pd.Index(expression_table.index).dropna().unique().sort_values()
+
+
+def gene_universe_fingerprint(expression_table):
+    digest = hashlib.sha1()
+    digest.update(json.dumps([str(gene) for gene in gene_universe(expression_table)]).encode())
+    return digest.hexdigest()
+
+
+def pathways_fingerprint(pathways):
+    digest = hashlib.sha1()
+    if isinstance(pathways, GeneSets):
+        for array in pathways:
+            digest.update(np.ascontiguousarray(array).tobytes())
+    else:
+        digest.update(json.dumps(
+            [[str(name), sorted(str(gene) for gene in set(genes))] for name, genes in pathways.items()]
+        ).encode())
+    return digest.hexdigest()
+
+
+# Directions of all() results: [(None, results)] or, with direction='both',
+# [('suppression', results), ('activation', results)]
+def direction_results(results):
+    if 'harmonic' in results:
+        return [(None, results)]
+    return list(results.items())
+
+
+def save_score_set(results, score_set_dir, samples, fingerprint, settings):
+    os.makedirs(score_set_dir, exist_ok=True)
+    for name, frame in result_frames(results).items():
+        frame.to_csv(os.path.join(score_set_dir, '{}.tsv'.format(name)), sep='\t')
+    with open(os.path.join(score_set_dir, score_set_file), 'w') as f:
+        json.dump({
+            'samples': [str(sample) for sample in samples],
+            'gene_universe': fingerprint,
+            'settings': settings,
+            'results': [
+                [direction, stat, frame is not None]
+                for direction, stats in direction_results(results)
+                for stat, frame in stats.items()
+            ],
+        }, f, indent=1)
+    return score_set_dir
+
+
+def load_score_set(score_set_dir):
+    with open(os.path.join(score_set_dir, score_set_file)) as f:
+        score_set = json.load(f)
+    results = {}
+    for direction, stat, saved in score_set['results']:
+        frame = None
+        if saved:
+            name = '{}_{}'.format(direction, stat) if direction else stat
+            frame = pd.read_csv(
+                os.path.join(score_set_dir, '{}.tsv'.format(name)), sep='\t', index_col=0, float_precision='round_trip'
+            )
+            frame.index.name = None
+        (results.setdefault(direction, {}) if direction else results)[stat] = frame
+    return results, score_set
+
+
+def merge_results(results, new_results):
+    merged = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            merged[key] = merge_results(value, new_results[key])
+        elif value is None:
+            merged[key] = None
+        else:
+            merged[key] = pd.concat([value, new_results[key]], axis=1)
+    return merged
+
+
+# pathway_assessor.all for a cohort whose scores were saved in score_set_dir
+# by an earlier update: only samples not in the score set are scored and
+# merged in, and the merged score set is saved back. The whole table is
+# rescored (and must then hold every saved sample) when there is no score set
+# yet or the gene universe or settings differ from the saved ones.
+def update_scores(
+        expression_table,
+        score_set_dir,
+        pathways=None,
+        db='kegg',
+        geometric=True,
+        min_p_val=True,
+        ascending=True,
+        rank_method='max',
+        p_value_method='hypergeom',
+        n_jobs=1,
+        executor=None,
+        extra_aggregates=(),
+        log_p=False,
+        direction=None,
+        p_value_cache=None,
+        precision='double',
+        backend='numpy'
+):
+    if not pathways:
+        pathways = db_pathways(db)
+    else:
+        validate_pathways(pathways)
+    settings = {
+        'pathways': pathways_fingerprint(pathways),
+        'geometric': bool(geometric),
+        'min_p_val': bool(min_p_val),
+        'ascending': bool(ascending),
+        'rank_method': rank_method,
+        'p_value_method': p_value_method,
+        'extra_aggregates': list(extra_aggregates),
+        'log_p': bool(log_p),
+        'direction': direction,
+        'precision': precision,
+    }
+    # backends give the same scores, so switching backend keeps the score set
+    fingerprint = gene_universe_fingerprint(expression_table)
+    samples = [str(sample) for sample in expression_table.columns]
+
+    def score(table):
+        return pathway_assessor.all(
+            table,
+            pathways=pathways,
+            geometric=geometric,
+            min_p_val=min_p_val,
+            ascending=ascending,
+            rank_method=rank_method,
+            p_value_method=p_value_method,
+            n_jobs=n_jobs,
+            executor=executor,
+            extra_aggregates=extra_aggregates,
+            log_p=log_p,
+            direction=direction,
+            p_value_cache=p_value_cache,
+            precision=precision,
+            backend=backend
+        )
+
+    score_set = None
+    if os.path.exists(os.path.join(score_set_dir, score_set_file)):
+        results, score_set = load_score_set(score_set_dir)
+
+    if score_set is None or score_set['gene_universe'] != fingerprint or score_set['settings'] != settings:
+        missing = [] if score_set is None else [sample for sample in score_set['samples'] if sample not in samples]
+        if missing:
+            raise ValueError(
+                "The gene universe or settings changed, so every sample has to be rescored; "
+                "missing samples: {}".format(",".join(missing))
+            )
+        results = score(expression_table.copy())
+        save_score_set(results, score_set_dir, samples, fingerprint, settings)
+        return ScoreUpdate(results, samples, True)
+
+    new_samples = [sample for sample in samples if sample not in score_set['samples']]
+    if new_samples:
+        new_columns = [column for column in expression_table.columns if str(column) in new_samples]
+        results = merge_results(results, score(expression_table[new_columns].copy()))
+        save_score_set(results, score_set_dir, score_set['samples'] + new_samples, fingerprint, settings)
+    return ScoreUpdate(results, new_samples, False)
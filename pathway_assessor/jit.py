@@ -0,0 +1,201 @@
+import math
+
+import numpy as np
+
+from . import profiling
+from .aggregation import default_aggregates, statistics_scores, validate_aggregates
+from .batched import SparseRanks, rank_methods, validate_rank_method
+from .parallel import start_fork_server
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# backend='numba' scores with one compiled kernel per run: for every
+# (pathway, sample) it ranks the pathway genes, builds their 2x2 tables,
+# takes the hypergeometric log p-values (hypergeom_log_sf, with math.lgamma
+# for the log binomials) and reduces them to the statistics of the
+# aggregates, with samples spread over threads (prange). Compiled kernels are
+# cached on disk. P-values are float64 whatever the precision and only the
+# 'hypergeom' p-value method is available. Without numba installed the
+# kernel is not compiled and the numpy backend is used instead.
+backends = ('numpy', 'numba')
+
+# Statistics computed by the kernel, in the order of its output
+kernel_statistics = ('count', 'min', 'log_sum', 'reciprocal', 'cauchy')
+
+
+def validate_backend(backend):
+    if backend not in backends:
+        raise ValueError(
+            "{} not recognized. Available backends: {}".format(backend, ",".join(backends))
+        )
+    return True
+
+
+def effective_backend(backend):
+    validate_backend(backend)
+    if backend == 'numba' and numba is None:
+        profiling.logger.warning('numba is not installed; scoring with the numpy backend')
+        return 'numpy'
+    return backend
+
+
+def njit(**options):
+    if numba is None:
+        return lambda function: function
+    return numba.njit(cache=True, **options)
+
+
+prange = numba.prange if numba is not None else range
+
+
+@njit()
+def log_binomial(n, k):
+    return math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
+
+
+# Scalar hypergeom_tail_sums
+@njit()
+def tail_sum(x, stop, M, K, n, step):
+    total = 1.
+    if x == stop:
+        return total
+    y = float(x)
+    rest = M - K - n
+    term = 1.
+    while True:
+        if step > 0:
+            term *= (K - y) * (n - y) / ((y + 1) * (rest + y + 1))
+        else:
+            term *= y * (rest + y) / ((K - y + 1) * (n - y + 1))
+        total += term
+        y += step
+        if y == stop or term <= 1e-17 * total:
+            return total
+
+
+# Scalar hypergeom_log_sf of [[a, b], [c, d]]
+@njit()
+def log_sf(a, b, c, d):
+    if a + b == 0 or c + d == 0 or a + c == 0 or b + d == 0:
+        return 0.
+    M = a + b + c + d
+    K = a + c
+    n = a + b
+    lowest = max(0, a - d)
+    if a <= lowest:
+        return 0.
+    if a > (n + 1) * (K + 1) // (M + 2):
+        log_pmf = log_binomial(K, a) + log_binomial(M - K, n - a) - log_binomial(M, n)
+        return log_pmf + math.log(tail_sum(a, min(n, K), M, K, n, 1))
+    x = a - 1
+    log_pmf = log_binomial(K, x) + log_binomial(M - K, n - x) - log_binomial(M, n)
+    cdf = math.exp(log_pmf) * tail_sum(x, lowest, M, K, n, -1)
+    return math.log1p(-min(cdf, 1.))
+
+
+# Ranks of values[:n] among themselves, written to ranks[:n]; rank_method is
+# a position in batched.rank_methods
+@njit()
+def within_ranks(values, n, rank_method, ranks):
+    order = np.argsort(values[:n], kind='mergesort')
+    start = 0
+    group = 0
+    while start < n:
+        stop = start
+        while stop + 1 < n and values[order[stop + 1]] == values[order[start]]:
+            stop += 1
+        group += 1
+        for k in range(start, stop + 1):
+            if rank_method == 0:
+                ranks[order[k]] = (start + stop) / 2 + 1
+            elif rank_method == 1:
+                ranks[order[k]] = start + 1
+            elif rank_method == 2:
+                ranks[order[k]] = stop + 1
+            elif rank_method == 3:
+                ranks[order[k]] = k + 1
+            else:
+                ranks[order[k]] = group
+        start = stop + 1
+
+
+# (statistics, pathways, samples) array of the kernel_statistics of every
+# pathway of a CSR membership and every sample. Ranks below 1 (NaN, or 0
+# with precision='single') are missing. Without log_p the log p-values go
+# through p-values, as the numpy backend computes them.
+@njit(parallel=True)
+def pathway_statistics(expression_ranks, bg, indptr, indices, rank_method, log_p):
+    n_pathways = len(indptr) - 1
+    n_samples = expression_ranks.shape[1]
+    statistics = np.full((5, n_pathways, n_samples), np.nan)
+    max_size = 0
+    for i in range(n_pathways):
+        max_size = max(max_size, indptr[i + 1] - indptr[i])
+
+    for j in prange(n_samples):
+        ranks = np.empty(max_size)
+        pathway_ranks = np.empty(max_size)
+        log_p_values = np.empty(max_size)
+        for i in range(n_pathways):
+            n = 0
+            for k in range(indptr[i], indptr[i + 1]):
+                rank = expression_ranks[indices[k], j]
+                if rank >= 1:
+                    ranks[n] = rank
+                    n += 1
+            statistics[0, i, j] = n
+            if n == 0:
+                continue
+
+            within_ranks(ranks, n, rank_method, pathway_ranks)
+            effective_pathway = pathway_ranks[:n].max()
+            lowest = np.inf
+            log_sum = 0.
+            cauchy = 0.
+            for k in range(n):
+                a = int(pathway_ranks[k])
+                b = int(ranks[k] - pathway_ranks[k])
+                c = int(effective_pathway - pathway_ranks[k])
+                d = int(bg[j] - ranks[k] - effective_pathway + pathway_ranks[k])
+                log_p_value = log_sf(a, b, c, d)
+                if not log_p:
+                    log_p_value = np.log(np.exp(log_p_value))
+                log_p_values[k] = log_p_value
+                lowest = min(lowest, log_p_value)
+                log_sum += log_p_value
+                cauchy += 1 / math.tan(math.pi * math.exp(log_p_value))
+
+            # log(SUM 1/Pk), shifted by the smallest log p-value
+            reciprocal = 0.
+            if np.isfinite(lowest):
+                for k in range(n):
+                    reciprocal += math.exp(lowest - log_p_values[k])
+            statistics[1, i, j] = lowest
+            statistics[2, i, j] = log_sum
+            statistics[3, i, j] = np.log(reciprocal) - lowest
+            statistics[4, i, j] = cauchy
+    return statistics
+
+
+# Scores of every pathway of a membership matrix and every sample, as
+# batched.pathway_scores with p_value_method='hypergeom'
+def jit_pathway_scores(expression_ranks, bg, membership, rank_method='max', aggregates=default_aggregates, log_p=False):
+    validate_rank_method(rank_method)
+    validate_aggregates(aggregates)
+    if isinstance(expression_ranks, SparseRanks):
+        raise ValueError("backend='numba' is not supported with sparse expression")
+    start_fork_server()
+    with profiling.stage('jit_kernel'):
+        statistics = pathway_statistics(
+            np.asarray(expression_ranks),
+            np.asarray(bg, dtype=np.float64),
+            membership.indptr.astype(np.int64),
+            membership.indices.astype(np.int64),
+            rank_methods.index(rank_method),
+            bool(log_p)
+        )
+    with profiling.stage('aggregation'):
+        return statistics_scores(dict(zip(kernel_statistics, statistics)), aggregates)
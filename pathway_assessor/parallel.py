@@ -0,0 +1,260 @@
+import multiprocessing
+import os
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from .aggregation import default_aggregates, validate_aggregates
+from .batched import (
+    BLOCK_CELLS,
+    SparseRanks,
+    block_membership,
+    block_scores,
+    block_scores_both,
+    pathway_blocks,
+    pathway_scores,
+    pathway_scores_both,
+    rank_dtype,
+    score_matrices,
+    validate_precision
+)
+
+
+def validate_n_jobs(n_jobs):
+    if not isinstance(n_jobs, int) or n_jobs == 0 or n_jobs < -1:
+        raise ValueError("n_jobs should be a positive integer or -1 (all cores), got {}".format(n_jobs))
+    return True
+
+
+def effective_n_jobs(n_jobs):
+    validate_n_jobs(n_jobs)
+    if n_jobs == -1:
+        return os.cpu_count() or 1
+    return n_jobs
+
+
+# Worker processes start from a fork server rather than a fork of the
+# caller: forking a process whose thread pool has run (numba's threading
+# layer after backend='numba') can deadlock the child. The server imports
+# the package once, so workers start without importing it again. As with
+# spawn, a script that starts a pool needs an `if __name__ == '__main__':`
+# guard.
+def process_pool(max_workers):
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=max_workers)
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=forkserver_context())
+
+
+def forkserver_context():
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__package__])
+    return context
+
+
+# Before Python 3.10 the fork server (and its resource tracker) is started
+# with fork(); started after numba's TBB threading layer has run, the process
+# then hangs at exit. The numba backend starts the server ahead of its threads.
+def start_fork_server():
+    if sys.version_info < (3, 10) and 'forkserver' in multiprocessing.get_all_start_methods():
+        from multiprocessing import forkserver
+        forkserver_context()
+        forkserver.ensure_running()
+
+
+# Attach to a block created by the parent, which alone unlinks it. Before
+# Python 3.13 attaching always registers the block, but pool workers share
+# the parent's resource tracker so that registration is a no-op.
+def attach_shared_memory(name):
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        return SharedMemory(name=name)
+
+
+# (dtype, shape, byte offset) of every matrix packed one after the other
+# into one shared memory block, each starting on an 8 byte boundary
+def shared_layout(matrices):
+    layout = []
+    offset = 0
+    for matrix in matrices:
+        layout.append((matrix.dtype.str, matrix.shape, offset))
+        offset += -(-matrix.nbytes // 8) * 8
+    return layout, offset
+
+
+def shared_matrices(buffer, layout):
+    return [np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset) for dtype, shape, offset in layout]
+
+
+# Runs block_function on one chunk of samples of the matrices in shared
+# memory; the ascending and descending pass share one block
+def shared_block_scores(
+        shm_name, layout, samples, bg, indptr, indices, block_function, p_value_function, rank_method, aggregates,
+        log_p, precision='double'
+):
+    shm = attach_shared_memory(shm_name)
+    matrices = shared_matrices(shm.buf, layout)
+    try:
+        return block_function(
+            *(matrix[:, samples[0]:samples[1]] for matrix in matrices),
+            bg[samples[0]:samples[1]],
+            indptr,
+            indices,
+            p_value_function,
+            rank_method=rank_method,
+            aggregates=aggregates,
+            log_p=log_p,
+            precision=precision
+        )
+    finally:
+        del matrices
+        shm.close()
+
+
+# (pathway block, sample chunk) tasks: samples are split into n_jobs chunks
+# and pathways into blocks within the cell budget of each chunk
+def pathway_sample_tasks(indptr, n_samples, n_jobs, max_cells=BLOCK_CELLS):
+    chunk = max(-(-n_samples // n_jobs), 1)
+    sample_chunks = [(start, min(start + chunk, n_samples)) for start in range(0, n_samples, chunk)]
+    return [
+        (pathways, samples)
+        for pathways in pathway_blocks(indptr, chunk, max_cells=max_cells)
+        for samples in sample_chunks
+    ]
+
+
+# Scores of block_function over every (pathway block, sample chunk) task, as
+# one {aggregate: pathways x samples array} per output of block_function
+def shared_pathway_scores(
+        matrices,
+        bg,
+        membership,
+        block_function,
+        n_outputs,
+        p_value_function,
+        rank_method,
+        aggregates,
+        log_p,
+        n_jobs,
+        executor,
+        max_cells,
+        precision='double'
+):
+    validate_aggregates(aggregates)
+    validate_precision(precision)
+    matrices = [np.ascontiguousarray(matrix) for matrix in matrices]
+    bg = np.asarray(bg, dtype=rank_dtype(rank_method, precision))
+    n_pathways = membership.shape[0]
+    n_samples = matrices[0].shape[1]
+    if n_jobs == 1:
+        # executor given without n_jobs: one sample chunk per core
+        n_jobs = os.cpu_count() or 1
+
+    scores = tuple(
+        {aggregate: np.full((n_pathways, n_samples), np.nan) for aggregate in aggregates}
+        for _ in range(n_outputs)
+    )
+    if not n_pathways or not n_samples:
+        return scores
+
+    layout, size = shared_layout(matrices)
+    shm = SharedMemory(create=True, size=max(size, 1))
+    own_executor = executor is None
+    try:
+        for (dtype, shape, offset), matrix in zip(layout, matrices):
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[:] = matrix
+        if own_executor:
+            executor = process_pool(n_jobs)
+
+        tasks = pathway_sample_tasks(membership.indptr, n_samples, n_jobs, max_cells=max_cells)
+        futures = [
+            executor.submit(
+                shared_block_scores,
+                shm.name,
+                layout,
+                samples,
+                bg,
+                *block_membership(membership.indptr, membership.indices, *pathways),
+                block_function,
+                p_value_function,
+                rank_method,
+                aggregates,
+                log_p,
+                precision
+            )
+            for (pathways, samples) in tasks
+        ]
+        for ((start, stop), (first, last)), future in zip(tasks, futures):
+            blocks = future.result()
+            if n_outputs == 1:
+                blocks = (blocks,)
+            for output_scores, block in zip(scores, blocks):
+                for aggregate, values in block.items():
+                    output_scores[aggregate][start:stop, first:last] = values
+    finally:
+        if own_executor and executor is not None:
+            executor.shutdown()
+        shm.close()
+        shm.unlink()
+    return scores
+
+
+# Same result as batched.pathway_scores, computed on a process pool (or the
+# given executor). The rank matrix is copied once into shared memory and every
+# task scores one pathway block for one chunk of samples, so the result does
+# not depend on scheduling.
+def parallel_pathway_scores(
+        expression_ranks,
+        bg,
+        membership,
+        p_value_function,
+        rank_method='max',
+        aggregates=default_aggregates,
+        log_p=False,
+        n_jobs=1,
+        executor=None,
+        max_cells=BLOCK_CELLS,
+        precision='double'
+):
+    n_jobs = effective_n_jobs(n_jobs)
+    if executor is None and n_jobs == 1:
+        return pathway_scores(
+            expression_ranks, bg, membership, p_value_function, rank_method, aggregates, log_p, max_cells, precision
+        )
+    if isinstance(expression_ranks, SparseRanks):
+        raise ValueError("n_jobs and executor are not supported with sparse expression")
+    return shared_pathway_scores(
+        [np.asarray(expression_ranks, dtype=rank_dtype(rank_method, precision))], bg, membership, block_scores, 1,
+        p_value_function, rank_method, aggregates, log_p, n_jobs, executor, max_cells, precision
+    )[0]
+
+
+# Same result as batched.pathway_scores_both, computed like parallel_pathway_scores
+def parallel_pathway_scores_both(
+        expression_values,
+        ascending_ranks,
+        descending_ranks,
+        bg,
+        membership,
+        p_value_function,
+        rank_method='max',
+        aggregates=default_aggregates,
+        log_p=False,
+        n_jobs=1,
+        executor=None,
+        max_cells=BLOCK_CELLS,
+        precision='double'
+):
+    n_jobs = effective_n_jobs(n_jobs)
+    if executor is None and n_jobs == 1:
+        return pathway_scores_both(
+            expression_values, ascending_ranks, descending_ranks, bg, membership, p_value_function, rank_method,
+            aggregates, log_p, max_cells, precision
+        )
+    return shared_pathway_scores(
+        score_matrices(expression_values, ascending_ranks, descending_ranks, rank_method, precision), bg, membership,
+        block_scores_both, 2, p_value_function, rank_method, aggregates, log_p, n_jobs, executor, max_cells, precision
+    )
@@ -1,29 +1,186 @@
 import csv
+import functools
+import hashlib
 import pathlib
 import pickle
-import os
+import time
 
+from collections import OrderedDict, namedtuple
 from collections.abc import Iterable
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sparse
+import scipy.special as special
 import scipy.stats as stats
 
-
-def processed_expression_table(df):
-    df.index.name = 'genes'
-    return df.groupby('genes').mean()
+from .aggregation import aggregate_scores, default_aggregates, validate_aggregates
+from . import profiling
+from .batched import (
+    SparseRanks,
+    membership_matrix,
+    p_value_dtype,
+    rank_dtype,
+    segment_ranks,
+    segment_ranks_both,
+    sparse_bg_genes,
+    sparse_expression_ranks,
+    unique_membership,
+    validate_precision
+)
+from .dedup import dedup_expression_table
+from .genesets import GeneSets, db_gene_sets, gene_sets_dict, gene_sets_membership
+from .jit import effective_backend, jit_pathway_scores, validate_backend
+from .parallel import parallel_pathway_scores, parallel_pathway_scores_both, validate_n_jobs
+from .screening import pathway_pairs, screened_pathway_scores, top_pairs, validate_screening
+from .sparse_expression import SparseExpression, is_sparse_frame
+
+
+# One row per gene: duplicated gene labels are combined with `dedup` and
+# rows without a label are dropped (see dedup.dedup_methods). With sort=False
+# genes keep the order in which they first appear.
+def processed_expression_table(df, dedup='mean', sort=True):
+    return dedup_expression_table(df, dedup=dedup, sort=sort)
 
 
 def expression_ranks(expression_table_df, ascending, rank_method='max'):
     return expression_table_df.rank(method=rank_method, ascending=ascending)
 
 
+# Ascending and descending rank tables from one sort of the expression table
+def expression_ranks_both(expression_table_df, rank_method='max', precision='double'):
+    ascending_ranks, descending_ranks = segment_ranks_both(
+        expression_table_df.values, np.zeros(len(expression_table_df), dtype=int), rank_method=rank_method,
+        precision=precision
+    )
+    return tuple(
+        pd.DataFrame(ranks, index=expression_table_df.index, columns=expression_table_df.columns)
+        for ranks in (ascending_ranks, descending_ranks)
+    )
+
+
+# Rank table in the dtype of `precision`; with 'single', missing ranks are 0
+def compact_ranks(expression_ranks_df, rank_method, precision='double'):
+    dtype = rank_dtype(rank_method, precision)
+    if precision == 'double':
+        return expression_ranks_df
+    values = expression_ranks_df.values
+    with np.errstate(invalid='ignore'):
+        ranks = values.astype(dtype)
+    ranks[np.isnan(values)] = 0
+    return pd.DataFrame(ranks, index=expression_ranks_df.index, columns=expression_ranks_df.columns)
+
+
 # bg_genes: df of samples with background gene count
 def bg_genes(expression_ranks_df):
     return expression_ranks_df.count()
 
 
+# Deduplicated expression table with its rank matrices (built on first use
+# for each ascending/rank_method/precision) and background gene counts, so that
+# repeated scoring of one cohort only pays for the pathway stage. Accepted
+# in place of expression_table by all, pa_stats, harmonic, geometric and
+# min_p_val. dedup and sort are passed to processed_expression_table; genes
+# is the gene index shared by the table and its rank matrices, so its hash
+# table is built once for every pathway lookup.
+class PreparedExpression:
+
+    def __init__(self, expression_table, dedup='mean', sort=True):
+        with profiling.stage('dedup'):
+            self.expression_table_df = processed_expression_table(expression_table, dedup=dedup, sort=sort)
+            self.bg_genes = bg_genes(self.expression_table_df)
+        self.rank_tables = {}
+
+    @property
+    def genes(self):
+        return self.expression_table_df.index
+
+    @property
+    def samples(self):
+        return self.expression_table_df.columns
+
+    def expression_ranks(self, ascending=True, rank_method='max', precision='double'):
+        key = (bool(ascending), rank_method, precision)
+        if key not in self.rank_tables:
+            with profiling.stage('ranking'):
+                self.rank_tables[key] = compact_ranks(
+                    expression_ranks(self.expression_table_df, ascending=ascending, rank_method=rank_method),
+                    rank_method,
+                    precision
+                )
+        return self.rank_tables[key]
+
+    def expression_ranks_both(self, rank_method='max', precision='double'):
+        keys = [(True, rank_method, precision), (False, rank_method, precision)]
+        if any(key not in self.rank_tables for key in keys):
+            with profiling.stage('ranking'):
+                rank_tables = expression_ranks_both(
+                    self.expression_table_df, rank_method=rank_method, precision=precision
+                )
+            for key, rank_table in zip(keys, rank_tables):
+                self.rank_tables.setdefault(key, rank_table)
+        return tuple(self.rank_tables[key] for key in keys)
+
+
+def expression_fingerprint(expression_table):
+    digest = hashlib.sha1()
+    digest.update(pd.util.hash_pandas_object(expression_table, index=True).values.tobytes())
+    digest.update(repr(list(expression_table.columns)).encode())
+    return digest.hexdigest()
+
+
+# Fingerprint of a PreparedExpression (its table) or a SparseExpression (its
+# matrix, genes and samples)
+def prepared_fingerprint(prepared):
+    if not isinstance(prepared, SparseExpression):
+        return expression_fingerprint(prepared.expression_table_df)
+    digest = hashlib.sha1()
+    matrix = prepared.matrix
+    digest.update(repr(matrix.shape).encode())
+    for array in (matrix.indptr, matrix.indices, matrix.data):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    digest.update(pd.util.hash_pandas_object(prepared.genes, index=False).values.tobytes())
+    digest.update(repr(list(prepared.samples)).encode())
+    return digest.hexdigest()
+
+
+# Content-hash keyed LRU cache of PreparedExpression objects
+class PreparedExpressionCache:
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.prepared = OrderedDict()
+
+    def __len__(self):
+        return len(self.prepared)
+
+    def get(self, expression_table):
+        if isinstance(expression_table, PreparedExpression):
+            return expression_table
+        key = expression_fingerprint(expression_table)
+        if key in self.prepared:
+            self.prepared.move_to_end(key)
+        else:
+            self.prepared[key] = PreparedExpression(expression_table)
+            while len(self.prepared) > self.maxsize:
+                self.prepared.popitem(last=False)
+        return self.prepared[key]
+
+    def clear(self):
+        self.prepared.clear()
+
+
+# A DataFrame of pandas sparse columns is prepared as a SparseExpression
+def prepared_expression(expression_table, cache=None):
+    if isinstance(expression_table, (PreparedExpression, SparseExpression)):
+        return expression_table
+    if is_sparse_frame(expression_table):
+        return SparseExpression.from_frame(expression_table)
+    if cache is not None:
+        return cache.get(expression_table)
+    return PreparedExpression(expression_table)
+
+
 def pathway_ranks(pathway_genes, expression_ranks_df, rank_method):
     return expression_ranks_df.reindex(pathway_genes).rank(method=rank_method).dropna(how='all')
 
@@ -65,13 +222,342 @@ def clean_fisher_exact(table):
         else:
             return stats.fisher_exact(table, alternative='greater')[1]
     except ValueError:
-        print(table)
+        profiling.logger.warning('fisher_exact failed for table %s', table)
 
 
 def p_values(sample_2x2_df):
     return sample_2x2_df.apply(np.vectorize(clean_fisher_exact))
 
 
+# Compact replacement for sample_2x2: tables is a (genes, samples, 4) int32
+# array of [a, b, c, d] counts and missing flags the cells with any NaN count.
+# Counts are truncated to integers as fisher_exact does.
+Contingency = namedtuple('Contingency', ['tables', 'missing', 'genes', 'samples'])
+
+
+def contingency_tables(pathway_ranks_df, b_df, c_df, d_df):
+    genes = pathway_ranks_df.index
+    samples = pathway_ranks_df.columns
+    counts = np.stack([
+        pathway_ranks_df.values,
+        b_df.reindex(index=genes, columns=samples).values,
+        c_df.reindex(index=genes, columns=samples).values,
+        d_df.reindex(index=genes, columns=samples).values
+    ], axis=-1)
+    missing = np.isnan(counts).any(axis=-1)
+    counts[missing] = 0
+    return Contingency(counts.astype(np.int32), missing, genes, samples)
+
+
+# Backwards compatible sample_2x2 dataframe of [[a, b], [c, d]] cells
+def contingency_to_sample_2x2(contingency):
+    counts = contingency.tables.astype(float)
+    counts[contingency.missing] = np.nan
+    return pd.DataFrame({
+        sample: {
+            gene: counts[i, j].reshape(2, 2).tolist()
+            for (i, gene) in enumerate(contingency.genes)
+        }
+        for (j, sample) in enumerate(contingency.samples)
+    })
+
+
+def log_binomial(n, k):
+    return special.gammaln(n + 1) - special.gammaln(k + 1) - special.gammaln(n - k + 1)
+
+
+# Sum of pmf(y) / pmf(x) of a hypergeometric distribution (M total, K
+# successes, n draws) for y from x to stop, stepping away from the mode so
+# that terms only shrink; each sum stops once its terms are below 1e-17 of it
+def hypergeom_tail_sums(x, stop, M, K, n, step):
+    total = np.ones(x.shape)
+    active = np.flatnonzero(x != stop)
+    y = x[active].astype(float)
+    stop = stop[active].astype(float)
+    K = K[active].astype(float)
+    n = n[active].astype(float)
+    rest = M[active] - K - n
+    term = np.ones(active.shape)
+    running = total[active]
+    while active.size:
+        if step > 0:
+            term *= (K - y) * (n - y) / ((y + 1) * (rest + y + 1))
+        else:
+            term *= y * (rest + y) / ((K - y + 1) * (n - y + 1))
+        running += term
+        y += step
+        done = (y == stop) | (term <= 1e-17 * running)
+        # finished sums only stop changing once a term is zero, so drop them
+        # from the arrays when there are enough of them to be worth the copy
+        term[done] = 0
+        y[done] = stop[done]
+        if 4 * done.sum() >= done.size:
+            keep = ~done
+            total[active] = running
+            active, y, stop, K, n, rest, term, running = (
+                v[keep] for v in (active, y, stop, K, n, rest, term, running)
+            )
+    return total
+
+
+# log of the one-sided ('greater') Fisher p-value of [[a, b], [c, d]], the
+# hypergeometric survival function P(X >= a) with M = a + b + c + d,
+# n = a + b and K = a + c. It is summed from log-gamma pmf terms in the
+# shorter tail: upwards from a above the mode, and as 1 - P(X <= a - 1)
+# below it, so p-values far below the float64 range stay finite. Tables with
+# an empty row or column give a p-value of 1.0 like fisher_exact. Agrees with
+# clean_fisher_exact to within a relative tolerance of 1e-9.
+def hypergeom_log_sf(a, b, c, d):
+    a, b, c, d = np.broadcast_arrays(*(np.asarray(x, dtype=np.int64) for x in (a, b, c, d)))
+    M = a + b + c + d
+    K = a + c
+    n = a + b
+    log_sf = np.zeros(a.shape)
+
+    empty_margin = (a + b == 0) | (c + d == 0) | (a + c == 0) | (b + d == 0)
+    lowest = np.maximum(0, a - d)
+    mode = (n + 1) * (K + 1) // (M + 2)
+    upper = ~empty_margin & (a > lowest) & (a > mode)
+    lower = ~empty_margin & (a > lowest) & (a <= mode)
+
+    if upper.any():
+        x, m, k, draws = a[upper], M[upper], K[upper], n[upper]
+        log_pmf = log_binomial(k, x) + log_binomial(m - k, draws - x) - log_binomial(m, draws)
+        highest = np.minimum(draws, k)
+        log_sf[upper] = log_pmf + np.log(hypergeom_tail_sums(x, highest, m, k, draws, 1))
+
+    if lower.any():
+        x, m, k, draws = a[lower] - 1, M[lower], K[lower], n[lower]
+        log_pmf = log_binomial(k, x) + log_binomial(m - k, draws - x) - log_binomial(m, draws)
+        cdf = np.exp(log_pmf) * hypergeom_tail_sums(x, lowest[lower], m, k, draws, -1)
+        log_sf[lower] = np.log1p(-np.minimum(cdf, 1.))
+
+    return log_sf
+
+
+def hypergeom_sf(a, b, c, d):
+    return np.exp(hypergeom_log_sf(a, b, c, d))
+
+
+# Tables are packed into one uint64 key of 16 bits per count, so tables of
+# expression tables with up to 65,535 genes dedupe with a 1-d np.unique
+table_key_bits = 16
+
+
+def table_keys(a, b, c, d):
+    counts = [np.asarray(x).ravel() for x in (a, b, c, d)]
+    if counts[0].size and (
+            min(count.min() for count in counts) < 0 or max(count.max() for count in counts) >= 2 ** table_key_bits
+    ):
+        return None
+    keys = np.zeros(counts[0].size, dtype=np.uint64)
+    for count in counts:
+        keys = (keys << np.uint64(table_key_bits)) | count.astype(np.uint64)
+    return keys
+
+
+def key_tables(keys):
+    mask = np.uint64(2 ** table_key_bits - 1)
+    return [
+        ((keys >> np.uint64(table_key_bits * shift)) & mask).astype(np.int64)
+        for shift in (3, 2, 1, 0)
+    ]
+
+
+PValueCacheInfo = namedtuple('PValueCacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+# Bounded LRU of hypergeometric log p-values keyed on the packed 2x2 table
+# (equivalently on N, K, n and a). Entries are kept as sorted key/value
+# arrays so a batch of tables is looked up with one searchsorted; when full,
+# the least recently used entries are evicted. hits and misses count tables,
+# duplicates within a call included, and misses are the kernel evaluations.
+class PValueCache:
+
+    def __init__(self, maxsize=2 ** 22):
+        self.maxsize = maxsize
+        self.clear()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def clear(self):
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.values = np.empty(0)
+        self.last_used = np.empty(0, dtype=np.int64)
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return PValueCacheInfo(self.hits, self.misses, self.maxsize, len(self))
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
+
+    # log p-values of sorted unique keys; `lookups` is the number of tables
+    # the keys stand for
+    def log_sf(self, keys, lookups):
+        self.tick += 1
+        positions = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+        found = self.keys[positions] == keys if len(self.keys) else np.zeros(keys.shape, dtype=bool)
+        log_sf = np.empty(keys.shape)
+        log_sf[found] = self.values[positions[found]]
+        self.last_used[positions[found]] = self.tick
+
+        new_keys = keys[~found]
+        log_sf[~found] = hypergeom_log_sf(*key_tables(new_keys))
+        self.misses += len(new_keys)
+        self.hits += lookups - len(new_keys)
+        self.insert(new_keys, log_sf[~found])
+        return log_sf
+
+    def insert(self, keys, values):
+        if not len(keys) or self.maxsize <= 0:
+            return
+        all_keys = np.concatenate([self.keys, keys])
+        all_values = np.concatenate([self.values, values])
+        last_used = np.concatenate([self.last_used, np.full(len(keys), self.tick)])
+        if len(all_keys) > self.maxsize:
+            keep = np.argsort(-last_used, kind='stable')[:self.maxsize]
+            all_keys, all_values, last_used = all_keys[keep], all_values[keep], last_used[keep]
+        order = np.argsort(all_keys)
+        self.keys, self.values, self.last_used = all_keys[order], all_values[order], last_used[order]
+
+
+# Integer counts keep their dtype; other counts are truncated to int64
+def integer_counts(x):
+    x = np.asarray(x)
+    return x if x.dtype.kind in 'iu' else x.astype(np.int64)
+
+
+# hypergeom_log_sf evaluated once per distinct table (and looked up in
+# `cache` when given), returned as `dtype`
+def unique_hypergeom_log_sf(a, b, c, d, cache=None, dtype=np.float64):
+    a, b, c, d = np.broadcast_arrays(*(integer_counts(x) for x in (a, b, c, d)))
+    keys = table_keys(a, b, c, d)
+    if keys is None:
+        tables, inverse = np.unique(np.stack([x.ravel() for x in (a, b, c, d)], axis=1), axis=0, return_inverse=True)
+        log_sf = hypergeom_log_sf(*tables.T)
+    else:
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        if cache is None:
+            log_sf = hypergeom_log_sf(*key_tables(unique_keys))
+        else:
+            log_sf = cache.log_sf(unique_keys, keys.size)
+    return log_sf.astype(dtype, copy=False)[inverse.ravel()].reshape(a.shape)
+
+
+# Batched equivalents of clean_fisher_exact over aligned count arrays; any NaN
+# count gives NaN. Integer counts are used as they are. dtype is the dtype of
+# the p-values.
+def hypergeom_log_p_values(a, b, c, d, cache=None, dtype=np.float64):
+    counts = [np.asarray(x) for x in (a, b, c, d)]
+    if not any(count.dtype.kind not in 'iu' for count in counts):
+        return unique_hypergeom_log_sf(*counts, cache=cache, dtype=dtype)
+    a, b, c, d = (count.astype(float, copy=False) for count in counts)
+    missing = np.isnan(a) | np.isnan(b) | np.isnan(c) | np.isnan(d)
+    log_p = unique_hypergeom_log_sf(*(x[~missing] for x in (a, b, c, d)), cache=cache, dtype=dtype)
+    log_p_values = np.full(a.shape, np.nan, dtype=dtype)
+    log_p_values[~missing] = log_p
+    return log_p_values
+
+
+def hypergeom_p_values(a, b, c, d, cache=None, dtype=np.float64):
+    return np.exp(hypergeom_log_p_values(a, b, c, d, cache=cache, dtype=dtype))
+
+
+def contingency_log_p_values(contingency, cache=None):
+    tables = contingency.tables
+    log_p = unique_hypergeom_log_sf(tables[..., 0], tables[..., 1], tables[..., 2], tables[..., 3], cache=cache)
+    log_p[contingency.missing] = np.nan
+    return log_p
+
+
+def contingency_p_values(contingency, cache=None):
+    return np.exp(contingency_log_p_values(contingency, cache=cache))
+
+
+# Reference per-cell p-values over aligned a/b/c/d arrays
+def fisher_p_values(a, b, c, d, dtype=np.float64):
+    return np.vectorize(
+        lambda *table: clean_fisher_exact(np.reshape(table, (2, 2))),
+        otypes=[float]
+    )(a, b, c, d).astype(dtype, copy=False)
+
+
+def fisher_log_p_values(a, b, c, d, dtype=np.float64):
+    with np.errstate(divide='ignore'):
+        return np.log(fisher_p_values(a, b, c, d)).astype(dtype, copy=False)
+
+
+p_value_functions = {
+    'hypergeom': hypergeom_p_values,
+    'fisher': fisher_p_values,
+}
+
+# log_p=True: log p-values computed directly. The 'fisher' reference mode
+# logs fisher_exact p-values and so still underflows.
+log_p_value_functions = {
+    'hypergeom': hypergeom_log_p_values,
+    'fisher': fisher_log_p_values,
+}
+
+
+def validate_p_value_method(p_value_method):
+    if p_value_method not in p_value_functions:
+        raise ValueError(
+            "{} not recognized. Available p-value methods: {}".format(
+                p_value_method, ",".join(p_value_functions)
+            )
+        )
+    return True
+
+
+# p_value_cache: an optional PValueCache shared by the hypergeometric p-values
+# of every call it is passed to
+def validate_p_value_cache(p_value_method, p_value_cache):
+    if p_value_cache is not None and p_value_method != 'hypergeom':
+        raise ValueError("p_value_cache is only supported with p_value_method='hypergeom'")
+    return True
+
+
+def p_value_function(p_value_method, log_p=False, p_value_cache=None, precision='double'):
+    function = (log_p_value_functions if log_p else p_value_functions)[p_value_method]
+    keywords = {}
+    if p_value_cache is not None:
+        keywords['cache'] = p_value_cache
+    if precision != 'double':
+        keywords['dtype'] = p_value_dtype(precision)
+    if keywords:
+        return functools.partial(function, **keywords)
+    return function
+
+
+def pathway_p_values(
+        pathway_ranks_df, b_df, c_df, d_df, p_value_method='hypergeom', log_p=False, p_value_cache=None
+):
+    validate_p_value_method(p_value_method)
+    validate_p_value_cache(p_value_method, p_value_cache)
+
+    with profiling.stage('contingency'):
+        contingency = contingency_tables(pathway_ranks_df, b_df, c_df, d_df)
+    with profiling.stage('p_values'):
+        if p_value_method == 'fisher':
+            p_values_df = p_values(contingency_to_sample_2x2(contingency))
+            if log_p:
+                with np.errstate(divide='ignore'):
+                    return np.log(p_values_df)
+            return p_values_df
+
+        return pd.DataFrame(
+            (contingency_log_p_values if log_p else contingency_p_values)(contingency, cache=p_value_cache),
+            index=contingency.genes,
+            columns=contingency.samples
+        )
+
+
 def neg_log(table):
     return -np.log(table)
 
@@ -132,7 +618,7 @@ def user_pathways(f):
 
 
 def validate_db_name(db_name):
-    available_dbs = ['kegg', 'hallmark', 'reactome', 'hmdb_smpdb']
+    available_dbs = ['kegg', 'hallmark', 'reactome', 'hmdb_smpdb', 'wikipathways']
     if db_name.lower() not in available_dbs:
         raise ValueError(
             "{} not recognized. Available dbs: {}".format(db_name, ",".join(available_dbs))
@@ -142,13 +628,18 @@ def validate_db_name(db_name):
 
 def db_pathways_dict(db_name):
     validate_db_name(db_name)
-    db_parent = os.path.dirname(os.path.abspath(__file__))
-    with open('{}/databases/{}.pkl'.format(db_parent, db_name.lower()), 'rb') as f:
-        pathways = pickle.load(f)
-    return pathways
+    return gene_sets_dict(db_gene_sets(db_name))
+
+
+# Compiled (memory-mapped) gene sets of an included database
+def db_pathways(db_name):
+    validate_db_name(db_name)
+    return db_gene_sets(db_name)
 
 
 def validate_pathways(pw_dict):
+    if isinstance(pw_dict, GeneSets):
+        return True
     if not isinstance(pw_dict, dict):
         raise TypeError("Pathways should be a dictionary of lists or sets")
     if any(not isinstance(gene_list, Iterable) for gene_list in pw_dict.values()):
@@ -157,137 +648,779 @@ def validate_pathways(pw_dict):
     return True
 
 
-def all(
-        expression_table,
-        pathways=None,
-        db='kegg',
-        geometric=True,
-        min_p_val=True,
-        ascending=True,
-        rank_method='max'
+# direction: ascending ranks score suppression, descending ranks activation
+directions = {'suppression': True, 'activation': False}
+
+
+def validate_direction(direction):
+    if direction is not None and direction != 'both' and direction not in directions:
+        raise ValueError(
+            "{} not recognized. Available directions: {},both".format(direction, ",".join(directions))
+        )
+    return True
+
+
+# n_jobs and executor spread the batched pass over a process pool
+# A p_value_cache would be pickled into every task and filled in the workers,
+# so the parent cache would neither be reused nor updated
+def validate_parallel_options(batched, n_jobs, executor, p_value_cache=None):
+    validate_n_jobs(n_jobs)
+    if not batched and (n_jobs != 1 or executor is not None):
+        raise ValueError("n_jobs and executor are only supported with batched=True")
+    if p_value_cache is not None and (n_jobs != 1 or executor is not None):
+        raise ValueError("n_jobs and executor are not supported with a p_value_cache")
+    return True
+
+
+# precision='single' stores ranks and counts as int32 and gene p-values as
+# float32 in the batched pass (see batched.precisions)
+def validate_precision_options(batched, precision):
+    validate_precision(precision)
+    if not batched and precision != 'double':
+        raise ValueError("precision='{}' is only supported with batched=True".format(precision))
+    return True
+
+
+# backend='numba' scores the batched pass with one compiled kernel (see
+# jit.backends); it parallelizes over samples with threads of its own
+def validate_backend_options(batched, backend, p_value_method, p_value_cache, n_jobs, executor, expression_table=None):
+    validate_backend(backend)
+    if backend == 'numba':
+        if (
+            isinstance(expression_table, SparseExpression) or is_sparse_frame(expression_table)
+            or sparse.issparse(expression_table)
+        ):
+            raise ValueError("backend='numba' is not supported with sparse expression")
+        if not batched:
+            raise ValueError("backend='numba' is only supported with batched=True")
+        if p_value_method != 'hypergeom' or p_value_cache is not None:
+            raise ValueError("backend='numba' only supports p_value_method='hypergeom' without a p_value_cache")
+        if n_jobs != 1 or executor is not None:
+            raise ValueError("n_jobs and executor are not supported with backend='numba'")
+    return True
+
+
+# top_k and min_score screen pairs with bounds on the hypergeometric scores of
+# the batched pass (see screening.py)
+def validate_screening_options(mode, top_k, min_score, batched, p_value_method, n_jobs, executor, backend):
+    validate_screening(mode, top_k, min_score)
+    if not batched or p_value_method != 'hypergeom':
+        raise ValueError("top_k and min_score are only supported with batched=True and p_value_method='hypergeom'")
+    if n_jobs != 1 or executor is not None or backend != 'numpy':
+        raise ValueError("n_jobs, executor and backend='numba' are not supported with top_k or min_score")
+    return True
+
+
+# pathways: a dict of gene collections or compiled GeneSets
+def pathway_membership(pathways, genes):
+    with profiling.stage('membership'):
+        if isinstance(pathways, GeneSets):
+            membership = gene_sets_membership(pathways, genes)
+        else:
+            membership = membership_matrix(pathways, genes)
+    if profiling.active_profiler() is not None:
+        for name, size, present in zip(pathway_names(pathways), pathway_sizes(pathways), np.diff(membership.indptr)):
+            profiling.record_pathway(name, genes=int(size), present_genes=int(present))
+    return membership
+
+
+def pathway_names(pathways):
+    if isinstance(pathways, GeneSets):
+        return pd.Index(pathways.names.tolist())
+    return pd.Index(list(pathways))
+
+
+def pathway_sizes(pathways):
+    if isinstance(pathways, GeneSets):
+        return np.diff(pathways.offsets)
+    return [len(set(genes)) for genes in pathways.values()]
+
+
+# Array API of the batched pass. Expression values are a genes x samples
+# float matrix with one row per gene (NaN for missing values), pathways are
+# arrays of row positions (or a pathways x genes CSR membership matrix) and
+# scores are {aggregate: pathways x samples array} in pathway order. Nothing
+# is aligned by label; all, pa_stats, harmonic, geometric and min_p_val run
+# through it and attach gene, pathway and sample labels at the end.
+
+
+# membership: pathways x genes CSR matrix of integer row positions; positions
+# repeated within a pathway are counted once
+def index_membership(pathway_indices, n_genes):
+    if sparse.issparse(pathway_indices):
+        if pathway_indices.shape[1] != n_genes:
+            raise ValueError(
+                "membership has {} genes, expected {}".format(pathway_indices.shape[1], n_genes)
+            )
+        return sparse.csr_matrix(pathway_indices)
+    pathway_indices = [np.asarray(indices).ravel() for indices in pathway_indices]
+    if any(indices.size and indices.dtype.kind not in 'iu' for indices in pathway_indices):
+        raise TypeError("Pathway indices should be arrays of integer row positions")
+    sizes = [indices.size for indices in pathway_indices]
+    cols = np.concatenate(pathway_indices).astype(np.intp) if pathway_indices else np.empty(0, dtype=np.intp)
+    if cols.size and (cols.min() < 0 or cols.max() >= n_genes):
+        raise ValueError("Pathway indices should be row positions between 0 and {}".format(n_genes - 1))
+
+    membership = sparse.csr_matrix(
+        (np.ones(cols.size, dtype=np.int8), (np.repeat(np.arange(len(sizes)), sizes), cols)),
+        shape=(len(sizes), n_genes)
+    )
+    membership.sum_duplicates()
+    membership.data[:] = 1
+    return membership
+
+
+# Ranks of every sample (column) of an expression matrix, as
+# DataFrame.rank; missing values get NaN ranks, or 0 with precision='single'
+def array_expression_ranks(values, ascending=True, rank_method='max', precision='double'):
+    return segment_ranks(
+        values, np.zeros(len(values), dtype=int), rank_method=rank_method, ascending=ascending, precision=precision
+    )
+
+
+def array_bg_genes(values):
+    return (~np.isnan(values)).sum(axis=0)
+
+
+# Membership of the distinct sets of present genes of the pathways and the
+# distinct set of every pathway, so that aliases (within one database, across
+# combined databases or after dropping the genes missing from the expression
+# table) are scored once. The work saved is logged and counted.
+def unique_pathway_membership(membership, n_samples):
+    unique, inverse = unique_membership(membership)
+    profiling.count('pathways', membership.shape[0])
+    profiling.count('unique_pathways', unique.shape[0])
+    profiling.count('pathway_cells', membership.nnz * n_samples)
+    profiling.count('unique_pathway_cells', unique.nnz * n_samples)
+    if unique.shape[0] < membership.shape[0]:
+        profiling.logger.info(
+            '%d pathways have %d distinct gene sets; scoring each once saves %d of %d gene x sample cells',
+            membership.shape[0], unique.shape[0], (membership.nnz - unique.nnz) * n_samples,
+            membership.nnz * n_samples
+        )
+    return unique, inverse
+
+
+# Scores of the distinct rows of membership fanned out to every pathway
+def pathway_rows(scores, unique, inverse):
+    if unique.shape[0] == len(inverse):
+        return scores
+    return {aggregate: values[inverse] for (aggregate, values) in scores.items()}
+
+
+# Scores of a rank matrix (from array_expression_ranks) with the background
+# gene count of every sample
+def rank_scores(
+        expression_ranks,
+        bg,
+        membership,
+        rank_method='max',
+        p_value_method='hypergeom',
+        aggregates=default_aggregates,
+        log_p=False,
+        n_jobs=1,
+        executor=None,
+        p_value_cache=None,
+        precision='double',
+        backend='numpy'
+):
+    unique, inverse = unique_pathway_membership(membership, expression_ranks.shape[1])
+    if effective_backend(backend) == 'numba':
+        scores = jit_pathway_scores(expression_ranks, bg, unique, rank_method, aggregates, log_p)
+    else:
+        scores = parallel_pathway_scores(
+            expression_ranks,
+            bg,
+            unique,
+            p_value_function(p_value_method, log_p, p_value_cache, precision),
+            rank_method=rank_method,
+            aggregates=aggregates,
+            log_p=log_p,
+            n_jobs=n_jobs,
+            executor=executor,
+            precision=precision
+        )
+    return pathway_rows(scores, unique, inverse)
+
+
+# rank_scores for both directions from one sort of every pathway block:
+# {'suppression': scores of the ascending ranks, 'activation': scores of the
+# descending ranks}. The numba kernel scores each direction in its own pass.
+def rank_scores_both(
+        expression_values,
+        ascending_ranks,
+        descending_ranks,
+        bg,
+        membership,
+        rank_method='max',
+        p_value_method='hypergeom',
+        aggregates=default_aggregates,
+        log_p=False,
+        n_jobs=1,
+        executor=None,
+        p_value_cache=None,
+        precision='double',
+        backend='numpy'
+):
+    if effective_backend(backend) == 'numba':
+        return {
+            direction: rank_scores(
+                expression_ranks, bg, membership, rank_method, p_value_method, aggregates, log_p, n_jobs, executor,
+                p_value_cache, precision, backend
+            )
+            for direction, expression_ranks in zip(('suppression', 'activation'), (ascending_ranks, descending_ranks))
+        }
+    unique, inverse = unique_pathway_membership(membership, expression_values.shape[1])
+    scores = parallel_pathway_scores_both(
+        expression_values,
+        ascending_ranks,
+        descending_ranks,
+        bg,
+        unique,
+        p_value_function(p_value_method, log_p, p_value_cache, precision),
+        rank_method=rank_method,
+        aggregates=aggregates,
+        log_p=log_p,
+        n_jobs=n_jobs,
+        executor=executor,
+        precision=precision
+    )
+    return {
+        direction: pathway_rows(direction_scores, unique, inverse)
+        for direction, direction_scores in zip(('suppression', 'activation'), scores)
+    }
+
+
+# rank_scores of sparse expression for one direction, or both; expression_ranks
+# maps ascending to the SparseRanks of that direction
+def sparse_rank_scores(
+        expression_ranks,
+        bg,
+        membership,
+        direction,
+        ascending,
+        rank_method='max',
+        p_value_method='hypergeom',
+        aggregates=default_aggregates,
+        log_p=False,
+        n_jobs=1,
+        executor=None,
+        p_value_cache=None,
+        precision='double',
+        backend='numpy'
 ):
+    if direction == 'both':
+        return {
+            name: sparse_rank_scores(
+                expression_ranks, bg, membership, name, ascending, rank_method, p_value_method, aggregates, log_p,
+                n_jobs, executor, p_value_cache, precision, backend
+            )
+            for name in directions
+        }
+    if direction is not None:
+        ascending = directions[direction]
+    return rank_scores(
+        expression_ranks(ascending), bg, membership, rank_method, p_value_method, aggregates, log_p, n_jobs,
+        executor, p_value_cache, precision, backend
+    )
 
-    if not pathways:
-        pathways = db_pathways_dict(db)
+
+def validate_expression_values(values):
+    if values.ndim != 2:
+        raise ValueError("Expression values should be a genes x samples matrix, got {} dimensions".format(values.ndim))
+    return True
+
+
+# Scores of a genes x samples float matrix against pathways given as arrays
+# of row positions: {aggregate: pathways x samples array}, or
+# {'suppression': scores, 'activation': scores} when direction is 'both'.
+# A scipy.sparse matrix is ranked without densifying (see
+# batched.SparseRanks).
+def array_scores(
+        values,
+        pathway_indices,
+        aggregates=default_aggregates,
+        ascending=True,
+        rank_method='max',
+        p_value_method='hypergeom',
+        n_jobs=1,
+        executor=None,
+        log_p=False,
+        direction=None,
+        p_value_cache=None,
+        precision='double',
+        backend='numpy'
+):
+    if sparse.issparse(values):
+        values = sparse.csc_matrix(values, dtype=np.float64)
     else:
-        validate_pathways(pathways)
+        values = np.asarray(values, dtype=np.float64)
+        validate_expression_values(values)
+    validate_p_value_method(p_value_method)
+    validate_p_value_cache(p_value_method, p_value_cache)
+    validate_n_jobs(n_jobs)
+    validate_precision(precision)
+    validate_backend_options(True, backend, p_value_method, p_value_cache, n_jobs, executor, values)
+    validate_aggregates(aggregates)
+    validate_direction(direction)
+
+    with profiling.stage('membership'):
+        membership = index_membership(pathway_indices, values.shape[0])
+    if sparse.issparse(values):
+        def expression_ranks(ranks_ascending):
+            with profiling.stage('ranking'):
+                return sparse_expression_ranks(
+                    values, ascending=ranks_ascending, rank_method=rank_method, precision=precision
+                )
+        return sparse_rank_scores(
+            expression_ranks, sparse_bg_genes(values), membership, direction, ascending, rank_method, p_value_method,
+            aggregates, log_p, n_jobs, executor, p_value_cache, precision, backend
+        )
+    bg = array_bg_genes(values)
+    if direction == 'both':
+        with profiling.stage('ranking'):
+            ascending_ranks, descending_ranks = segment_ranks_both(
+                values, np.zeros(len(values), dtype=int), rank_method=rank_method, precision=precision
+            )
+        return rank_scores_both(
+            values, ascending_ranks, descending_ranks, bg, membership, rank_method, p_value_method, aggregates,
+            log_p, n_jobs, executor, p_value_cache, precision, backend
+        )
 
-    harmonic_averages = [None] * len(pathways)
-    geometric_averages = []
-    min_p_vals = []
+    if direction is not None:
+        ascending = directions[direction]
+    with profiling.stage('ranking'):
+        ranks = array_expression_ranks(values, ascending=ascending, rank_method=rank_method, precision=precision)
+    return rank_scores(
+        ranks, bg, membership, rank_method, p_value_method, aggregates, log_p, n_jobs, executor, p_value_cache,
+        precision, backend
+    )
 
-    if geometric:
-        geometric_averages = [None] * len(pathways)
-    if min_p_val:
-        min_p_vals = [None] * len(pathways)
 
-    expression_table_df = processed_expression_table(expression_table)
-    expression_ranks_df = expression_ranks(expression_table_df, ascending=ascending, rank_method=rank_method)
-    bg_genes_df = bg_genes(expression_ranks_df)
+def labelled_scores(scores, pathways, samples):
+    names = pathway_names(pathways)
+    return {
+        aggregate: pd.DataFrame(values, index=names, columns=samples)
+        for (aggregate, values) in scores.items()
+    }
 
-    sample_order = expression_table_df.columns
+
+def batched_scores(
+        expression_ranks_df,
+        bg_genes_df,
+        pathways,
+        rank_method,
+        p_value_method,
+        aggregates=default_aggregates,
+        log_p=False,
+        n_jobs=1,
+        executor=None,
+        p_value_cache=None,
+        precision='double',
+        backend='numpy'
+):
+    scores = rank_scores(
+        expression_ranks_df.values,
+        bg_genes_df.loc[expression_ranks_df.columns].values,
+        pathway_membership(pathways, expression_ranks_df.index),
+        rank_method,
+        p_value_method,
+        aggregates,
+        log_p,
+        n_jobs,
+        executor,
+        p_value_cache,
+        precision,
+        backend
+    )
+    return labelled_scores(scores, pathways, expression_ranks_df.columns)
+
+
+# batched_scores for both directions (see rank_scores_both)
+def batched_scores_both(
+        expression_table_df,
+        ascending_ranks_df,
+        descending_ranks_df,
+        bg_genes_df,
+        pathways,
+        rank_method,
+        p_value_method,
+        aggregates=default_aggregates,
+        log_p=False,
+        n_jobs=1,
+        executor=None,
+        p_value_cache=None,
+        precision='double',
+        backend='numpy'
+):
+    scores = rank_scores_both(
+        expression_table_df.values,
+        ascending_ranks_df.values,
+        descending_ranks_df.values,
+        bg_genes_df.loc[expression_table_df.columns].values,
+        pathway_membership(pathways, expression_table_df.index),
+        rank_method,
+        p_value_method,
+        aggregates,
+        log_p,
+        n_jobs,
+        executor,
+        p_value_cache,
+        precision,
+        backend
+    )
+    return {
+        direction: labelled_scores(direction_scores, pathways, expression_table_df.columns)
+        for direction, direction_scores in scores.items()
+    }
+
+
+# One pathway at a time; every aggregate comes from a single reduction of
+# the pathway's p-values
+def pathway_loop_scores(
+        expression_ranks_df,
+        bg_genes_df,
+        pathways,
+        rank_method,
+        p_value_method,
+        aggregates=default_aggregates,
+        log_p=False,
+        verbose=False,
+        p_value_cache=None
+):
+    sample_order = expression_ranks_df.columns
+    scores = {aggregate: [None] * len(pathways) for aggregate in aggregates}
 
     # perform analysis for each pathway
     for i, pathway in enumerate(pathways):
-        print('starting: {}'.format(pathway))
-        pathway_ranks_df = pathway_ranks(pathways[pathway], expression_ranks_df, rank_method=rank_method)
-        effective_pathway_df = effective_pathway(pathway_ranks_df)
-        b_df = b(expression_ranks_df, pathway_ranks_df)
-        c_df = c(effective_pathway_df, pathway_ranks_df)
-        d_df = d(bg_genes_df, pathway_ranks_df, b_df, c_df)
-
-        sample_2x2_df = sample_2x2(
-            pathway_ranks_df.to_dict(),
-            b_df.to_dict(),
-            c_df.to_dict(),
-            d_df.to_dict()
+        if verbose:
+            profiling.logger.info('starting: %s', pathway)
+        start = time.perf_counter()
+        with profiling.stage('pathway_ranks'):
+            pathway_ranks_df = pathway_ranks(pathways[pathway], expression_ranks_df, rank_method=rank_method)
+        with profiling.stage('contingency'):
+            effective_pathway_df = effective_pathway(pathway_ranks_df)
+            b_df = b(expression_ranks_df, pathway_ranks_df)
+            c_df = c(effective_pathway_df, pathway_ranks_df)
+            d_df = d(bg_genes_df, pathway_ranks_df, b_df, c_df)
+
+        p_values_df = pathway_p_values(
+            pathway_ranks_df, b_df, c_df, d_df, p_value_method=p_value_method, log_p=log_p, p_value_cache=p_value_cache
+        )
+        with profiling.stage('aggregation'):
+            if log_p:
+                log_p_values = p_values_df.values
+            else:
+                with np.errstate(divide='ignore'):
+                    log_p_values = np.log(p_values_df.values)
+
+            for aggregate, values in aggregate_scores(log_p_values, aggregates=aggregates).items():
+                scores[aggregate][i] = pd.Series(values, index=p_values_df.columns, name=pathway).loc[sample_order]
+        profiling.record_pathway(
+            pathway,
+            genes=len(set(pathways[pathway])),
+            present_genes=len(pathway_ranks_df),
+            seconds=time.perf_counter() - start
         )
-        p_values_df = p_values(sample_2x2_df)
+        if verbose:
+            profiling.logger.info('finished: %s', pathway)
 
-        # Harmonic averaging is default
-        harmonic_averages_series = neg_log(p_values_df.apply(harmonic_average).loc[sample_order])
-        harmonic_averages_series.name = pathway
-        harmonic_averages[i] = harmonic_averages_series
+    return {
+        aggregate: pd.concat(series, axis=1).T
+        for (aggregate, series) in scores.items()
+    }
 
-        if geometric:
-            geometric_averages_series = neg_log(p_values_df.apply(geometric_average).loc[sample_order])
-            geometric_averages_series.name = pathway
-            geometric_averages[i] = geometric_averages_series
-        if min_p_val:
-            min_p_vals_series = neg_log(p_values_df.min().loc[sample_order])
-            min_p_vals_series.name = pathway
-            min_p_vals[i] = min_p_vals_series
-        print('finished: {}'.format(pathway))
 
-    harmonic_averages_df = pd.concat(harmonic_averages, axis=1).T
+# Scores of every aggregate for one direction, or {'suppression': scores,
+# 'activation': scores} when direction is 'both'. Without direction the
+# expression table is ranked as `ascending` says. prepared is a
+# PreparedExpression or a SparseExpression.
+def expression_scores(
+        prepared,
+        pathways,
+        direction,
+        ascending,
+        rank_method,
+        p_value_method,
+        aggregates,
+        batched,
+        n_jobs,
+        executor,
+        log_p,
+        verbose=False,
+        p_value_cache=None,
+        precision='double',
+        backend='numpy'
+):
+    if isinstance(prepared, SparseExpression):
+        if not batched:
+            raise ValueError("Sparse expression is only supported with batched=True")
+        scores = sparse_rank_scores(
+            functools.partial(prepared.expression_ranks, rank_method=rank_method, precision=precision),
+            prepared.bg_genes.values,
+            pathway_membership(pathways, prepared.genes),
+            direction,
+            ascending,
+            rank_method,
+            p_value_method,
+            aggregates,
+            log_p,
+            n_jobs,
+            executor,
+            p_value_cache,
+            precision,
+            backend
+        )
+        if direction == 'both':
+            return {
+                name: labelled_scores(direction_scores, pathways, prepared.samples)
+                for name, direction_scores in scores.items()
+            }
+        return labelled_scores(scores, pathways, prepared.samples)
+
+    bg_genes_df = prepared.bg_genes
+    if not batched and isinstance(pathways, GeneSets):
+        pathways = gene_sets_dict(pathways)
+    if direction == 'both':
+        ascending_ranks_df, descending_ranks_df = prepared.expression_ranks_both(
+            rank_method=rank_method, precision=precision
+        )
+        if batched:
+            return batched_scores_both(
+                prepared.expression_table_df,
+                ascending_ranks_df,
+                descending_ranks_df,
+                bg_genes_df,
+                pathways,
+                rank_method,
+                p_value_method,
+                aggregates,
+                log_p,
+                n_jobs,
+                executor,
+                p_value_cache,
+                precision,
+                backend
+            )
+        return {
+            'suppression': pathway_loop_scores(
+                ascending_ranks_df, bg_genes_df, pathways, rank_method, p_value_method, aggregates, log_p, verbose,
+                p_value_cache
+            ),
+            'activation': pathway_loop_scores(
+                descending_ranks_df, bg_genes_df, pathways, rank_method, p_value_method, aggregates, log_p, verbose,
+                p_value_cache
+            )
+        }
 
+    if direction is not None:
+        ascending = directions[direction]
+    expression_ranks_df = prepared.expression_ranks(ascending=ascending, rank_method=rank_method, precision=precision)
+    if batched:
+        return batched_scores(
+            expression_ranks_df,
+            bg_genes_df,
+            pathways,
+            rank_method,
+            p_value_method,
+            aggregates,
+            log_p,
+            n_jobs,
+            executor,
+            p_value_cache,
+            precision,
+            backend
+        )
+    return pathway_loop_scores(
+        expression_ranks_df, bg_genes_df, pathways, rank_method, p_value_method, aggregates, log_p, verbose,
+        p_value_cache
+    )
+
+
+# Long-format scores of the pathway/sample pairs that make the top_k of their
+# sample and/or reach min_score: a DataFrame of sample, pathway and score
+# ordered by sample and then by score, largest first, or {'suppression':
+# scores, 'activation': scores} when direction is 'both'
+def screened_scores(
+        prepared,
+        pathways,
+        direction,
+        ascending,
+        rank_method,
+        mode,
+        top_k=None,
+        min_score=None,
+        log_p=False,
+        p_value_cache=None,
+        precision='double'
+):
+    if direction == 'both':
+        return {
+            name: screened_scores(
+                prepared, pathways, name, ascending, rank_method, mode, top_k, min_score, log_p, p_value_cache,
+                precision
+            )
+            for name in directions
+        }
+    if direction is not None:
+        ascending = directions[direction]
+    ranks = prepared.expression_ranks(ascending=ascending, rank_method=rank_method, precision=precision)
+    if not isinstance(ranks, SparseRanks):
+        ranks = ranks.values
+    samples = prepared.samples
+    unique, inverse = unique_pathway_membership(pathway_membership(pathways, prepared.genes), len(samples))
+    rows, columns, scores = screened_pathway_scores(
+        ranks,
+        prepared.bg_genes.loc[samples].values,
+        unique,
+        p_value_function('hypergeom', log_p, p_value_cache, precision),
+        mode=mode,
+        top_k=top_k,
+        min_score=min_score,
+        rank_method=rank_method,
+        log_p=log_p,
+        precision=precision
+    )
+    rows, columns, scores = top_pairs(*pathway_pairs(rows, columns, scores, inverse), top_k, min_score)
+    return pd.DataFrame({
+        'sample': samples[columns],
+        'pathway': pathway_names(pathways)[rows],
+        'score': scores,
+    })
+
+
+def all_aggregates(geometric=True, min_p_val=True, extra_aggregates=()):
+    # Harmonic averaging is default
+    aggregates = ['harmonic']
     if geometric:
-        geometric_averages_df = pd.concat(geometric_averages, axis=1).T
-    else:
-        geometric_averages_df = None
-
+        aggregates.append('geometric')
     if min_p_val:
-        min_p_vals_df = pd.concat(min_p_vals, axis=1).T
-    else:
-        min_p_vals_df = None
+        aggregates.append('min')
+    aggregates += [aggregate for aggregate in extra_aggregates if aggregate not in aggregates]
+    return aggregates
 
-    return {
-               'harmonic': harmonic_averages_df,
-               'geometric': geometric_averages_df,
-                'min_p_val': min_p_vals_df
+
+def all_results(scores, extra_aggregates=()):
+    results = {
+        'harmonic': scores['harmonic'],
+        'geometric': scores.get('geometric'),
+        'min_p_val': scores.get('min')
     }
+    for aggregate in extra_aggregates:
+        results[aggregate] = scores[aggregate]
+    return results
 
 
-def pa_stats(
+def all(
         expression_table,
-        mode='harmonic',
         pathways=None,
         db='kegg',
+        geometric=True,
+        min_p_val=True,
         ascending=True,
-        rank_method='max'
+        rank_method='max',
+        p_value_method='hypergeom',
+        batched=True,
+        n_jobs=1,
+        executor=None,
+        extra_aggregates=(),
+        log_p=False,
+        cache=None,
+        direction=None,
+        p_value_cache=None,
+        precision='double',
+        backend='numpy'
 ):
+
     if not pathways:
-        pathways = db_pathways_dict(db)
+        pathways = db_pathways(db)
     else:
         validate_pathways(pathways)
+    validate_p_value_method(p_value_method)
+    validate_p_value_cache(p_value_method, p_value_cache)
+    validate_parallel_options(batched, n_jobs, executor, p_value_cache)
+    validate_precision_options(batched, precision)
+    validate_backend_options(batched, backend, p_value_method, p_value_cache, n_jobs, executor, expression_table)
+    validate_aggregates(extra_aggregates)
+    validate_direction(direction)
+
+    aggregates = all_aggregates(geometric, min_p_val, extra_aggregates)
+
+    prepared = prepared_expression(expression_table, cache=cache)
+    scores = expression_scores(
+        prepared,
+        pathways,
+        direction,
+        ascending,
+        rank_method,
+        p_value_method,
+        aggregates,
+        batched,
+        n_jobs,
+        executor,
+        log_p,
+        verbose=True,
+        p_value_cache=p_value_cache,
+        precision=precision,
+        backend=backend
+    )
+
+    if direction == 'both':
+        return {
+            direction: all_results(direction_scores, extra_aggregates)
+            for direction, direction_scores in scores.items()
+        }
+    return all_results(scores, extra_aggregates)
 
-    averages = [None] * len(pathways)
-
-    expression_table_df = processed_expression_table(expression_table)
-    expression_ranks_df = expression_ranks(expression_table_df, ascending=ascending, rank_method=rank_method)
-    bg_genes_df = bg_genes(expression_ranks_df)
-
-    sample_order = expression_table_df.columns
 
-    # perform analysis for each pathway
-    for i, pathway in enumerate(pathways):
-        pathway_ranks_df = pathway_ranks(pathways[pathway], expression_ranks_df, rank_method=rank_method)
-        effective_pathway_df = effective_pathway(pathway_ranks_df)
-        b_df = b(expression_ranks_df, pathway_ranks_df)
-        c_df = c(effective_pathway_df, pathway_ranks_df)
-        d_df = d(bg_genes_df, pathway_ranks_df, b_df, c_df)
-
-        sample_2x2_df = sample_2x2(
-            pathway_ranks_df.to_dict(),
-            b_df.to_dict(),
-            c_df.to_dict(),
-            d_df.to_dict()
+def pa_stats(
+        expression_table,
+        mode='harmonic',
+        pathways=None,
+        db='kegg',
+        ascending=True,
+        rank_method='max',
+        p_value_method='hypergeom',
+        batched=True,
+        n_jobs=1,
+        executor=None,
+        log_p=False,
+        cache=None,
+        direction=None,
+        p_value_cache=None,
+        precision='double',
+        backend='numpy',
+        top_k=None,
+        min_score=None
+):
+    if not pathways:
+        pathways = db_pathways(db)
+    else:
+        validate_pathways(pathways)
+    validate_p_value_method(p_value_method)
+    validate_p_value_cache(p_value_method, p_value_cache)
+    validate_parallel_options(batched, n_jobs, executor, p_value_cache)
+    validate_precision_options(batched, precision)
+    validate_backend_options(batched, backend, p_value_method, p_value_cache, n_jobs, executor, expression_table)
+    validate_aggregates([mode])
+    validate_direction(direction)
+    screening = top_k is not None or min_score is not None
+    if screening:
+        validate_screening_options(mode, top_k, min_score, batched, p_value_method, n_jobs, executor, backend)
+
+    prepared = prepared_expression(expression_table, cache=cache)
+    if screening:
+        return screened_scores(
+            prepared, pathways, direction, ascending, rank_method, mode, top_k, min_score, log_p, p_value_cache,
+            precision
         )
-        p_values_df = p_values(sample_2x2_df)
-
-        if mode == 'geometric':
-            averages_series = neg_log(p_values_df.apply(geometric_average).loc[sample_order])
-        if mode == 'harmonic':
-            averages_series = neg_log(p_values_df.apply(harmonic_average).loc[sample_order])
-        if mode == 'min':
-            averages_series = neg_log(p_values_df.min().loc[sample_order])
-
-        averages_series.name = pathway
-        averages[i] = averages_series
-
-    averages_df = pd.concat(averages, axis=1).T
-
-    return averages_df
+    scores = expression_scores(
+        prepared, pathways, direction, ascending, rank_method, p_value_method, [mode], batched, n_jobs, executor, log_p,
+        p_value_cache=p_value_cache, precision=precision, backend=backend
+    )
+    if direction == 'both':
+        return {direction: direction_scores[mode] for direction, direction_scores in scores.items()}
+    return scores[mode]
 
 
 # Try doing this with a decorator
@@ -296,9 +1429,24 @@ def harmonic(
         pathways=None,
         db='kegg',
         ascending=True,
-        rank_method='max'
+        rank_method='max',
+        p_value_method='hypergeom',
+        batched=True,
+        n_jobs=1,
+        executor=None,
+        log_p=False,
+        cache=None,
+        direction=None,
+        p_value_cache=None,
+        precision='double',
+        backend='numpy',
+        top_k=None,
+        min_score=None
 ):
-    return pa_stats(expression_table, 'harmonic', pathways, db, ascending, rank_method)
+    return pa_stats(
+        expression_table, 'harmonic', pathways, db, ascending, rank_method, p_value_method, batched, n_jobs, executor,
+        log_p, cache, direction, p_value_cache, precision, backend, top_k, min_score
+    )
 
 
 def geometric(
@@ -306,9 +1454,24 @@ def geometric(
         pathways=None,
         db='kegg',
         ascending=True,
-        rank_method='max'
+        rank_method='max',
+        p_value_method='hypergeom',
+        batched=True,
+        n_jobs=1,
+        executor=None,
+        log_p=False,
+        cache=None,
+        direction=None,
+        p_value_cache=None,
+        precision='double',
+        backend='numpy',
+        top_k=None,
+        min_score=None
 ):
-    return pa_stats(expression_table, 'geometric', pathways, db, ascending, rank_method)
+    return pa_stats(
+        expression_table, 'geometric', pathways, db, ascending, rank_method, p_value_method, batched, n_jobs, executor,
+        log_p, cache, direction, p_value_cache, precision, backend, top_k, min_score
+    )
 
 
 def min_p_val(
@@ -316,6 +1479,21 @@ def min_p_val(
         pathways=None,
         db='kegg',
         ascending=True,
-        rank_method='max'
+        rank_method='max',
+        p_value_method='hypergeom',
+        batched=True,
+        n_jobs=1,
+        executor=None,
+        log_p=False,
+        cache=None,
+        direction=None,
+        p_value_cache=None,
+        precision='double',
+        backend='numpy',
+        top_k=None,
+        min_score=None
 ):
-    return pa_stats(expression_table, 'min', pathways, db, ascending, rank_method)
+    return pa_stats(
+        expression_table, 'min', pathways, db, ascending, rank_method, p_value_method, batched, n_jobs, executor,
+        log_p, cache, direction, p_value_cache, precision, backend, top_k, min_score
+    )
@@ -0,0 +1,328 @@
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+
+from . import pathway_assessor
+from . import profiling
+from .batched import BLOCK_CELLS, SparseRanks, membership_matrix
+from .genesets import gene_sets_membership
+from .jit import effective_backend, jit_pathway_scores
+from .parallel import parallel_pathway_scores
+from .sparse_expression import SparseExpression
+from .pathway_assessor import (
+    GeneSets,
+    all_aggregates,
+    db_pathways,
+    directions,
+    p_value_function,
+    prepared_expression,
+    validate_backend_options,
+    validate_pathways
+)
+
+# Empirical significance of pathway scores. For every pathway size (genes
+# present in the expression table) n_permutations random gene sets of that
+# size are scored like the pathways, through the batched pass and on the same
+# rank matrix; a pathway's score is then compared with the null scores of its
+# size in each sample:
+#   empirical p  (1 + null scores >= score) / (1 + null scores)
+#   z            (score - mean of null scores) / standard deviation
+# Permutation p is a shuffle of the genes drawn from its own stream of
+# random_state, and the null set of size k is its first k genes, so a null
+# set only depends on random_state, p and k. Null scores are kept per
+# (settings, aggregate, sample, size) in a NullCache; a sample is identified
+# by a fingerprint of its genes and values, so later runs reuse the nulls of
+# every sample they share.
+
+# Result keys of the aggregates (see all_results)
+result_keys = {'min': 'min_p_val'}
+
+
+def validate_n_permutations(n_permutations):
+    if not isinstance(n_permutations, (int, np.integer)) or n_permutations < 1:
+        raise ValueError("n_permutations must be a positive integer, got {}".format(n_permutations))
+    return True
+
+
+# Fingerprint of every sample column together with the genes it is indexed
+# by; a sample of a SparseExpression has the fingerprint of its dense column
+def sample_fingerprints(prepared):
+    genes = pd.util.hash_pandas_object(prepared.genes, index=False).values.tobytes()
+    if isinstance(prepared, SparseExpression):
+        def column(i):
+            return prepared.matrix[:, i].toarray().ravel()
+    else:
+        values = prepared.expression_table_df.to_numpy(dtype=np.float64)
+
+        def column(i):
+            return values[:, i]
+    return [
+        hashlib.sha1(genes + np.ascontiguousarray(column(i)).tobytes()).hexdigest()
+        for i in range(len(prepared.samples))
+    ]
+
+
+# n_permutations x max_size positions of genes; row p holds the first
+# max_size genes of permutation p
+def null_gene_positions(n_genes, max_size, n_permutations, random_state=0):
+    positions = np.empty((n_permutations, min(max_size, n_genes)), dtype=np.intp)
+    for p in range(n_permutations):
+        positions[p] = np.random.default_rng([random_state, p]).permutation(n_genes)[:positions.shape[1]]
+    return positions
+
+
+# CSR membership of the null sets of every size in `sizes`, n_permutations
+# consecutive rows per size
+def null_membership(positions, sizes, n_genes):
+    n_permutations = len(positions)
+    indices = np.concatenate([positions[:, :size].ravel() for size in sizes])
+    indptr = np.concatenate([[0], np.cumsum(np.repeat(sizes, n_permutations))])
+    membership = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.int8), indices, indptr), shape=(len(sizes) * n_permutations, n_genes)
+    )
+    membership.sort_indices()
+    return membership
+
+
+# Null scores of (settings, aggregate, sample, size), each an array of null
+# scores in permutation order. hits and misses count (sample, size) lookups.
+# save and NullCache.load keep the cache in one .npz file.
+class NullCache:
+
+    def __init__(self):
+        self.nulls = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.nulls)
+
+    def clear(self):
+        self.nulls.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, settings, aggregate, sample, size, n_permutations):
+        null = self.nulls.get((settings, aggregate, sample, int(size)))
+        if null is None or len(null) < n_permutations:
+            return None
+        return null[:n_permutations]
+
+    def set(self, settings, aggregate, sample, size, null):
+        self.nulls[(settings, aggregate, sample, int(size))] = null
+
+    def save(self, f):
+        keys = list(self.nulls)
+        np.savez(
+            f,
+            keys=np.array(json.dumps([
+                [list(settings), aggregate, sample, size] for settings, aggregate, sample, size in keys
+            ])),
+            **{'null_{}'.format(i): self.nulls[key] for i, key in enumerate(keys)}
+        )
+        return f
+
+    @classmethod
+    def load(cls, f):
+        null_cache = cls()
+        with np.load(f, allow_pickle=False) as arrays:
+            for i, (settings, aggregate, sample, size) in enumerate(json.loads(str(arrays['keys']))):
+                null_cache.set(tuple(settings), aggregate, sample, size, arrays['null_{}'.format(i)])
+        return null_cache
+
+
+# {aggregate: {size: n_permutations x samples null scores}} for one
+# direction; null scores missing from null_cache are computed for the samples
+# that lack them, sizes grouped into passes of at most BLOCK_CELLS null genes
+def null_scores(
+        prepared,
+        sizes,
+        ascending,
+        rank_method,
+        p_value_method,
+        aggregates,
+        n_permutations,
+        null_cache,
+        random_state,
+        log_p=False,
+        n_jobs=1,
+        executor=None,
+        p_value_cache=None,
+        precision='double',
+        backend='numpy'
+):
+    settings = (bool(ascending), rank_method, p_value_method, bool(log_p), precision, int(random_state))
+    samples = sample_fingerprints(prepared)
+    nulls = {
+        aggregate: {size: np.full((n_permutations, len(samples)), np.nan) for size in sizes}
+        for aggregate in aggregates
+    }
+
+    missing = {}
+    for size in sizes:
+        for j, sample in enumerate(samples):
+            cached = [null_cache.get(settings, aggregate, sample, size, n_permutations) for aggregate in aggregates]
+            if any(null is None for null in cached):
+                null_cache.misses += 1
+                missing.setdefault(size, []).append(j)
+                continue
+            null_cache.hits += 1
+            for aggregate, null in zip(aggregates, cached):
+                nulls[aggregate][size][:, j] = null
+
+    groups = {}
+    for size, columns in missing.items():
+        groups.setdefault(tuple(columns), []).append(size)
+    if not groups:
+        return nulls
+
+    n_genes = len(prepared.genes)
+    positions = null_gene_positions(n_genes, max(sizes), n_permutations, random_state)
+    ranks = prepared.expression_ranks(ascending=ascending, rank_method=rank_method, precision=precision)
+    function = p_value_function(p_value_method, log_p, p_value_cache, precision)
+    backend = effective_backend(backend)
+    for columns, group_sizes in groups.items():
+        columns = list(columns)
+        passes = [[]]
+        for size in group_sizes:
+            if passes[-1] and (sum(passes[-1]) + size) * n_permutations > BLOCK_CELLS:
+                passes.append([])
+            passes[-1].append(size)
+        for pass_sizes in passes:
+            bg = prepared.bg_genes.loc[prepared.samples[columns]].values
+            if isinstance(ranks, SparseRanks):
+                column_ranks = ranks.columns(columns)
+            else:
+                column_ranks = ranks.values[:, columns]
+            membership = null_membership(positions, pass_sizes, n_genes)
+            with profiling.stage('null_scores'):
+                if backend == 'numba':
+                    scores = jit_pathway_scores(
+                        column_ranks, bg, membership, rank_method, aggregates, log_p
+                    )
+                else:
+                    scores = parallel_pathway_scores(
+                        column_ranks,
+                        bg,
+                        membership,
+                        function,
+                        rank_method=rank_method,
+                        aggregates=aggregates,
+                        log_p=log_p,
+                        n_jobs=n_jobs,
+                        executor=executor,
+                        precision=precision
+                    )
+            for aggregate, values in scores.items():
+                for i, size in enumerate(pass_sizes):
+                    size_scores = values[i * n_permutations:(i + 1) * n_permutations]
+                    nulls[aggregate][size][:, columns] = size_scores
+                    for j, column in enumerate(columns):
+                        null_cache.set(settings, aggregate, samples[column], size, size_scores[:, j].copy())
+    return nulls
+
+
+# Empirical p-values and z-scores of pathways x samples scores against the
+# null scores of each pathway's size; NaN where the pathway has no genes
+def empirical_statistics(scores, sizes, nulls):
+    empirical_p = np.full(scores.shape, np.nan)
+    z_scores = np.full(scores.shape, np.nan)
+    for size, null in nulls.items():
+        rows = np.flatnonzero(sizes == size)
+        observed = scores[rows]
+        exceeding = (null[None] >= observed[:, None]).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            p = (1 + exceeding) / (1 + (~np.isnan(null)).sum(axis=0))
+            p[np.isnan(observed)] = np.nan
+            empirical_p[rows] = p
+            z_scores[rows] = (observed - np.nanmean(null, axis=0)) / np.nanstd(null, axis=0, ddof=1)
+    return empirical_p, z_scores
+
+
+# pathway_assessor.all with an empirical p-value ('{key}_empirical_p') and a
+# z-score ('{key}_z') next to every score, from n_permutations size-matched
+# random gene sets per pathway size. Pass the same null_cache (a NullCache)
+# to later runs to reuse their null scores.
+def permutation_all(
+        expression_table,
+        pathways=None,
+        db='kegg',
+        n_permutations=1000,
+        geometric=True,
+        min_p_val=True,
+        ascending=True,
+        rank_method='max',
+        p_value_method='hypergeom',
+        n_jobs=1,
+        executor=None,
+        extra_aggregates=(),
+        log_p=False,
+        cache=None,
+        direction=None,
+        p_value_cache=None,
+        precision='double',
+        null_cache=None,
+        random_state=0,
+        backend='numpy'
+):
+    if not pathways:
+        pathways = db_pathways(db)
+    else:
+        validate_pathways(pathways)
+    validate_n_permutations(n_permutations)
+    validate_backend_options(True, backend, p_value_method, p_value_cache, n_jobs, executor, expression_table)
+    if null_cache is None:
+        null_cache = NullCache()
+    if random_state is None:
+        random_state = int(np.random.SeedSequence().entropy % 2 ** 63)
+
+    prepared = prepared_expression(expression_table, cache=cache)
+    results = pathway_assessor.all(
+        prepared,
+        pathways=pathways,
+        geometric=geometric,
+        min_p_val=min_p_val,
+        ascending=ascending,
+        rank_method=rank_method,
+        p_value_method=p_value_method,
+        n_jobs=n_jobs,
+        executor=executor,
+        extra_aggregates=extra_aggregates,
+        log_p=log_p,
+        direction=direction,
+        p_value_cache=p_value_cache,
+        precision=precision,
+        backend=backend
+    )
+
+    if isinstance(pathways, GeneSets):
+        membership = gene_sets_membership(pathways, prepared.genes)
+    else:
+        membership = membership_matrix(pathways, prepared.genes)
+    sizes = np.diff(membership.indptr)
+    null_sizes = [int(size) for size in np.unique(sizes) if size > 0]
+    aggregates = all_aggregates(geometric, min_p_val, extra_aggregates)
+
+    if direction == 'both':
+        direction_results = [(results[key], directions[key]) for key in ('suppression', 'activation')]
+    else:
+        direction_results = [(results, directions[direction] if direction is not None else ascending)]
+    for direction_result, direction_ascending in direction_results:
+        nulls = null_scores(
+            prepared, null_sizes, direction_ascending, rank_method, p_value_method, aggregates, n_permutations,
+            null_cache, random_state, log_p, n_jobs, executor, p_value_cache, precision, backend
+        )
+        for aggregate in aggregates:
+            key = result_keys.get(aggregate, aggregate)
+            scores_df = direction_result[key]
+            empirical_p, z_scores = empirical_statistics(scores_df.values, sizes, nulls[aggregate])
+            direction_result['{}_empirical_p'.format(key)] = pd.DataFrame(
+                empirical_p, index=scores_df.index, columns=scores_df.columns
+            )
+            direction_result['{}_z'.format(key)] = pd.DataFrame(
+                z_scores, index=scores_df.index, columns=scores_df.columns
+            )
+    return results
@@ -0,0 +1,177 @@
+import contextlib
+import csv
+import json
+import logging
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Progress goes to the 'pathway_assessor' logger. Timings and sizes are
+# collected by a Profiler: while one is active (`with Profiler() as profiler:`)
+# every stage of a run (dedup, ranking, membership, pathway_ranks,
+# contingency, p_values, aggregation, jit_kernel, which replaces the three
+# stages before aggregation with backend='numba', and bounds and
+# screened_scores with top_k or min_score) adds its wall time to it, pathway
+# gene counts are recorded, counters (such as the pathways and gene x sample
+# cells saved by scoring duplicate gene sets once, or the bounded and
+# screened pathway/sample pairs) are summed and the peak memory is tracked.
+# Profilers are active per thread: stages run in worker processes (n_jobs) or
+# on other threads (such as the service's scoring thread) are not seen by a
+# profiler of the caller.
+logger = logging.getLogger('pathway_assessor')
+
+local = threading.local()
+
+
+def active_profilers():
+    if not hasattr(local, 'profilers'):
+        local.profilers = []
+    return local.profilers
+
+
+def active_profiler():
+    profilers = active_profilers()
+    return profilers[-1] if profilers else None
+
+
+def stage(name):
+    profiler = active_profiler()
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name)
+
+
+def record_pathway(name, **fields):
+    profiler = active_profiler()
+    if profiler is not None:
+        profiler.record_pathway(name, **fields)
+
+
+def count(name, value):
+    profiler = active_profiler()
+    if profiler is not None:
+        profiler.count(name, value)
+
+
+# High-water mark of the whole process, not of a single run
+def peak_rss():
+    if resource is None:
+        return None
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# callback(event, fields) is called with event 'stage' after every stage and
+# 'pathway' for every recorded pathway. trace_memory records the peak of the
+# memory allocated during the run (peak_memory) and during each stage with
+# tracemalloc (which slows the run). process_peak_rss is the peak resident
+# memory of the process when the run ended, which includes earlier work.
+class Profiler:
+
+    def __init__(self, callback=None, trace_memory=False):
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.pathways = []
+        self.counts = {}
+        self.peak_memory = None
+        self.process_peak_rss = None
+        self.seconds = 0.
+        self.stage_peaks = []
+        self.started_tracing = False
+
+    def __enter__(self):
+        active_profilers().append(self)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        if self.trace_memory:
+            # the run's peak, raised by the stages below it
+            tracemalloc.reset_peak()
+            self.stage_peaks.append(tracemalloc.get_traced_memory()[0])
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds += time.perf_counter() - self.start
+        self.process_peak_rss = peak_rss()
+        if self.trace_memory and tracemalloc.is_tracing():
+            peak = max(self.stage_peaks.pop(), tracemalloc.get_traced_memory()[1])
+            self.peak_memory = max(self.peak_memory or 0, peak)
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        active_profilers().remove(self)
+        return False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            # keep the peak of an enclosing stage before resetting it
+            if self.stage_peaks:
+                self.stage_peaks[-1] = max(self.stage_peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self.stage_peaks.append(tracemalloc.get_traced_memory()[0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            fields = self.stages.setdefault(name, {'calls': 0, 'seconds': 0., 'peak_memory': None})
+            fields['calls'] += 1
+            fields['seconds'] += seconds
+            if tracing:
+                peak = max(self.stage_peaks.pop(), tracemalloc.get_traced_memory()[1])
+                fields['peak_memory'] = max(fields['peak_memory'] or 0, peak)
+                if self.stage_peaks:
+                    self.stage_peaks[-1] = max(self.stage_peaks[-1], peak)
+            logger.debug('%s: %.6f s', name, seconds)
+            if self.callback is not None:
+                self.callback('stage', {'stage': name, 'seconds': seconds})
+
+    def record_pathway(self, name, **fields):
+        fields = dict({'pathway': name}, **fields)
+        self.pathways.append(fields)
+        if self.callback is not None:
+            self.callback('pathway', fields)
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def to_dict(self):
+        return {
+            'seconds': self.seconds,
+            'peak_memory': self.peak_memory,
+            'process_peak_rss': self.process_peak_rss,
+            'stages': self.stages,
+            'pathways': self.pathways,
+            'counts': self.counts,
+        }
+
+    def to_json(self, f=None):
+        profile = json.dumps(self.to_dict(), indent=1)
+        if f is not None:
+            with open(f, 'w') as f_out:
+                f_out.write(profile)
+        return profile
+
+    # One row per stage, per recorded pathway and per counter, told apart by `kind`
+    def to_csv(self, f):
+        rows = [dict({'kind': 'stage', 'name': name}, **fields) for name, fields in self.stages.items()]
+        rows += [
+            dict({'kind': 'pathway', 'name': fields['pathway']}, **{k: v for k, v in fields.items() if k != 'pathway'})
+            for fields in self.pathways
+        ]
+        rows += [{'kind': 'count', 'name': name, 'value': value} for name, value in self.counts.items()]
+        columns = list(dict.fromkeys(column for row in rows for column in row))
+        with open(f, 'w', newline='') as f_out:
+            writer = csv.DictWriter(f_out, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+        return f
@@ -0,0 +1,205 @@
+import numpy as np
+import scipy.special as special
+
+from . import profiling
+from .aggregation import segment_reduce
+from .batched import (
+    BLOCK_CELLS,
+    SparseRanks,
+    block_contingency,
+    block_membership,
+    contingency_scores,
+    p_value_dtype,
+    pathway_blocks,
+    rank_dtype,
+    validate_precision
+)
+
+# Screening keeps only the (pathway, sample) pairs that make the top_k of
+# their sample and/or reach min_score. Every p-value of a pair is at least
+# the hypergeometric pmf of its table (P(X >= a) >= P(X = a)), and the
+# harmonic, geometric, min and Cauchy combinations of p-values are at least
+# their smallest p-value, so -log of the largest pmf bounds the score of a
+# pair from above. The pmf is a few log-gamma terms per cell where the
+# p-value sums a tail, so pairs are bounded first and only the pairs whose
+# bound can still qualify are scored. The Fisher combination can fall below
+# the smallest p-value and is not bounded.
+screening_aggregates = ('harmonic', 'geometric', 'min', 'cauchy')
+
+
+def validate_screening(mode, top_k, min_score):
+    if mode not in screening_aggregates:
+        raise ValueError(
+            "{} not recognized. Available aggregates for top_k and min_score: {}".format(
+                mode, ",".join(screening_aggregates)
+            )
+        )
+    if top_k is not None and (isinstance(top_k, bool) or not isinstance(top_k, (int, np.integer)) or top_k < 1):
+        raise ValueError("top_k should be a positive integer, got {}".format(top_k))
+    if min_score is not None and np.isnan(min_score):
+        raise ValueError("min_score should be a number, got {}".format(min_score))
+    return True
+
+
+# Lower bound on hypergeom_log_sf of every table: the log pmf, 0 where the
+# p-value is 1 and -inf where the counts do not make a table. Counts are
+# truncated to integers as the p-values take them; NaN counts give NaN. The
+# log binomials are looked up in a table of log factorials, and the bound is
+# lowered by the rounding of the log factorial sums, which grows with the
+# largest of them (log M!).
+def hypergeom_log_sf_bound(a, b, c, d):
+    counts = np.broadcast_arrays(*(np.asarray(x) for x in (a, b, c, d)))
+    missing = np.zeros(counts[0].shape, dtype=bool)
+    for count in counts:
+        if count.dtype.kind == 'f':
+            missing |= np.isnan(count)
+    a, b, c, d = (np.where(missing, 0, count).astype(np.int64, copy=False) for count in counts)
+    invalid = (a < 0) | (b < 0) | (c < 0) | (d < 0)
+    if invalid.any():
+        a, b, c, d = (np.where(invalid, 0, count) for count in (a, b, c, d))
+    M = a + b + c + d
+    K = a + c
+    n = a + b
+
+    log_factorials = special.gammaln(np.arange(M.max(initial=0) + 1) + 1)
+    bound = (
+        log_factorials[K] - log_factorials[a] - log_factorials[c]
+        + log_factorials[b + d] - log_factorials[b] - log_factorials[d]
+        - log_factorials[M] + log_factorials[n] + log_factorials[c + d]
+    )
+    bound -= 32 * np.finfo(float).eps * log_factorials[M]
+    certain = (a + b == 0) | (c + d == 0) | (a + c == 0) | (b + d == 0) | (a <= np.maximum(0, a - d))
+    bound[certain] = 0
+    bound[invalid] = -np.inf
+    bound[missing] = np.nan
+    return bound
+
+
+# Upper bounds on the scores of a block of pathways (pathways x samples, NaN
+# for pathways without present genes), loose enough to cover the rounding of
+# the scores. Without log_p a p-value that underflows to 0 scores inf, so
+# bounds past the underflow are inf.
+def contingency_bounds(contingency, indptr, log_p=False, precision='double'):
+    with profiling.stage('bounds'):
+        log_bounds = hypergeom_log_sf_bound(*contingency[:4])
+        if len(contingency) == 5:
+            log_bounds[contingency[4]] = np.nan
+        bounds = -segment_reduce(np.fmin, log_bounds, indptr)
+        finfo = np.finfo(p_value_dtype(precision))
+        bounds += 1024 * finfo.eps * (1 + np.abs(bounds))
+        if not log_p:
+            bounds[bounds > -np.log(finfo.tiny)] = np.inf
+        return bounds
+
+
+# Scores of the given (pathway, sample) pairs of a block from its a/b/c/d:
+# the cells of each pair are gathered into one segment
+def pair_scores(contingency, indptr, pathways, samples, p_value_function, mode, log_p=False):
+    sizes = indptr[pathways + 1] - indptr[pathways]
+    pair_indptr = np.concatenate([[0], np.cumsum(sizes)])
+    rows = np.repeat(indptr[pathways] - pair_indptr[:-1], sizes) + np.arange(pair_indptr[-1])
+    columns = np.repeat(samples, sizes)
+    cells = tuple(count[rows, columns][:, None] for count in contingency)
+    return contingency_scores(cells, p_value_function, pair_indptr, aggregates=[mode], log_p=log_p)[mode][:, 0]
+
+
+# The k largest of each column, as a k x columns array padded with -inf
+def column_top(values, k):
+    if len(values) > k:
+        values = -np.partition(-values, k - 1, axis=0)[:k]
+    return np.vstack([values, np.full((k - len(values), values.shape[1]), -np.inf)])
+
+
+# Scores of the pairs of every pathway of a membership matrix and every sample
+# that may make the top_k of their sample and reach min_score, as aligned
+# (pathway, sample, score) arrays. The pairs left out are those whose bound
+# is below min_score or below k exact scores of their sample, so the top_k
+# and min_score pairs are all returned (select with top_pairs). Within a
+# block the top_k pairs of every sample by bound are scored first, and the
+# rest only where their bound reaches the k-th of the scores so far.
+def screened_pathway_scores(
+        expression_ranks,
+        bg,
+        membership,
+        p_value_function,
+        mode='harmonic',
+        top_k=None,
+        min_score=None,
+        rank_method='max',
+        log_p=False,
+        max_cells=BLOCK_CELLS,
+        precision='double'
+):
+    validate_screening(mode, top_k, min_score)
+    validate_precision(precision)
+    if not isinstance(expression_ranks, SparseRanks):
+        expression_ranks = np.asarray(expression_ranks, dtype=rank_dtype(rank_method, precision))
+    bg = np.asarray(bg, dtype=rank_dtype(rank_method, precision))
+    n_samples = expression_ranks.shape[1]
+
+    lowest = -np.inf if min_score is None else min_score
+    top = None if top_k is None else np.full((top_k, n_samples), -np.inf)
+    pairs = []
+    for start, stop in pathway_blocks(membership.indptr, n_samples, max_cells=max_cells):
+        indptr, indices = block_membership(membership.indptr, membership.indices, start, stop)
+        contingency = block_contingency(
+            expression_ranks, bg, indptr, indices, rank_method=rank_method, precision=precision
+        )
+        bounds = contingency_bounds(contingency, indptr, log_p=log_p, precision=precision)
+        with np.errstate(invalid='ignore'):
+            candidates = bounds >= lowest
+        rounds = [candidates]
+        if top is not None:
+            # rank of every bound within its sample, largest first
+            order = np.argsort(np.where(candidates, -bounds, np.inf), axis=0, kind='stable')
+            first = np.zeros(candidates.shape, dtype=bool)
+            np.put_along_axis(first, order[:top_k], True, axis=0)
+            rounds = [first & candidates, ~first & candidates]
+
+        for i, selected in enumerate(rounds):
+            if i and top is not None:
+                with np.errstate(invalid='ignore'):
+                    selected = selected & (bounds >= np.maximum(top[-1], lowest))
+            pathways, samples = np.nonzero(selected)
+            profiling.count('screened_pairs', len(pathways))
+            if not len(pathways):
+                continue
+            with profiling.stage('screened_scores'):
+                scores = pair_scores(contingency, indptr, pathways, samples, p_value_function, mode, log_p=log_p)
+            pairs.append((pathways + start, samples, scores))
+            if top is not None:
+                scored = np.full((stop - start, n_samples), -np.inf)
+                scored[pathways, samples] = np.where(np.isnan(scores), -np.inf, scores)
+                top = column_top(np.vstack([top, scored]), top_k)
+                top = -np.sort(-top, axis=0)
+        profiling.count('bounded_pairs', bounds.size)
+
+    if not pairs:
+        return tuple(np.empty(0, dtype=dtype) for dtype in (np.intp, np.intp, float))
+    return tuple(np.concatenate(arrays) for arrays in zip(*pairs))
+
+
+# Pairs of the distinct membership rows (see unique_pathway_membership) fanned
+# out to every pathway of each row
+def pathway_pairs(rows, samples, scores, inverse):
+    order = np.argsort(inverse, kind='stable')
+    starts = np.searchsorted(inverse[order], rows, side='left')
+    counts = np.searchsorted(inverse[order], rows, side='right') - starts
+    positions = np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts) + np.arange(counts.sum())
+    return order[positions], np.repeat(samples, counts), np.repeat(scores, counts)
+
+
+# The pairs that make the top_k of their sample (ties in pathway order) and
+# reach min_score, ordered by sample and then by score, largest first
+def top_pairs(pathways, samples, scores, top_k=None, min_score=None):
+    keep = ~np.isnan(scores)
+    if min_score is not None:
+        keep &= scores >= min_score
+    pathways, samples, scores = pathways[keep], samples[keep], scores[keep]
+    order = np.lexsort((pathways, -scores, samples))
+    pathways, samples, scores = pathways[order], samples[order], scores[order]
+    if top_k is not None:
+        starts = np.searchsorted(samples, samples, side='left')
+        keep = np.arange(len(samples)) - starts < top_k
+        pathways, samples, scores = pathways[keep], samples[keep], scores[keep]
+    return pathways, samples, scores
@@ -0,0 +1,463 @@
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from .batched import validate_precision, validate_rank_method
+from .cli import cohort_keys, cohort_source, manifest_pathways, settings_keys, validate_keys
+from .genesets import combine_gene_sets
+from .pathway_assessor import (
+    PreparedExpression,
+    all_aggregates,
+    all_results,
+    directions,
+    expression_fingerprint,
+    pathway_membership,
+    rank_scores,
+    rank_scores_both,
+    validate_aggregates,
+    validate_backend_options,
+    validate_db_name,
+    validate_p_value_method
+)
+from .profiling import logger
+
+# `pathway-assessor-serve` keeps a scoring process running on localhost so
+# that a request does not pay for importing SciPy, loading a database and
+# ranking its expression table again. Requests and responses are lines of
+# JSON over TCP. A request
+#
+#   {"expression": {"path": "upload.tsv"}, "dbs": ["kegg"], "direction": "both",
+#    "settings": {"rank_method": "max", "log_p": true}}
+#
+# names a cohort by path (with the cohort keys of a CLI manifest) or gives it
+# inline as {"genes": [...], "samples": [...], "values": [[...], ...]} with one
+# row of values per gene (null for missing values). dbs are included database
+# names or gene-set paths, direction is 'suppression' (the default),
+# 'activation' or 'both' and settings are those of a CLI manifest. The
+# response is a {"event": "samples"} line with the samples of the cohort, one
+# {"event": "pathway"} line per pathway with its scores per sample in the
+# keys of the result of pathway_assessor.all (per direction with 'both'),
+# streamed block by block as they are scored, and a final {"event": "done"},
+# or an {"event": "error"} line. Non-finite scores are written as NaN and
+# Infinity, as json.dumps does.
+#
+# Databases and prepared cohorts stay resident in bounded LRU caches; a
+# cohort named by path is read again when its file changes. Scoring runs in
+# one background thread, one pass at a time. Requests with the same direction
+# and settings that arrive while a pass is pending (within batch_delay, or
+# while the previous pass runs) are scored together: their cohorts are placed
+# side by side on the union of their genes, which leaves the scores of every
+# sample unchanged as they only depend on its own column, and their dbs are
+# combined so that a gene set shared by several of them is scored once.
+
+default_port = 8765
+request_keys = ('expression', 'dbs', 'direction', 'settings')
+service_directions = ('suppression', 'activation', 'both')
+
+
+def validate_service_request(request):
+    if not isinstance(request, dict):
+        raise ValueError("A request should be a JSON object")
+    validate_keys(request, request_keys, 'request keys')
+    if 'expression' not in request:
+        raise ValueError("A request needs an expression")
+    direction = request.get('direction', 'suppression')
+    if direction not in service_directions:
+        raise ValueError(
+            "{} not recognized. Available directions: {}".format(direction, ",".join(service_directions))
+        )
+    settings = request.get('settings', {})
+    validate_keys(settings, settings_keys, 'settings')
+    validate_rank_method(settings.get('rank_method', 'max'))
+    validate_p_value_method(settings.get('p_value_method', 'hypergeom'))
+    validate_aggregates(settings.get('extra_aggregates', ()))
+    validate_precision(settings.get('precision', 'double'))
+    validate_backend_options(
+        True, settings.get('backend', 'numpy'), settings.get('p_value_method', 'hypergeom'), None, 1, None
+    )
+    dbs = request.get('dbs', ['kegg'])
+    if isinstance(dbs, str) or not dbs:
+        raise ValueError("dbs should be a list of database names or gene-set paths")
+    for db in dbs:
+        if not os.path.exists(db):
+            validate_db_name(db)
+    return True
+
+
+# Cache key of the cohort of a request and a function that loads it as a
+# DataFrame. A cohort path is keyed by its modification time and size.
+def cohort_loader(expression):
+    if not isinstance(expression, dict):
+        raise ValueError("expression should be a JSON object")
+    if 'path' in expression:
+        validate_keys(expression, cohort_keys, 'cohort keys')
+        cohort = dict(expression, path=os.path.abspath(expression['path']))
+        stat = os.stat(cohort['path'])
+        key = json.dumps([cohort, stat.st_mtime_ns, stat.st_size], sort_keys=True)
+
+        def load():
+            with tempfile.TemporaryDirectory() as spill:
+                source = cohort_source(cohort, spill)
+                return source.chunk(0, len(source.samples))
+        return key, load
+
+    inline_keys = ('genes', 'samples', 'values')
+    validate_keys(expression, inline_keys, 'inline expression keys')
+    for key in inline_keys:
+        if key not in expression:
+            raise ValueError("An inline expression needs {}".format(",".join(inline_keys)))
+    table = pd.DataFrame(
+        np.array(expression['values'], dtype=float).reshape(len(expression['genes']), len(expression['samples'])),
+        index=expression['genes'],
+        columns=expression['samples']
+    )
+    return expression_fingerprint(table), lambda: table
+
+
+class ResidentCache:
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, load):
+        if key in self.items:
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+        self.misses += 1
+        self.items[key] = load()
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+        return self.items[key]
+
+
+# Requests scored in one pass: every distinct cohort is one group of sample
+# columns and every request reads its rows and columns from the pass
+class Batch:
+
+    def __init__(self, direction, settings):
+        self.direction = direction
+        self.settings = settings
+        self.cohorts = OrderedDict()
+        self.dbs = []
+        self.requests = []
+
+    def add(self, cohort_key, load, dbs, queue):
+        self.cohorts.setdefault(cohort_key, load)
+        self.dbs += [db for db in dbs if db not in self.dbs]
+        self.requests.append((list(self.cohorts).index(cohort_key), dbs, queue))
+
+
+# Matrices of several cohorts side by side on the union of their genes; the
+# genes a cohort lacks get missing_value (NaN, or 0 in single precision ranks)
+def union_matrix(matrices, rows, n_genes, missing_value=np.nan):
+    combined = np.full((n_genes, sum(matrix.shape[1] for matrix in matrices)), missing_value, dtype=matrices[0].dtype)
+    start = 0
+    for matrix, matrix_rows in zip(matrices, rows):
+        combined[matrix_rows, start:start + matrix.shape[1]] = matrix
+        start += matrix.shape[1]
+    return combined
+
+
+class ScoringService:
+
+    def __init__(self, dbs=('kegg',), max_dbs=16, max_cohorts=8, block_size=64, batch_delay=0.01):
+        self.databases = ResidentCache(max_dbs)
+        self.cohorts = ResidentCache(max_cohorts)
+        self.block_size = block_size
+        self.batch_delay = batch_delay
+        self.requests = 0
+        self.passes = 0
+        self.pending = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.scoring = None
+        for db in dbs:
+            self.database(db)
+
+    def info(self):
+        return {
+            'requests': self.requests,
+            'passes': self.passes,
+            'dbs': len(self.databases),
+            'cohorts': len(self.cohorts),
+            'cohort_hits': self.cohorts.hits,
+            'cohort_misses': self.cohorts.misses,
+        }
+
+    def database(self, db):
+        key = os.path.abspath(db) if os.path.exists(db) else db.lower()
+        return self.databases.get(key, lambda: manifest_pathways(key))
+
+    def prepared(self, cohort_key, load):
+        return self.cohorts.get(cohort_key, lambda: PreparedExpression(load()))
+
+    # Scores a request, putting its response events on `queue` and None last
+    async def submit(self, request, queue):
+        self.requests += 1
+        loop = asyncio.get_running_loop()
+        try:
+            validate_service_request(request)
+            cohort_key, load = await loop.run_in_executor(None, cohort_loader, request['expression'])
+        except (ValueError, TypeError, OSError) as e:
+            queue.put_nowait({'event': 'error', 'message': str(e)})
+            queue.put_nowait(None)
+            return
+
+        direction = request.get('direction', 'suppression')
+        settings = request.get('settings', {})
+        key = json.dumps([direction, settings], sort_keys=True)
+        if key not in self.pending:
+            self.pending[key] = Batch(direction, settings)
+            loop.create_task(self.run_batch(key))
+        self.pending[key].add(cohort_key, load, list(request.get('dbs', ['kegg'])), queue)
+
+    async def run_batch(self, key):
+        if self.scoring is None:
+            self.scoring = asyncio.Lock()
+        await asyncio.sleep(self.batch_delay)
+        async with self.scoring:
+            batch = self.pending.pop(key)
+            self.passes += 1
+            loop = asyncio.get_running_loop()
+
+            def post(queue, event):
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+            try:
+                await loop.run_in_executor(self.executor, self.score_batch, batch, post)
+            except Exception as e:
+                logger.exception('scoring pass failed')
+                for _, _, queue in batch.requests:
+                    post(queue, {'event': 'error', 'message': str(e)})
+            finally:
+                for _, _, queue in batch.requests:
+                    post(queue, None)
+
+    # One scoring pass over every cohort and db of a batch, run in the
+    # scoring thread
+    def score_batch(self, batch, post):
+        settings = dict(batch.settings)
+        extra_aggregates = settings.get('extra_aggregates', ())
+        aggregates = all_aggregates(settings.get('geometric', True), settings.get('min_p_val', True), extra_aggregates)
+        rank_method = settings.get('rank_method', 'max')
+        precision = settings.get('precision', 'double')
+        options = (
+            rank_method, settings.get('p_value_method', 'hypergeom'), aggregates, settings.get('log_p', False), 1,
+            None, None, precision, settings.get('backend', 'numpy')
+        )
+
+        # a cohort that fails to load fails only the requests that share it
+        prepared = []
+        positions = {}
+        for index, (cohort_key, load) in enumerate(batch.cohorts.items()):
+            try:
+                prepared.append(self.prepared(cohort_key, load))
+            except Exception as e:
+                logger.warning('cohort failed to load: %s', e)
+                for cohort_index, _, queue in batch.requests:
+                    if cohort_index == index:
+                        post(queue, {'event': 'error', 'message': str(e)})
+                        post(queue, None)
+            else:
+                positions[index] = len(prepared) - 1
+        batch.requests = [
+            (positions[cohort_index], dbs, queue)
+            for cohort_index, dbs, queue in batch.requests if cohort_index in positions
+        ]
+        batch.dbs = [db for db in batch.dbs if any(db in dbs for _, dbs, _ in batch.requests)]
+        if not batch.requests:
+            return
+
+        genes = prepared[0].genes
+        for cohort in prepared[1:]:
+            genes = genes.union(cohort.genes)
+        rows = [genes.get_indexer(cohort.genes) for cohort in prepared]
+        columns = np.cumsum([0] + [len(cohort.samples) for cohort in prepared])
+        bg = np.concatenate([cohort.bg_genes.loc[cohort.samples].values for cohort in prepared])
+
+        def combined(matrices, missing_value=np.nan if precision == 'double' else 0):
+            if len(matrices) == 1:
+                return matrices[0]
+            return union_matrix(matrices, rows, len(genes), missing_value)
+
+        if batch.direction == 'both':
+            ranks = [cohort.expression_ranks_both(rank_method=rank_method, precision=precision) for cohort in prepared]
+            matrices = (
+                combined([cohort.expression_table_df.values for cohort in prepared], np.nan),
+                combined([both[0].values for both in ranks]),
+                combined([both[1].values for both in ranks])
+            )
+        else:
+            ascending = directions[batch.direction]
+            matrices = (combined([
+                cohort.expression_ranks(ascending=ascending, rank_method=rank_method, precision=precision).values
+                for cohort in prepared
+            ]),)
+
+        for cohort_index, _, queue in batch.requests:
+            post(queue, {'event': 'samples', 'samples': list(map(str, prepared[cohort_index].samples))})
+
+        pathways = [self.database(db) for db in batch.dbs]
+        gene_sets = combine_gene_sets(pathways)
+        bounds = np.cumsum([0] + [len(db_gene_sets.names) for db_gene_sets in pathways])
+        membership = pathway_membership(gene_sets, genes)
+        names = list(gene_sets.names)
+        for start in range(0, len(names), self.block_size):
+            stop = min(start + self.block_size, len(names))
+            if batch.direction == 'both':
+                scores = rank_scores_both(*matrices, bg, membership[start:stop], *options)
+                results = {name: all_results(value, extra_aggregates) for name, value in scores.items()}
+            else:
+                results = all_results(rank_scores(*matrices, bg, membership[start:stop], *options), extra_aggregates)
+            for row in range(start, stop):
+                db = batch.dbs[np.searchsorted(bounds, row, side='right') - 1]
+                for cohort_index, dbs, queue in batch.requests:
+                    if db not in dbs:
+                        continue
+                    samples = slice(columns[cohort_index], columns[cohort_index + 1])
+                    post(queue, {
+                        'event': 'pathway',
+                        'db': db,
+                        'pathway': names[row],
+                        'scores': row_scores(results, row - start, samples),
+                    })
+        for _, dbs, queue in batch.requests:
+            post(queue, {'event': 'done', 'pathways': int(sum(
+                bounds[i + 1] - bounds[i] for i, db in enumerate(batch.dbs) if db in dbs
+            ))})
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                queue = asyncio.Queue()
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    queue.put_nowait({'event': 'error', 'message': 'Request is not valid JSON: {}'.format(e)})
+                    queue.put_nowait(None)
+                else:
+                    await self.submit(request, queue)
+                while True:
+                    event = await queue.get()
+                    if event is None:
+                        break
+                    writer.write(json.dumps(event).encode() + b'\n')
+                    await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError) as e:
+            logger.warning('closing connection: %s', e)
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=default_port, limit=2 ** 30):
+        return await asyncio.start_server(self.handle, host, port, limit=limit)
+
+    async def serve_forever(self, host='127.0.0.1', port=default_port):
+        server = await self.start(host, port)
+        logger.info('serving on %s', ', '.join(str(sock.getsockname()) for sock in server.sockets))
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def row_scores(results, row, samples):
+    if all(isinstance(value, dict) for value in results.values()):
+        return {name: row_scores(value, row, samples) for name, value in results.items()}
+    return {key: values[row, samples].tolist() for key, values in results.items() if values is not None}
+
+
+# Response events of one request to a running service
+async def request_events(request, host='127.0.0.1', port=default_port, limit=2 ** 30):
+    reader, writer = await asyncio.open_connection(host, port, limit=limit)
+    try:
+        writer.write(json.dumps(request).encode() + b'\n')
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError("The service closed the connection")
+            event = json.loads(line)
+            yield event
+            if event['event'] in ('done', 'error'):
+                break
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+# Scores of one request to a running service in the layout of
+# pathway_assessor.all (pathways of every requested db in db order)
+async def service_scores(request, host='127.0.0.1', port=default_port):
+    samples = None
+    db_rows = OrderedDict((db, OrderedDict()) for db in request.get('dbs', ['kegg']))
+    async for event in request_events(request, host, port):
+        if event['event'] == 'error':
+            raise ValueError(event['message'])
+        if event['event'] == 'samples':
+            samples = event['samples']
+        elif event['event'] == 'pathway':
+            db_rows[event['db']][event['pathway']] = event['scores']
+    rows = OrderedDict((name, scores) for pathways in db_rows.values() for name, scores in pathways.items())
+
+    if not rows:
+        return {}
+
+    def frame(values):
+        return pd.DataFrame(values, index=list(rows), columns=samples)
+    first = next(iter(rows.values()))
+    if all(isinstance(value, dict) for value in first.values()):
+        return {
+            name: {stat: frame([row[name][stat] for row in rows.values()]) for stat in stats}
+            for name, stats in first.items()
+        }
+    return {stat: frame([row[stat] for row in rows.values()]) for stat in first}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pathway-assessor-serve',
+        description='Serve pathway scores on localhost with resident databases and prepared cohorts'
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=default_port)
+    parser.add_argument('--db', action='append', help='database loaded at startup (repeatable); default kegg')
+    parser.add_argument('--max-dbs', type=int, default=16, help='databases kept resident')
+    parser.add_argument('--max-cohorts', type=int, default=8, help='prepared cohorts kept resident')
+    parser.add_argument('--block-size', type=int, default=64, help='pathways scored per streamed block')
+    parser.add_argument('--batch-delay', type=float, default=0.01, help='seconds a pass waits for more requests')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO if args.verbose else logging.WARNING)
+    service = ScoringService(
+        dbs=args.db or ['kegg'], max_dbs=args.max_dbs, max_cohorts=args.max_cohorts, block_size=args.block_size,
+        batch_delay=args.batch_delay
+    )
+    try:
+        asyncio.run(service.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
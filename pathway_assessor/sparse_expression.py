@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+
+from . import profiling
+from .batched import sparse_bg_genes, sparse_expression_ranks
+from .dedup import gene_codes
+
+# Zero-inflated expression (single-cell counts) kept sparse: a genes x
+# samples scipy.sparse matrix with gene and sample labels. Only the stored
+# values are ranked (see batched.SparseRanks), so ranking time and memory
+# follow the number of stored values rather than genes x samples. Duplicated
+# genes are averaged as the 'mean' dedup does, from their stored values only,
+# and rows without a label are dropped.
+sparse_dedup_methods = ('mean',)
+
+
+def validate_sparse_dedup(dedup):
+    if dedup not in sparse_dedup_methods:
+        raise ValueError(
+            "{} not recognized. Available dedup methods for sparse expression: {}".format(
+                dedup, ",".join(sparse_dedup_methods)
+            )
+        )
+    return True
+
+
+# A DataFrame whose columns are all pandas sparse columns
+def is_sparse_frame(df):
+    return (
+        isinstance(df, pd.DataFrame) and len(df.columns) > 0
+        and all(isinstance(dtype, pd.SparseDtype) for dtype in df.dtypes)
+    )
+
+
+def sparse_frame_matrix(df):
+    fill_values = {dtype.fill_value for dtype in df.dtypes}
+    if any(fill_value != 0 for fill_value in fill_values):
+        raise ValueError("Sparse expression columns should have a fill value of 0, got {}".format(fill_values))
+    return df.sparse.to_coo().tocsr()
+
+
+# One row per gene, sorted unless sort=False
+def dedup_sparse_matrix(matrix, genes, dedup='mean', sort=True):
+    validate_sparse_dedup(dedup)
+    genes = pd.Index(genes)
+    if genes.is_unique and not genes.hasnans:
+        if sort and not genes.is_monotonic_increasing:
+            order = genes.argsort()
+            return matrix[order], genes[order].rename('genes')
+        return matrix, genes.rename('genes')
+
+    # stored values are grouped by (gene, sample); a mean is taken over the
+    # rows of the gene that are not NaN, zeros included
+    codes, unique_genes = gene_codes(genes, sort=sort)
+    n_samples = matrix.shape[1]
+    entries = matrix.tocoo()
+    labelled = codes[entries.row] >= 0
+    gene_samples, inverse = np.unique(
+        codes[entries.row[labelled]].astype(np.int64) * n_samples + entries.col[labelled], return_inverse=True
+    )
+    values = entries.data[labelled]
+    missing = np.isnan(values)
+    sums = np.bincount(inverse, weights=np.where(missing, 0., values), minlength=len(gene_samples))
+    n_missing = np.bincount(inverse, weights=missing, minlength=len(gene_samples))
+    rows, columns = np.divmod(gene_samples, n_samples)
+    counts = np.bincount(codes[codes >= 0], minlength=len(unique_genes))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / (counts[rows] - n_missing)
+    return sparse.csr_matrix((means, (rows, columns)), shape=(len(unique_genes), n_samples)), unique_genes
+
+
+class SparseExpression:
+
+    def __init__(self, matrix, genes, samples, dedup='mean', sort=True):
+        if matrix.shape != (len(genes), len(samples)):
+            raise ValueError(
+                "Sparse expression of shape {} does not match {} genes and {} samples".format(
+                    matrix.shape, len(genes), len(samples)
+                )
+            )
+        with profiling.stage('dedup'):
+            matrix, self.genes = dedup_sparse_matrix(
+                sparse.csr_matrix(matrix, dtype=np.float64), genes, dedup=dedup, sort=sort
+            )
+            self.matrix = sparse.csc_matrix(matrix)
+            self.samples = pd.Index(samples)
+            self.bg_genes = pd.Series(sparse_bg_genes(self.matrix), index=self.samples)
+        self.rank_tables = {}
+
+    @classmethod
+    def from_frame(cls, df, dedup='mean', sort=True):
+        return cls(sparse_frame_matrix(df), df.index, df.columns, dedup=dedup, sort=sort)
+
+    def expression_ranks(self, ascending=True, rank_method='max', precision='double'):
+        key = (bool(ascending), rank_method, precision)
+        if key not in self.rank_tables:
+            with profiling.stage('ranking'):
+                self.rank_tables[key] = sparse_expression_ranks(
+                    self.matrix, ascending=ascending, rank_method=rank_method, precision=precision
+                )
+        return self.rank_tables[key]
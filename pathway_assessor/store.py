@@ -0,0 +1,223 @@
+import json
+import os
+import shutil
+
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+
+from .genesets import gene_sets_slice
+from .incremental import pathways_fingerprint
+from .pathway_assessor import (
+    GeneSets,
+    all_aggregates,
+    all_results,
+    db_pathways,
+    expression_scores,
+    pathway_names,
+    prepared_expression,
+    prepared_fingerprint,
+    validate_aggregates,
+    validate_direction,
+    validate_p_value_cache,
+    validate_p_value_method,
+    validate_backend_options,
+    validate_parallel_options,
+    validate_pathways,
+    validate_precision
+)
+from .streaming import result_frames
+
+# On-disk result store of a checkpointed run. Pathways are scored in blocks of
+# block_size; every finished block is flushed as one .npy per result
+# (blocks/{block}_{name}.npy, block pathways x samples) and recorded in
+# manifest.json, which is replaced atomically. A rerun with the same inputs
+# skips the recorded blocks; different inputs start the store over.
+
+manifest_file = 'manifest.json'
+
+
+def pathways_slice(pathways, start, stop):
+    if isinstance(pathways, GeneSets):
+        return gene_sets_slice(pathways, start, stop)
+    names = list(pathways)[start:stop]
+    return {name: pathways[name] for name in names}
+
+
+class ResultStore:
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest = None
+        if os.path.exists(os.path.join(path, manifest_file)):
+            with open(os.path.join(path, manifest_file)) as f:
+                self.manifest = json.load(f)
+
+    def block_file(self, block, name):
+        return os.path.join(self.path, 'blocks', '{:05d}_{}.npy'.format(block, name))
+
+    def save_manifest(self):
+        tmp_f = os.path.join(self.path, manifest_file + '.tmp')
+        with open(tmp_f, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_f, os.path.join(self.path, manifest_file))
+
+    # Keep the store if it was written for `fingerprint`, else start it over
+    def open(self, fingerprint, pathways, samples, blocks, results):
+        if self.manifest is not None and self.manifest['fingerprint'] == fingerprint:
+            return self
+        shutil.rmtree(os.path.join(self.path, 'blocks'), ignore_errors=True)
+        os.makedirs(os.path.join(self.path, 'blocks'))
+        self.manifest = {
+            'fingerprint': fingerprint,
+            'pathways': [str(pathway) for pathway in pathways],
+            'samples': [str(sample) for sample in samples],
+            'blocks': [list(block) for block in blocks],
+            'results': results,
+            'completed': [],
+        }
+        self.save_manifest()
+        return self
+
+    def completed(self, block):
+        return block in self.manifest['completed']
+
+    def write_block(self, block, frames):
+        for name, frame in frames.items():
+            np.save(self.block_file(block, name), frame.values, allow_pickle=False)
+        self.manifest['completed'].append(block)
+        self.save_manifest()
+
+    def complete(self):
+        return len(self.manifest['completed']) == len(self.manifest['blocks'])
+
+    # pathways x samples frame of one result, read from the block files
+    def frame(self, name):
+        blocks = [
+            np.load(self.block_file(block, name), mmap_mode='r')
+            for block in range(len(self.manifest['blocks']))
+        ]
+        return pd.DataFrame(
+            np.concatenate(blocks) if blocks else np.empty((0, len(self.manifest['samples']))),
+            index=pd.Index(self.manifest['pathways']),
+            columns=pd.Index(self.manifest['samples'])
+        )
+
+    def results(self):
+        return StoredResults(self)
+
+
+# Read-only mapping with the keys of the result of all() whose frames are
+# assembled from the store when they are looked up
+class StoredResults(Mapping):
+
+    def __init__(self, store, direction=None):
+        self.store = store
+        self.direction = direction
+        self.stats = [
+            (stat, saved) for result_direction, stat, saved in store.manifest['results']
+            if result_direction == direction
+        ]
+        self.directions = list(dict.fromkeys(
+            result_direction for result_direction, stat, saved in store.manifest['results'] if result_direction
+        ))
+
+    def __getitem__(self, key):
+        if self.direction is None and key in self.directions:
+            return StoredResults(self.store, key)
+        for stat, saved in self.stats:
+            if stat == key:
+                if not saved:
+                    return None
+                return self.store.frame('{}_{}'.format(self.direction, stat) if self.direction else stat)
+        raise KeyError(key)
+
+    def __iter__(self):
+        if self.direction is None and self.directions:
+            return iter(self.directions)
+        return iter(stat for stat, saved in self.stats)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+
+# pathway_assessor.all with every block of block_size pathways flushed to the
+# result store in store_dir as it finishes. Rerunning with the same inputs
+# resumes after the last flushed block. Returns the results as a
+# StoredResults mapping, with the frames read from the store on access.
+def checkpointed_all(
+        expression_table,
+        store_dir,
+        pathways=None,
+        db='kegg',
+        block_size=64,
+        geometric=True,
+        min_p_val=True,
+        ascending=True,
+        rank_method='max',
+        p_value_method='hypergeom',
+        n_jobs=1,
+        executor=None,
+        extra_aggregates=(),
+        log_p=False,
+        direction=None,
+        p_value_cache=None,
+        cache=None,
+        precision='double',
+        backend='numpy'
+):
+    if not pathways:
+        pathways = db_pathways(db)
+    else:
+        validate_pathways(pathways)
+    validate_p_value_method(p_value_method)
+    validate_p_value_cache(p_value_method, p_value_cache)
+    validate_parallel_options(True, n_jobs, executor, p_value_cache)
+    validate_aggregates(extra_aggregates)
+    validate_direction(direction)
+    validate_precision(precision)
+    validate_backend_options(True, backend, p_value_method, p_value_cache, n_jobs, executor, expression_table)
+    aggregates = all_aggregates(geometric, min_p_val, extra_aggregates)
+
+    prepared = prepared_expression(expression_table, cache=cache)
+    names = pathway_names(pathways)
+    fingerprint = json.dumps({
+        'expression_table': prepared_fingerprint(prepared),
+        'pathways': pathways_fingerprint(pathways),
+        'aggregates': aggregates,
+        'ascending': bool(ascending),
+        'rank_method': rank_method,
+        'p_value_method': p_value_method,
+        'log_p': bool(log_p),
+        'direction': direction,
+        'precision': precision,
+        'block_size': block_size,
+    }, sort_keys=True)
+    # the backend is left out: both backends give the same scores (to 1e-9), so
+    # a run may be resumed with either
+    blocks = [(start, min(start + block_size, len(names))) for start in range(0, len(names), block_size)]
+    directions = ['suppression', 'activation'] if direction == 'both' else [None]
+    stats = [('harmonic', True), ('geometric', geometric), ('min_p_val', min_p_val)]
+    stats += [(aggregate, True) for aggregate in extra_aggregates]
+    results = [
+        [result_direction, stat, bool(saved)]
+        for result_direction in directions
+        for stat, saved in stats
+    ]
+
+    store = ResultStore(store_dir).open(fingerprint, names, prepared.samples, blocks, results)
+    for block, (start, stop) in enumerate(blocks):
+        if store.completed(block):
+            continue
+        scores = expression_scores(
+            prepared, pathways_slice(pathways, start, stop), direction, ascending, rank_method, p_value_method,
+            aggregates, True, n_jobs, executor, log_p, p_value_cache=p_value_cache, precision=precision,
+            backend=backend
+        )
+        if direction == 'both':
+            block_results = {key: all_results(value, extra_aggregates) for key, value in scores.items()}
+        else:
+            block_results = all_results(scores, extra_aggregates)
+        store.write_block(block, result_frames(block_results))
+    return store.results()
@@ -0,0 +1,277 @@
+import os
+import tempfile
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from .pathway_assessor import (
+    PreparedExpression,
+    all_aggregates,
+    all_results,
+    db_pathways,
+    expression_scores,
+    pathway_names,
+    validate_aggregates,
+    validate_direction,
+    validate_p_value_cache,
+    validate_p_value_method,
+    validate_backend_options,
+    validate_parallel_options,
+    validate_pathways,
+    validate_precision
+)
+
+# Scoring of expression matrices that do not fit in memory. Scores of a
+# sample only depend on that sample's column (duplicate genes are averaged
+# within a column), so the matrix is read and scored one chunk of sample
+# columns at a time and the results are appended to disk after every chunk.
+
+# genes and samples of a source; chunk(start, stop) returns the genes x
+# samples[start:stop] DataFrame
+ExpressionSource = namedtuple('ExpressionSource', ['genes', 'samples', 'chunk'])
+
+source_formats = ('tsv', 'parquet', 'npy', 'hdf5')
+output_formats = ('tsv', 'npy')
+
+
+def validate_source_format(source_format):
+    if source_format not in source_formats:
+        raise ValueError(
+            "{} not recognized. Available source formats: {}".format(source_format, ",".join(source_formats))
+        )
+    return True
+
+
+def validate_output_format(output_format):
+    if output_format not in output_formats:
+        raise ValueError(
+            "{} not recognized. Available output formats: {}".format(output_format, ",".join(output_formats))
+        )
+    return True
+
+
+def infer_source_format(path):
+    extension = os.path.splitext(str(path))[1].lower()
+    return {
+        '.parquet': 'parquet',
+        '.pq': 'parquet',
+        '.npy': 'npy',
+        '.h5': 'hdf5',
+        '.hdf5': 'hdf5',
+    }.get(extension, 'tsv')
+
+
+def array_source(values, genes, samples):
+    genes = pd.Index(genes)
+    samples = pd.Index(samples)
+
+    def chunk(start, stop):
+        return pd.DataFrame(np.asarray(values[:, start:stop], dtype=float), index=genes, columns=samples[start:stop])
+    return ExpressionSource(genes, samples, chunk)
+
+
+# .npy of genes x samples, memory-mapped; genes and samples are given separately
+def npy_source(path, genes, samples=None):
+    values = np.load(path, mmap_mode='r')
+    if samples is None:
+        samples = range(values.shape[1])
+    return array_source(values, genes, samples)
+
+
+# TSV with genes in rows is row-oriented, so it is parsed once, `chunk_rows`
+# genes at a time, into a raw float64 file in spill_dir that is then read
+# column chunk by column chunk
+def tsv_source(path, spill_dir, chunk_rows=1000):
+    spill_f = os.path.join(spill_dir, 'expression.f8')
+    genes = []
+    samples = None
+    with open(spill_f, 'wb') as spill:
+        for rows in pd.read_csv(path, sep='\t', index_col=0, chunksize=chunk_rows):
+            samples = rows.columns if samples is None else samples
+            genes.extend(rows.index)
+            spill.write(np.ascontiguousarray(rows.values, dtype=float).tobytes())
+    if samples is None:
+        samples = pd.read_csv(path, sep='\t', index_col=0, nrows=0).columns
+    if not genes:
+        return array_source(np.empty((0, len(samples))), genes, samples)
+    values = np.memmap(spill_f, dtype=float, mode='r', shape=(len(genes), len(samples)))
+    return array_source(values, genes, samples)
+
+
+# Parquet written from a genes x samples DataFrame; columns are read per chunk
+def parquet_source(path):
+    import pyarrow.parquet as pq
+
+    schema = pq.ParquetFile(path).schema_arrow
+    index_columns = [
+        column for column in (schema.pandas_metadata or {}).get('index_columns', [])
+        if isinstance(column, str)
+    ]
+    samples = pd.Index([name for name in schema.names if name not in index_columns])
+    genes = pd.read_parquet(path, columns=[]).index
+
+    def chunk(start, stop):
+        return pd.read_parquet(path, columns=list(samples[start:stop])).astype(float)
+    return ExpressionSource(genes, samples, chunk)
+
+
+# HDF5 file with a genes x samples `dataset`; gene and sample names are read
+# from the `genes` and `samples` datasets unless given
+def hdf5_source(path, dataset='expression', genes=None, samples=None):
+    import h5py
+
+    def names(f, key):
+        return [name.decode() if isinstance(name, bytes) else name for name in f[key][()]]
+
+    with h5py.File(path, 'r') as f:
+        n_samples = f[dataset].shape[1]
+        genes = names(f, 'genes') if genes is None else genes
+        if samples is None:
+            samples = names(f, 'samples') if 'samples' in f else range(n_samples)
+    genes = pd.Index(genes)
+    samples = pd.Index(samples)
+
+    def chunk(start, stop):
+        with h5py.File(path, 'r') as f:
+            values = f[dataset][:, start:stop]
+        return pd.DataFrame(np.asarray(values, dtype=float), index=genes, columns=samples[start:stop])
+    return ExpressionSource(genes, samples, chunk)
+
+
+def expression_source(source, source_format=None, genes=None, samples=None, dataset='expression', spill_dir=None):
+    if isinstance(source, ExpressionSource):
+        return source
+    if source_format is None:
+        source_format = infer_source_format(source)
+    validate_source_format(source_format)
+
+    if source_format == 'tsv':
+        return tsv_source(source, spill_dir)
+    if source_format == 'parquet':
+        return parquet_source(source)
+    if source_format == 'npy':
+        if genes is None:
+            raise ValueError("genes are required for npy sources")
+        return npy_source(source, genes, samples)
+    return hdf5_source(source, dataset=dataset, genes=genes, samples=samples)
+
+
+def sample_chunks(n_samples, chunk_size):
+    return [(start, min(start + chunk_size, n_samples)) for start in range(0, n_samples, chunk_size)]
+
+
+# Appends the scores of every chunk to {out_dir}/{name}.tsv (samples in rows,
+# pathways in columns) or writes them into a pathways x samples
+# {out_dir}/{name}.npy, with pathways.txt and samples.txt naming its axes
+class ScoreWriter:
+
+    def __init__(self, out_dir, pathways, samples, output_format='tsv'):
+        validate_output_format(output_format)
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.pathways = pathways
+        self.samples = samples
+        self.output_format = output_format
+        self.files = {}
+        self.arrays = {}
+        if output_format == 'npy':
+            for axis, names in [('pathways', pathways), ('samples', samples)]:
+                with open(os.path.join(out_dir, '{}.txt'.format(axis)), 'w') as f:
+                    f.writelines('{}\n'.format(name) for name in names)
+
+    def write(self, name, scores_df, start):
+        f = os.path.join(self.out_dir, '{}.{}'.format(name, self.output_format))
+        if self.output_format == 'tsv':
+            scores_df.T.to_csv(f, sep='\t', mode='a' if name in self.files else 'w', header=name not in self.files)
+        else:
+            if name not in self.arrays:
+                self.arrays[name] = np.lib.format.open_memmap(
+                    f, mode='w+', dtype=float, shape=(len(self.pathways), len(self.samples))
+                )
+                self.arrays[name][:] = np.nan
+            self.arrays[name][:, start:start + scores_df.shape[1]] = scores_df.values
+        self.files[name] = f
+
+    def close(self):
+        for array in self.arrays.values():
+            array.flush()
+        self.arrays = {}
+        return self.files
+
+
+def result_frames(results):
+    frames = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            frames.update({
+                '{}_{}'.format(key, stat): frame for stat, frame in value.items() if frame is not None
+            })
+        elif value is not None:
+            frames[key] = value
+    return frames
+
+
+# pathway_assessor.all over a matrix read `chunk_size` samples at a time. The
+# scores are written to out_dir as they are computed (see ScoreWriter), named
+# after the keys of the result of all ('{direction}_{key}' with
+# direction='both'); returns {name: written file}.
+def stream_scores(
+        source,
+        out_dir,
+        pathways=None,
+        db='kegg',
+        chunk_size=1000,
+        output_format='tsv',
+        source_format=None,
+        genes=None,
+        samples=None,
+        dataset='expression',
+        spill_dir=None,
+        geometric=True,
+        min_p_val=True,
+        ascending=True,
+        rank_method='max',
+        p_value_method='hypergeom',
+        n_jobs=1,
+        executor=None,
+        extra_aggregates=(),
+        log_p=False,
+        direction=None,
+        p_value_cache=None,
+        precision='double',
+        backend='numpy'
+):
+    if not pathways:
+        pathways = db_pathways(db)
+    else:
+        validate_pathways(pathways)
+    validate_p_value_method(p_value_method)
+    validate_p_value_cache(p_value_method, p_value_cache)
+    validate_parallel_options(True, n_jobs, executor, p_value_cache)
+    validate_aggregates(extra_aggregates)
+    validate_direction(direction)
+    validate_output_format(output_format)
+    validate_precision(precision)
+    validate_backend_options(True, backend, p_value_method, p_value_cache, n_jobs, executor)
+    aggregates = all_aggregates(geometric, min_p_val, extra_aggregates)
+
+    with tempfile.TemporaryDirectory(dir=spill_dir) as spill:
+        source = expression_source(
+            source, source_format=source_format, genes=genes, samples=samples, dataset=dataset, spill_dir=spill
+        )
+        writer = ScoreWriter(out_dir, pathway_names(pathways), source.samples, output_format=output_format)
+        for start, stop in sample_chunks(len(source.samples), chunk_size):
+            prepared = PreparedExpression(source.chunk(start, stop))
+            scores = expression_scores(
+                prepared, pathways, direction, ascending, rank_method, p_value_method, aggregates, True, n_jobs,
+                executor, log_p, p_value_cache=p_value_cache, precision=precision, backend=backend
+            )
+            if direction == 'both':
+                results = {key: all_results(value, extra_aggregates) for key, value in scores.items()}
+            else:
+                results = all_results(scores, extra_aggregates)
+            for name, scores_df in result_frames(results).items():
+                writer.write(name, scores_df, start)
+        return writer.close()
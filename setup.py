@@ -18,13 +18,27 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     classifiers=[
         "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
+        "Programming Language :: Python :: 3.12",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
+    python_requires=">=3.9",
     install_requires=[
-          "numpy",
-          "scipy",
-          "pandas"
+          "numpy>=1.21",
+          "scipy>=1.10",
+          "pandas>=1.3"
     ],
+    extras_require={
+        "numba": ["numba>=0.56"],
+    },
     include_package_data=True,
+    entry_points={
+        "console_scripts": [
+            "pathway-assessor=pathway_assessor.cli:main",
+            "pathway-assessor-serve=pathway_assessor.service:main",
+        ],
+    },
 )
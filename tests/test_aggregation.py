@@ -0,0 +1,74 @@
+import unittest
+import sys
+
+import numpy as np
+import scipy.stats as stats
+
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pathway_assessor as _
+from pathway_assessor import aggregation
+
+
+class TestAggregation(unittest.TestCase):
+
+    def setUp(self):
+
+        self.p_values = np.array([
+            [0.1, 0., np.nan],
+            [0.2, 0.5, np.nan],
+            [0.3, 0.2, np.nan],
+            [np.nan, 0.1, np.nan],
+        ])
+        with np.errstate(divide='ignore'):
+            self.log_p_values = np.log(self.p_values)
+        self.scores = aggregation.aggregate_scores(
+            self.log_p_values,
+            aggregates=['harmonic', 'geometric', 'min', 'fisher', 'cauchy']
+        )
+
+    def test_aggregate_scores_match_average_functions(self):
+        p_vals = [0.1, 0.2, 0.3, np.nan]
+        self.assertAlmostEqual(self.scores['harmonic'][0], _.neg_log(_.harmonic_average(p_vals)))
+        self.assertAlmostEqual(self.scores['geometric'][0], _.neg_log(_.geometric_average(p_vals)))
+        self.assertAlmostEqual(self.scores['min'][0], _.neg_log(0.1))
+
+    def test_aggregate_scores_are_inf_if_zero_p_val(self):
+        for aggregate in ['harmonic', 'geometric', 'min', 'fisher', 'cauchy']:
+            self.assertEqual(self.scores[aggregate][1], np.inf)
+
+    def test_aggregate_scores_are_nan_if_all_vals_are_nan(self):
+        for aggregate in ['harmonic', 'geometric', 'min', 'fisher', 'cauchy']:
+            self.assertTrue(np.isnan(self.scores[aggregate][2]))
+
+    def test_fisher_and_cauchy_match_combined_p_values(self):
+        p_vals = [0.1, 0.2, 0.3]
+        cauchy = stats.cauchy.sf(np.mean(np.tan((0.5 - np.array(p_vals)) * np.pi)))
+        self.assertAlmostEqual(
+            self.scores['fisher'][0],
+            -np.log(stats.combine_pvalues(p_vals, method='fisher').pvalue)
+        )
+        self.assertAlmostEqual(self.scores['cauchy'][0], -np.log(cauchy))
+
+    def test_aggregate_scores_reduce_each_segment(self):
+        scores = aggregation.aggregate_scores(self.log_p_values, np.array([0, 2, 2, 4]), aggregates=['min'])
+        self.assertEqual(scores['min'].shape, (3, 3))
+        self.assertAlmostEqual(scores['min'][0, 0], _.neg_log(0.1))
+        self.assertTrue(np.isnan(scores['min'][1]).all())
+        self.assertAlmostEqual(scores['min'][2, 1], _.neg_log(0.1))
+
+    def test_aggregate_scores_of_float32_log_p_values_match_float64(self):
+        aggregates = ['harmonic', 'geometric', 'min', 'fisher', 'cauchy']
+        scores = aggregation.aggregate_scores(self.log_p_values.astype(np.float32), aggregates=aggregates)
+        for aggregate in aggregates:
+            self.assertEqual(scores[aggregate].dtype, np.float64)
+            np.testing.assert_allclose(scores[aggregate], self.scores[aggregate], rtol=1e-6)
+
+    def test_validate_aggregates_raises_error_if_aggregate_not_available(self):
+        with self.assertRaises(ValueError):
+            aggregation.validate_aggregates(['harmonic', 'nonexistent'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import unittest
+import sys
+
+import numpy as np
+import pandas as pd
+
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pathway_assessor as _
+from pathway_assessor import batched
+
+
+class TestBatched(unittest.TestCase):
+
+    def setUp(self):
+
+        self.test_dir = os.path.dirname(os.path.abspath(__file__))
+        self.expression_table_f = '{}/expression_table.tsv'.format(self.test_dir)
+        self.expression_table_unprocessed = pd.read_csv(self.expression_table_f, sep='\t', header=0, index_col=0)
+
+        self.expression_table = _.processed_expression_table(self.expression_table_unprocessed)
+        self.expression_ranks = _.expression_ranks(self.expression_table, ascending=True)
+        self.bg_genes = _.bg_genes(self.expression_ranks)
+
+        self.user_pathway_f = '{}/user_pathways.txt'.format(self.test_dir)
+        self.user_pathway_db, _pw_data = _.user_pathways(self.user_pathway_f)
+        self.user_pathway_db['Missing_pathway'] = {'NOT_A_GENE'}
+
+    def test_membership_matrix_drops_missing_and_duplicate_genes(self):
+        membership = batched.membership_matrix(
+            {'pathway': ['SLC2A6', 'PIKFYVE', 'SLC2A6', 'NOT_A_GENE'], 'empty': []},
+            self.expression_ranks.index
+        )
+        self.assertEqual(membership.shape, (2, len(self.expression_ranks.index)))
+        self.assertEqual(
+            sorted(self.expression_ranks.index[membership[0].indices]),
+            ['PIKFYVE', 'SLC2A6']
+        )
+        self.assertEqual(membership[1].nnz, 0)
+
+    def test_segment_ranks_match_dataframe_rank_within_each_segment(self):
+        values = np.array([
+            [3., 1.],
+            [1., np.nan],
+            [3., 2.],
+            [2., 2.],
+            [5., np.nan],
+            [5., 4.],
+        ])
+        segments = np.array([0, 0, 0, 1, 1, 1])
+        for rank_method in ['average', 'min', 'max', 'first', 'dense']:
+            expected = np.vstack([
+                pd.DataFrame(values[:3]).rank(method=rank_method).values,
+                pd.DataFrame(values[3:]).rank(method=rank_method).values,
+            ])
+            np.testing.assert_array_equal(
+                batched.segment_ranks(values, segments, rank_method=rank_method),
+                expected
+            )
+
+    def test_segment_ranks_both_match_dataframe_rank_in_both_directions(self):
+        values = np.array([
+            [3., 1.],
+            [1., np.nan],
+            [3., 2.],
+            [2., 2.],
+            [5., np.nan],
+            [5., 4.],
+            [2., 4.],
+        ])
+        segments = np.array([0, 0, 0, 1, 1, 1, 1])
+        for rank_method in ['average', 'min', 'max', 'first', 'dense']:
+            ascending, descending = batched.segment_ranks_both(values, segments, rank_method=rank_method)
+            for ranks, direction in [(ascending, True), (descending, False)]:
+                expected = np.vstack([
+                    pd.DataFrame(values[:3]).rank(method=rank_method, ascending=direction).values,
+                    pd.DataFrame(values[3:]).rank(method=rank_method, ascending=direction).values,
+                ])
+                np.testing.assert_array_equal(ranks, expected)
+
+    def test_single_precision_segment_ranks_are_compact_with_zero_for_missing(self):
+        values = np.array([
+            [3., 1.],
+            [1., np.nan],
+            [3., 2.],
+            [2., 2.],
+            [5., np.nan],
+            [5., 4.],
+        ])
+        segments = np.array([0, 0, 0, 1, 1, 1])
+        for rank_method in ['average', 'min', 'max', 'first', 'dense']:
+            expected = np.nan_to_num(batched.segment_ranks(values, segments, rank_method=rank_method))
+            ranks = batched.segment_ranks(values, segments, rank_method=rank_method, precision='single')
+            self.assertEqual(ranks.dtype, batched.rank_dtype(rank_method, 'single'))
+            np.testing.assert_array_equal(ranks, expected)
+            for single, double in zip(
+                batched.segment_ranks_both(values, segments, rank_method=rank_method, precision='single'),
+                batched.segment_ranks_both(values, segments, rank_method=rank_method)
+            ):
+                np.testing.assert_array_equal(single, np.nan_to_num(double))
+
+    def test_segment_ranks_tell_apart_near_equal_values(self):
+        values = np.array([
+            [-1e6, 0.5],
+            [0.1, 1e9],
+            [0.1 + 1e-11, np.nan],
+            [0.2, 1e9 + 1e-6],
+            [0.1, 3.],
+            [0.1 + 1e-11, 3.],
+            [1e12, np.nan],
+        ])
+        for segments in [np.zeros(7, dtype=int), np.array([0, 0, 0, 0, 1, 1, 1])]:
+            for rank_method in ['average', 'min', 'max', 'first', 'dense']:
+                expected = np.vstack([
+                    pd.DataFrame(values[segments == segment]).rank(method=rank_method).values
+                    for segment in np.unique(segments)
+                ])
+                ranks = batched.segment_ranks(values, segments, rank_method=rank_method)
+                np.testing.assert_array_equal(ranks, expected)
+                ascending, descending = batched.segment_ranks_both(values, segments, rank_method=rank_method)
+                np.testing.assert_array_equal(ascending, expected)
+        np.testing.assert_array_equal(
+            batched.segment_ranks(values[:4, :1], np.zeros(4, dtype=int), rank_method='max')[:, 0], [1, 2, 3, 4]
+        )
+
+    def test_segment_ranks_raises_error_if_rank_method_not_available(self):
+        with self.assertRaises(ValueError):
+            batched.segment_ranks(np.ones((2, 1)), np.array([0, 0]), rank_method='nonexistent')
+
+    def test_unique_membership_scores_each_gene_set_once(self):
+        membership = batched.membership_matrix(
+            {'a': ['PIKFYVE', 'SLC2A6'], 'b': ['SLC2A6', 'PIKFYVE', 'NOT_A_GENE'], 'c': ['PHOSPHO1'], 'd': [], 'e': []},
+            self.expression_ranks.index
+        )
+        unique, inverse = batched.unique_membership(membership)
+        self.assertEqual(unique.shape[0], 3)
+        np.testing.assert_array_equal(inverse, [0, 0, 1, 2, 2])
+        np.testing.assert_array_equal(unique[inverse].toarray(), membership.toarray())
+
+    def test_pathway_blocks_respect_cell_budget(self):
+        indptr = np.array([0, 2, 4, 10, 11])
+        self.assertEqual(batched.pathway_blocks(indptr, 2, max_cells=8), [(0, 2), (2, 3), (3, 4)])
+
+    def test_pathway_scores_match_per_pathway_scores(self):
+        membership = batched.membership_matrix(self.user_pathway_db, self.expression_ranks.index)
+        scores = batched.pathway_scores(
+            self.expression_ranks.values,
+            self.bg_genes.values,
+            membership,
+            _.hypergeom_p_values,
+            max_cells=4
+        )
+        expected = _.all(self.expression_table, pathways=self.user_pathway_db, batched=False)
+        np.testing.assert_allclose(scores['harmonic'], expected['harmonic'].values, rtol=1e-12)
+        np.testing.assert_allclose(scores['geometric'], expected['geometric'].values, rtol=1e-12)
+        np.testing.assert_allclose(scores['min'], expected['min_p_val'].values, rtol=1e-12)
+        self.assertTrue(np.isnan(scores['harmonic'][-1]).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
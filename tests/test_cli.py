@@ -0,0 +1,131 @@
+import unittest
+import contextlib
+import importlib.util
+import io
+import json
+import sys
+import tempfile
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pathway_assessor as _
+from pathway_assessor import cli
+
+
+class TestCli(unittest.TestCase):
+
+    def setUp(self):
+
+        self.test_dir = os.path.dirname(os.path.abspath(__file__))
+        self.expression_table_f = '{}/expression_table.tsv'.format(self.test_dir)
+        self.expression_table = pd.read_csv(self.expression_table_f, sep='\t', header=0, index_col=0)
+
+        self.user_pathway_f = '{}/user_pathways.txt'.format(self.test_dir)
+        self.user_pathway_db, _pw_data = _.user_pathways(self.user_pathway_f)
+        self.expected = _.all(self.expression_table.copy(), pathways=self.user_pathway_db, direction='both')
+        self.out_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.out_dir.cleanup()
+
+    def write_manifest(self, **manifest):
+        manifest = dict({
+            'cohorts': {'cohort_a': self.expression_table_f},
+            'dbs': [self.user_pathway_f],
+            'directions': ['suppression', 'activation'],
+            'output_dir': os.path.join(self.out_dir.name, 'scores'),
+        }, **manifest)
+        manifest_f = os.path.join(self.out_dir.name, 'manifest.json')
+        with open(manifest_f, 'w') as f:
+            json.dump(manifest, f)
+        return manifest_f
+
+    def assertTsvScoresEqual(self, files):
+        for f in files:
+            direction, stat = os.path.splitext(os.path.basename(f))[0].split('_', 1)
+            scores = pd.read_csv(f, sep='\t', index_col=0, float_precision='round_trip')
+            pd.testing.assert_frame_equal(scores, self.expected[direction][stat], check_names=False)
+
+    def test_run_manifest_matches_all(self):
+        files = cli.run_manifest(self.write_manifest())
+        self.assertEqual(list(files), ['cohort_a'])
+        self.assertEqual(list(files['cohort_a']), ['user_pathways'])
+        self.assertEqual(len(files['cohort_a']['user_pathways']), 6)
+        self.assertTsvScoresEqual(files['cohort_a']['user_pathways'])
+
+    def test_dbs_are_scored_in_one_pass(self):
+        other_f = os.path.join(self.out_dir.name, 'other_pathways.txt')
+        with open(self.user_pathway_f) as f_in, open(other_f, 'w') as f_out:
+            f_out.write(f_in.read())
+        with _.Profiler() as profiler:
+            files = cli.run_manifest(self.write_manifest(dbs=[self.user_pathway_f, other_f]))
+        self.assertEqual(list(files['cohort_a']), ['user_pathways', 'other_pathways'])
+        for db_files in files['cohort_a'].values():
+            self.assertTsvScoresEqual(db_files)
+        self.assertEqual((profiler.counts['pathways'], profiler.counts['unique_pathways']), (8, 2))
+
+    def test_memory_budget_scores_samples_in_chunks(self):
+        manifest = cli.load_manifest(self.write_manifest())
+        manifest['memory_budget'] = cli.job_bytes + 100 * cli.cohort_cell_bytes
+        self.assertEqual(cli.chunk_size(100, 3, manifest['memory_budget']), 1)
+        files = cli.run_manifest(manifest)
+        self.assertTsvScoresEqual(files['cohort_a']['user_pathways'])
+
+    def test_workers_score_cohorts_in_processes(self):
+        manifest_f = self.write_manifest(
+            cohorts={'cohort_a': self.expression_table_f, 'cohort_b': self.expression_table_f},
+            directions=['activation'],
+            workers=2,
+            memory_budget='64G'
+        )
+        files = cli.run_manifest(manifest_f)
+        self.assertEqual(list(files), ['cohort_a', 'cohort_b'])
+        for cohort_files in files.values():
+            self.assertTsvScoresEqual(cohort_files['user_pathways'])
+
+    def test_npz_output(self):
+        files = cli.run_manifest(self.write_manifest(output_format='npz'))
+        with np.load(files['cohort_a']['user_pathways'][0]) as scores:
+            self.assertEqual(list(scores['samples']), list(self.expression_table.columns))
+            self.assertEqual(list(scores['pathways']), list(self.user_pathway_db))
+            np.testing.assert_array_equal(scores['activation_harmonic'], self.expected['activation']['harmonic'].values)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_parquet_output(self):
+        files = cli.run_manifest(self.write_manifest(output_format='parquet'))
+        for f in files['cohort_a']['user_pathways']:
+            direction, stat = os.path.splitext(os.path.basename(f))[0].split('_', 1)
+            pd.testing.assert_frame_equal(pd.read_parquet(f), self.expected[direction][stat], check_names=False)
+
+    def test_parquet_output_raises_error_without_pyarrow(self):
+        manifest_f = self.write_manifest(output_format='parquet')
+        with mock.patch.object(cli.importlib.util, 'find_spec', return_value=None):
+            self.assertRaises(ImportError, cli.run_manifest, manifest_f)
+
+    def test_main_overrides_manifest_and_prints_files(self):
+        manifest_f = self.write_manifest()
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            cli.main([manifest_f, '--output-format', 'npz', '--memory-budget', '4G'])
+        expected_f = os.path.join(self.out_dir.name, 'scores', 'cohort_a', 'user_pathways.npz')
+        self.assertEqual(stdout.getvalue().split(), [expected_f])
+
+    def test_parse_memory(self):
+        self.assertEqual(cli.parse_memory('512M'), 512 * 2 ** 20)
+        self.assertEqual(cli.parse_memory('1.5GiB'), int(1.5 * 2 ** 30))
+        self.assertEqual(cli.parse_memory(1024), 1024)
+        self.assertRaises(ValueError, cli.parse_memory, 'lots')
+
+    def test_manifest_raises_error_if_key_not_available(self):
+        self.assertRaises(ValueError, cli.load_manifest, self.write_manifest(cohort={}))
+        self.assertRaises(ValueError, cli.run_manifest, self.write_manifest(directions=['up']))
+        self.assertRaises(ValueError, cli.run_manifest, self.write_manifest(settings={'ascending': True}))
+
+
+if __name__ == '__main__':
+    unittest.main()
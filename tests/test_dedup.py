@@ -0,0 +1,67 @@
+import unittest
+import sys
+
+import numpy as np
+import pandas as pd
+
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pathway_assessor as _
+from pathway_assessor import dedup
+
+
+class TestDedup(unittest.TestCase):
+
+    def setUp(self):
+
+        self.expression_table = pd.DataFrame(
+            [
+                [5., 1., np.nan],
+                [1., np.nan, np.nan],
+                [3., 2., 2.],
+                [2., 6., np.nan],
+                [4., 4., 1.],
+                [7., 8., 9.],
+                [0., 0., 0.],
+            ],
+            index=pd.Index(['TP53', 'BRCA1', 'TP53', 'EGFR', 'TP53', None, 'BRCA1']),
+            columns=['s1', 's2', 's3']
+        )
+
+    def test_mean_and_median_match_groupby(self):
+        for method in ['mean', 'median']:
+            expected = getattr(self.expression_table.rename_axis('genes').groupby('genes'), method)()
+            pd.testing.assert_frame_equal(_.processed_expression_table(self.expression_table, dedup=method), expected)
+
+    def test_max_variance_keeps_most_variable_row(self):
+        table = _.processed_expression_table(self.expression_table, dedup='max_variance')
+        self.assertEqual(list(table.index), ['BRCA1', 'EGFR', 'TP53'])
+        np.testing.assert_array_equal(table.loc['TP53'].values, [5., 1., np.nan])
+        # the single-valued row has no variance, so the other BRCA1 row wins
+        np.testing.assert_array_equal(table.loc['BRCA1'].values, [0., 0., 0.])
+
+    def test_unique_index_skips_aggregation(self):
+        table = self.expression_table.iloc[[0, 1, 3]].fillna(0).astype(int)
+        deduplicated = _.processed_expression_table(table)
+        pd.testing.assert_frame_equal(deduplicated, table.rename_axis('genes').groupby('genes').mean())
+        self.assertIsNone(table.index.name)
+
+    def test_sort_false_keeps_order_of_first_appearance(self):
+        table = _.processed_expression_table(self.expression_table, sort=False)
+        self.assertEqual(list(table.index), ['TP53', 'BRCA1', 'EGFR'])
+        pd.testing.assert_frame_equal(table.sort_index(), _.processed_expression_table(self.expression_table))
+
+    def test_prepared_expression_shares_gene_index(self):
+        prepared = _.PreparedExpression(self.expression_table, dedup='median')
+        self.assertIs(prepared.expression_ranks().index, prepared.genes)
+        self.assertIs(dedup.gene_index(prepared.genes), prepared.genes)
+        self.assertEqual(prepared.expression_table_df.loc['TP53', 's1'], 4.)
+
+    def test_dedup_raises_error_if_method_not_available(self):
+        with self.assertRaises(ValueError):
+            _.processed_expression_table(self.expression_table, dedup='first')
+
+
+if __name__ == '__main__':
+    unittest.main()
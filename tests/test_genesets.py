@@ -0,0 +1,94 @@
+import unittest
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pathway_assessor as _
+from pathway_assessor import batched, genesets
+
+
+class TestGeneSets(unittest.TestCase):
+
+    def setUp(self):
+
+        self.test_dir = os.path.dirname(os.path.abspath(__file__))
+        self.expression_table_f = '{}/expression_table.tsv'.format(self.test_dir)
+        self.expression_table = pd.read_csv(self.expression_table_f, sep='\t', header=0, index_col=0)
+
+        self.user_pathway_f = '{}/user_pathways.txt'.format(self.test_dir)
+        self.user_pathway_db, _pw_data = _.user_pathways(self.user_pathway_f)
+        self.out_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.out_dir.cleanup()
+
+    def test_compiled_user_pathways_round_trip(self):
+        _.compile_gene_sets(self.user_pathway_f, self.out_dir.name)
+        gene_sets = _.load_gene_sets(self.out_dir.name)
+        self.assertIsInstance(gene_sets.indices, np.memmap)
+        self.assertIs(_.load_gene_sets(self.out_dir.name), gene_sets)
+        self.assertEqual(list(gene_sets.names), list(self.user_pathway_db))
+        self.assertDictEqual(genesets.gene_sets_dict(gene_sets), self.user_pathway_db)
+
+    def test_read_gene_set_file_reads_gmt_and_tsv(self):
+        gmt_f = os.path.join(self.out_dir.name, 'pathways.gmt')
+        with open(gmt_f, 'w') as f:
+            f.write('first\thttp://example.org\tA\tB\tA\nsecond\t\tC\n')
+        self.assertDictEqual(genesets.read_gene_set_file(gmt_f), {'first': {'A', 'B'}, 'second': {'C'}})
+
+        tsv_f = os.path.join(self.out_dir.name, 'pathways.tsv')
+        with open(tsv_f, 'w') as f:
+            f.write('first\tA\tB\n')
+        self.assertDictEqual(genesets.read_gene_set_file(tsv_f), {'first': {'A', 'B'}})
+        with self.assertRaises(ValueError):
+            genesets.read_gene_set_file(tsv_f, file_format='xml')
+
+    def test_included_dbs_match_pathway_dicts(self):
+        for db in ['hallmark', 'wikipathways']:
+            gene_sets = _.db_pathways(db)
+            self.assertDictEqual(_.db_pathways_dict(db), genesets.gene_sets_dict(gene_sets))
+        wikipathways = genesets.read_gene_set_file(
+            os.path.join(os.path.dirname(self.test_dir), 'pathway_tables', 'wikipathways.tsv')
+        )
+        self.assertDictEqual(_.db_pathways_dict('wikipathways'), wikipathways)
+
+    def test_gene_sets_membership_matches_membership_matrix(self):
+        gene_sets = _.db_pathways('kegg')
+        genes = self.expression_table.index.drop_duplicates()
+        expected = batched.membership_matrix(_.db_pathways_dict('kegg'), genes)
+        membership = genesets.gene_sets_membership(gene_sets, genes)
+        np.testing.assert_array_equal(membership.indptr, expected.indptr)
+        np.testing.assert_array_equal(membership.indices, expected.indices)
+
+    def test_combined_gene_sets_score_like_each_db(self):
+        user_gene_sets = genesets.gene_sets_from_dict(self.user_pathway_db)
+        gene_sets = [_.db_pathways('hallmark'), user_gene_sets]
+        combined = _.combine_gene_sets(gene_sets)
+        self.assertEqual(list(combined.genes), sorted(set(combined.genes)))
+        expected = genesets.gene_sets_dict(gene_sets[0])
+        expected.update(genesets.gene_sets_dict(user_gene_sets))
+        self.assertDictEqual(genesets.gene_sets_dict(combined), expected)
+
+        results = _.all(self.expression_table, pathways=combined)
+        n_hallmark = len(gene_sets[0].names)
+        pd.testing.assert_frame_equal(
+            results['harmonic'].iloc[n_hallmark:], _.all(self.expression_table, pathways=user_gene_sets)['harmonic']
+        )
+
+    def test_all_accepts_compiled_gene_sets(self):
+        _.compile_gene_sets(self.user_pathway_db, self.out_dir.name)
+        gene_sets = _.load_gene_sets(self.out_dir.name)
+        expected = _.all(self.expression_table, pathways=self.user_pathway_db)
+        for batched_pass in [True, False]:
+            results = _.all(self.expression_table, pathways=gene_sets, batched=batched_pass)
+            for stat in ['harmonic', 'geometric', 'min_p_val']:
+                pd.testing.assert_frame_equal(results[stat], expected[stat])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import sys
+import tempfile
+
+import pandas as pd
+
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pathway_assessor as _
+
+
+class TestIncremental(unittest.TestCase):
+
+    def setUp(self):
+
+        self.test_dir = os.path.dirname(os.path.abspath(__file__))
+        self.expression_table_f = '{}/expression_table.tsv'.format(self.test_dir)
+        self.expression_table = pd.read_csv(self.expression_table_f, sep='\t', header=0, index_col=0)
+
+        self.user_pathway_f = '{}/user_pathways.txt'.format(self.test_dir)
+        self.user_pathway_db, _pw_data = _.user_pathways(self.user_pathway_f)
+        self.score_set = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.score_set.cleanup()
+
+    def update(self, expression_table, **kwargs):
+        return _.update_scores(expression_table.copy(), self.score_set.name, pathways=self.user_pathway_db, **kwargs)
+
+    def test_update_scores_only_new_samples_and_matches_all(self):
+        first = self.update(self.expression_table[['Sample_A']])
+        self.assertEqual(first.new_samples, ['Sample_A'])
+        self.assertTrue(first.recomputed)
+
+        update = self.update(self.expression_table)
+        self.assertEqual(update.new_samples, ['Sample_B', 'Sample_C'])
+        self.assertFalse(update.recomputed)
+        self.assertEqual(self.update(self.expression_table).new_samples, [])
+
+        expected = _.all(self.expression_table.copy(), pathways=self.user_pathway_db)
+        saved, _score_set = _.load_score_set(self.score_set.name)
+        for stat in ['harmonic', 'geometric', 'min_p_val']:
+            pd.testing.assert_frame_equal(update.results[stat], expected[stat])
+            pd.testing.assert_frame_equal(saved[stat], expected[stat])
+
+    def test_update_scores_with_both_directions(self):
+        self.update(self.expression_table[['Sample_A', 'Sample_B']], direction='both', geometric=False)
+        update = self.update(self.expression_table, direction='both', geometric=False)
+        expected = _.all(self.expression_table.copy(), pathways=self.user_pathway_db, ascending=False, geometric=False)
+        self.assertIsNone(update.results['activation']['geometric'])
+        pd.testing.assert_frame_equal(update.results['activation']['harmonic'], expected['harmonic'])
+
+    def test_changed_gene_universe_forces_full_recompute(self):
+        self.update(self.expression_table[['Sample_A', 'Sample_B']])
+        expression_table = self.expression_table.copy()
+        expression_table.loc['NOT_A_GENE'] = 1.
+
+        with self.assertRaises(ValueError):
+            self.update(expression_table[['Sample_C']])
+        update = self.update(expression_table)
+        self.assertTrue(update.recomputed)
+        self.assertEqual(update.new_samples, ['Sample_A', 'Sample_B', 'Sample_C'])
+
+    def test_changed_settings_force_full_recompute(self):
+        self.update(self.expression_table)
+        self.assertTrue(self.update(self.expression_table, rank_method='min').recomputed)
+        self.assertEqual(
+            _.gene_universe_fingerprint(self.expression_table),
+            _.gene_universe_fingerprint(self.expression_table.iloc[::-1])
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import unittest
+import importlib.util
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pathway_assessor as _
+from pathway_assessor import batched, jit
+
+
+class TestJit(unittest.TestCase):
+
+    def setUp(self):
+
+        self.test_dir = os.path.dirname(os.path.abspath(__file__))
+        self.expression_table_f = '{}/expression_table.tsv'.format(self.test_dir)
+        self.expression_table = pd.read_csv(self.expression_table_f, sep='\t', header=0, index_col=0)
+
+        self.user_pathway_f = '{}/user_pathways.txt'.format(self.test_dir)
+        self.user_pathway_db, _pw_data = _.user_pathways(self.user_pathway_f)
+
+    def test_log_sf_matches_hypergeom_log_sf(self):
+        tables = np.array([
+            [0, 0, 0, 0], [3, 0, 0, 5], [1, 4, 2, 30], [12, 1, 0, 900], [5, 5, 5, 5], [40, 200, 3, 17000]
+        ])
+        expected = _.hypergeom_log_sf(*tables.T)
+        for table, log_sf in zip(tables, expected):
+            self.assertAlmostEqual(jit.log_sf(*(int(count) for count in table)), log_sf, delta=1e-9 * abs(log_sf))
+
+    def test_within_ranks_match_segment_ranks(self):
+        values = np.array([3., 1., 3., 2., 7., 1.])
+        ranks = np.empty(len(values))
+        for rank_method in batched.rank_methods:
+            jit.within_ranks(values, len(values), batched.rank_methods.index(rank_method), ranks)
+            expected = batched.segment_ranks(values[:, None], np.zeros(len(values), dtype=int), rank_method=rank_method)
+            np.testing.assert_array_equal(ranks, expected[:, 0])
+
+    # runs as plain Python when numba is not installed
+    def test_kernel_scores_match_batched_pass(self):
+        prepared = _.PreparedExpression(self.expression_table)
+        membership = _.pathway_membership(self.user_pathway_db, prepared.genes)
+        aggregates = ['harmonic', 'geometric', 'min', 'fisher', 'cauchy']
+        for rank_method in ['max', 'average']:
+            for log_p in [False, True]:
+                ranks = prepared.expression_ranks(rank_method=rank_method)
+                scores = jit.jit_pathway_scores(
+                    ranks.values, prepared.bg_genes.values, membership, rank_method, aggregates, log_p
+                )
+                expected = batched.pathway_scores(
+                    ranks.values, prepared.bg_genes.values, membership,
+                    _.p_value_function('hypergeom', log_p), rank_method, aggregates, log_p
+                )
+                for aggregate in aggregates:
+                    np.testing.assert_allclose(scores[aggregate], expected[aggregate], rtol=1e-9)
+
+    @unittest.skipUnless(importlib.util.find_spec('numba'), 'numba is not installed')
+    def test_numba_backend_matches_numpy_backend(self):
+        for direction in [None, 'both']:
+            results = _.all(self.expression_table, pathways=self.user_pathway_db, direction=direction, backend='numba')
+            expected = _.all(self.expression_table, pathways=self.user_pathway_db, direction=direction)
+            for key in (['suppression', 'activation'] if direction else [None]):
+                for stat in ['harmonic', 'geometric', 'min_p_val']:
+                    np.testing.assert_allclose(
+                        (results[key] if key else results)[stat].values,
+                        (expected[key] if key else expected)[stat].values,
+                        rtol=1e-9
+                    )
+
+    # worker processes must not be forked from a process whose numba threads have run
+    @unittest.skipUnless(importlib.util.find_spec('numba'), 'numba is not installed')
+    def test_process_pool_runs_after_numba_backend(self):
+        results = _.harmonic(self.expression_table, pathways=self.user_pathway_db, backend='numba')
+        expected = _.harmonic(self.expression_table, pathways=self.user_pathway_db, n_jobs=2)
+        pd.testing.assert_frame_equal(results, expected, rtol=1e-9)
+
+    # before Python 3.10 the process hung at exit when the fork server started after numba's threads; the
+    # script is started with posix_spawn (close_fds=False, no cwd) so that this process does not fork either
+    @unittest.skipUnless(importlib.util.find_spec('numba'), 'numba is not installed')
+    def test_process_exits_after_numba_backend_and_process_pool(self):
+        script = '\n'.join([
+            'import sys',
+            'sys.path.insert(0, {!r})'.format(os.path.dirname(self.test_dir)),
+            'import pandas as pd',
+            'import pathway_assessor as _',
+            'expression_table = pd.read_csv({!r}, sep="\\t", header=0, index_col=0)'.format(self.expression_table_f),
+            'pathways = {!r}'.format(self.user_pathway_db),
+            '_.harmonic(expression_table, pathways=pathways, backend="numba")',
+            '_.harmonic(expression_table, pathways=pathways, n_jobs=2)',
+        ])
+        subprocess.run(
+            [sys.executable, '-c', script], close_fds=False, check=True, timeout=120, stdout=subprocess.DEVNULL
+        )
+
+    def test_backend_is_passed_through_permutation_all(self):
+        results = _.permutation_all(
+            self.expression_table, pathways=self.user_pathway_db, n_permutations=20, backend='numba'
+        )
+        expected = _.permutation_all(self.expression_table, pathways=self.user_pathway_db, n_permutations=20)
+        for key in ['harmonic', 'harmonic_empirical_p', 'harmonic_z']:
+            pd.testing.assert_frame_equal(results[key], expected[key], rtol=1e-9)
+
+    def test_numba_backend_falls_back_to_numpy_without_numba(self):
+        numba = jit.numba
+        jit.numba = None
+        try:
+            with self.assertLogs('pathway_assessor', level='WARNING'):
+                results = _.harmonic(self.expression_table, pathways=self.user_pathway_db, backend='numba')
+        finally:
+            jit.numba = numba
+        pd.testing.assert_frame_equal(results, _.harmonic(self.expression_table, pathways=self.user_pathway_db))
+
+    def test_backend_raises_error_if_option_not_available(self):
+        with self.assertRaises(ValueError):
+            _.all(self.expression_table, pathways=self.user_pathway_db, backend='cuda')
+        for options in [{'batched': False}, {'p_value_method': 'fisher'}, {'n_jobs': 2}]:
+            with self.assertRaises(ValueError):
+                _.all(self.expression_table, pathways=self.user_pathway_db, backend='numba', **options)
+        with self.assertRaises(ValueError):
+            _.all(
+                self.expression_table.astype(pd.SparseDtype(float, 0.)), pathways=self.user_pathway_db, backend='numba'
+            )
+        with self.assertRaises(ValueError):
+            _.array_scores(sparse.csc_matrix(self.expression_table.values), [np.arange(5)], backend='numba')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pathway_assessor as _
+from pathway_assessor import parallel
+
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+
+        self.test_dir = os.path.dirname(os.path.abspath(__file__))
+        self.expression_table_f = '{}/expression_table.tsv'.format(self.test_dir)
+        self.expression_table = pd.read_csv(self.expression_table_f, sep='\t', header=0, index_col=0)
+        self.user_pathway_f = '{}/user_pathways.txt'.format(self.test_dir)
+        self.user_pathway_db, _pw_data = _.user_pathways(self.user_pathway_f)
+        self.serial = _.all(self.expression_table, pathways=self.user_pathway_db)
+
+    def assertScoresEqual(self, results):
+        for stat in ['harmonic', 'geometric', 'min_p_val']:
+            pd.testing.assert_frame_equal(results[stat], self.serial[stat])
+
+    def test_process_pool_results_are_identical_to_serial(self):
+        results = _.all(self.expression_table, pathways=self.user_pathway_db, n_jobs=2)
+        self.assertScoresEqual(results)
+
+    def test_given_executor_results_are_identical_to_serial(self):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = _.all(self.expression_table, pathways=self.user_pathway_db, executor=executor)
+        self.assertScoresEqual(results)
+
+    def test_pa_stats_accepts_n_jobs(self):
+        results = _.min_p_val(self.expression_table, pathways=self.user_pathway_db, n_jobs=2)
+        pd.testing.assert_frame_equal(results, self.serial['min_p_val'])
+
+    def test_process_pool_results_for_both_directions_are_identical_to_serial(self):
+        serial = _.all(self.expression_table, pathways=self.user_pathway_db, direction='both')
+        results = _.all(self.expression_table, pathways=self.user_pathway_db, direction='both', n_jobs=2)
+        for direction in ['suppression', 'activation']:
+            for stat in ['harmonic', 'geometric', 'min_p_val']:
+                pd.testing.assert_frame_equal(results[direction][stat], serial[direction][stat])
+
+    def test_process_pool_single_precision_results_are_identical_to_serial(self):
+        for direction in [None, 'both']:
+            serial = _.all(
+                self.expression_table, pathways=self.user_pathway_db, direction=direction, precision='single'
+            )
+            results = _.all(
+                self.expression_table, pathways=self.user_pathway_db, direction=direction, precision='single', n_jobs=2
+            )
+            for key in (['suppression', 'activation'] if direction else [None]):
+                for stat in ['harmonic', 'geometric', 'min_p_val']:
+                    expected = serial[key][stat] if key else serial[stat]
+                    pd.testing.assert_frame_equal(results[key][stat] if key else results[stat], expected)
+
+    def test_pathway_sample_tasks_cover_every_pathway_and_sample_once(self):
+        indptr = np.array([0, 3, 5, 9, 10])
+        tasks = parallel.pathway_sample_tasks(indptr, 5, 2, max_cells=12)
+        covered = np.zeros((4, 5), dtype=int)
+        for (start, stop), (first, last) in tasks:
+            covered[start:stop, first:last] += 1
+        self.assertTrue((covered == 1).all())
+
+    def test_validate_n_jobs_raises_error_if_n_jobs_is_invalid(self):
+        self.assertTrue(parallel.validate_n_jobs(-1))
+        with self.assertRaises(ValueError):
+            parallel.validate_n_jobs(0)
+        with self.assertRaises(ValueError):
+            _.all(self.expression_table, pathways=self.user_pathway_db, batched=False, n_jobs=2)
+
+    def test_p_value_cache_raises_error_with_n_jobs_or_executor(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for options in [{'n_jobs': 2}, {'executor': executor}]:
+                for function in [_.all, _.harmonic]:
+                    with self.assertRaises(ValueError):
+                        function(
+                            self.expression_table, pathways=self.user_pathway_db, p_value_cache=_.PValueCache(),
+                            **options
+                        )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import math
 import unittest
 import sys
 
@@ -164,6 +165,33 @@ class TestPathwayAssessor(unittest.TestCase):
         self.assertTrue(np.isnan(self.sample_2x2['Sample_C'].to_dict()['PHOSPHO1']).all())
 
 
+    def test_contingency_tables_returns_int32_counts_with_missing_mask(self):
+        contingency = _.contingency_tables(self.pathway_ranks, self.b, self.c, self.d)
+        genes = list(contingency.genes)
+        samples = list(contingency.samples)
+        self.assertEqual(contingency.tables.dtype, np.int32)
+        self.assertEqual(contingency.tables.shape, (len(genes), len(samples), 4))
+        self.assertEqual(
+            contingency.tables[genes.index('SLC2A6'), samples.index('Sample_A')].tolist(),
+            [2, 2, 1, 95]
+        )
+        self.assertTrue(contingency.missing[genes.index('PHOSPHO1'), samples.index('Sample_C')])
+        self.assertEqual(contingency.missing.sum(), 1)
+
+    def test_contingency_to_sample_2x2_matches_sample_2x2(self):
+        contingency = _.contingency_tables(self.pathway_ranks, self.b, self.c, self.d)
+        converted = _.contingency_to_sample_2x2(contingency)
+        for sample in ['Sample_A', 'Sample_B']:
+            self.assertEqual(converted[sample].to_dict(), self.sample_2x2[sample].to_dict())
+        self.assertEqual(converted['Sample_C'].to_dict()['PIKFYVE'], self.sample_2x2['Sample_C'].to_dict()['PIKFYVE'])
+        self.assertTrue(np.isnan(converted['Sample_C'].to_dict()['PHOSPHO1']).all())
+
+    def test_contingency_p_values_match_p_values(self):
+        contingency = _.contingency_tables(self.pathway_ranks, self.b, self.c, self.d)
+        p_values = _.contingency_p_values(contingency)
+        expected = self.p_values.reindex(index=contingency.genes, columns=contingency.samples).values
+        np.testing.assert_allclose(p_values, expected, rtol=1e-9)
+
     def test_p_values_returns_dict_of_expected_p_values(self):
         expected_dict = {
             'Sample_A': {
@@ -191,6 +219,86 @@ class TestPathwayAssessor(unittest.TestCase):
         self.assertAlmostEqual(sample_c['PIKFYVE'], expected_dict['Sample_C']['PIKFYVE'])
         self.assertTrue(pd.isna(sample_c['PHOSPHO1']))
 
+    def test_hypergeom_p_values_match_fisher_exact_p_values(self):
+        p_values = _.hypergeom_p_values(
+            self.pathway_ranks.values,
+            self.b.reindex_like(self.pathway_ranks).values,
+            self.c.reindex_like(self.pathway_ranks).values,
+            self.d.reindex_like(self.pathway_ranks).values
+        )
+        expected = self.p_values.reindex_like(self.pathway_ranks).values
+        np.testing.assert_allclose(p_values, expected, rtol=1e-9)
+        self.assertTrue(np.isnan(p_values[self.pathway_ranks.isna().values]).all())
+
+    def test_hypergeom_p_values_returns_one_for_empty_margin_and_nan_for_missing(self):
+        p_values = _.hypergeom_p_values([0, np.nan], [0, 1], [3, 1], [5, 1])
+        self.assertEqual(p_values[0], 1.0)
+        self.assertTrue(np.isnan(p_values[1]))
+
+    def test_hypergeom_log_sf_is_finite_where_p_values_underflow(self):
+        # all 300 pathway genes ranked first out of 20000: p = 1 / C(20000, 300)
+        expected = -(math.lgamma(20001) - math.lgamma(301) - math.lgamma(19701))
+        self.assertEqual(_.hypergeom_sf(300, 0, 0, 19700), 0)
+        self.assertAlmostEqual(_.hypergeom_log_sf(300, 0, 0, 19700) / expected, 1, places=12)
+
+    def test_hypergeom_log_p_values_match_log_of_fisher_exact_p_values(self):
+        log_p_values = _.hypergeom_log_p_values(
+            self.pathway_ranks.values,
+            self.b.reindex_like(self.pathway_ranks).values,
+            self.c.reindex_like(self.pathway_ranks).values,
+            self.d.reindex_like(self.pathway_ranks).values
+        )
+        expected = np.log(self.p_values.reindex_like(self.pathway_ranks).values)
+        np.testing.assert_allclose(log_p_values, expected, rtol=1e-9)
+
+    def test_unique_hypergeom_log_sf_matches_per_table_evaluation(self):
+        a, b, c, d = np.array([[3, 0, 3, 70000], [1, 2, 1, 0], [2, 5, 2, 1], [10, 4, 10, 2]])
+        expected = _.hypergeom_log_sf(a, b, c, d)
+        np.testing.assert_array_equal(_.unique_hypergeom_log_sf(a, b, c, d), expected)
+        np.testing.assert_array_equal(_.unique_hypergeom_log_sf(a[:3], b[:3], c[:3], d[:3]), expected[:3])
+
+    def test_p_value_cache_counts_hits_and_evicts_least_recently_used(self):
+        cache = _.PValueCache(maxsize=3)
+        a, b, c, d = [3, 0, 3], [1, 2, 1], [2, 5, 2], [10, 4, 10]
+        log_p = _.hypergeom_log_p_values(a, b, c, d, cache=cache)
+        np.testing.assert_array_equal(log_p, _.hypergeom_log_sf(a, b, c, d))
+        self.assertEqual(cache.info(), _.PValueCacheInfo(hits=1, misses=2, maxsize=3, currsize=2))
+
+        _.hypergeom_log_p_values([3, 5], [1, 1], [2, 2], [10, 10], cache=cache)
+        self.assertEqual(cache.info(), _.PValueCacheInfo(hits=2, misses=3, maxsize=3, currsize=3))
+        self.assertEqual(cache.hit_rate(), 2 / 5)
+
+        # the [0, 2, 5, 4] table was used longest ago
+        _.hypergeom_log_p_values([1], [1], [1], [1], cache=cache)
+        _.hypergeom_log_p_values([3, 0], [1, 2], [2, 5], [10, 4], cache=cache)
+        self.assertEqual(cache.info(), _.PValueCacheInfo(hits=3, misses=5, maxsize=3, currsize=3))
+
+    def test_p_value_cache_gives_same_scores(self):
+        cache = _.PValueCache()
+        expected = _.all(self.expression_table, pathways=self.user_pathway_db)
+        for batched in [True, False]:
+            results = _.all(self.expression_table, pathways=self.user_pathway_db, batched=batched, p_value_cache=cache)
+            for stat in ['harmonic', 'geometric', 'min_p_val']:
+                np.testing.assert_allclose(results[stat].values, expected[stat].values, rtol=1e-12)
+        self.assertGreater(cache.info().hits, 0)
+        with self.assertRaises(ValueError):
+            _.harmonic(
+                self.expression_table, pathways=self.user_pathway_db, p_value_method='fisher', p_value_cache=cache
+            )
+
+    def test_pathway_p_values_fisher_method_matches_hypergeom_method(self):
+        hypergeom_p_values = _.pathway_p_values(self.pathway_ranks, self.b, self.c, self.d)
+        fisher_p_values = _.pathway_p_values(self.pathway_ranks, self.b, self.c, self.d, p_value_method='fisher')
+        np.testing.assert_allclose(
+            hypergeom_p_values.values,
+            fisher_p_values.reindex_like(hypergeom_p_values).values,
+            rtol=1e-9
+        )
+
+    def test_pathway_p_values_raises_error_if_method_not_available(self):
+        with self.assertRaises(ValueError):
+            _.pathway_p_values(self.pathway_ranks, self.b, self.c, self.d, p_value_method='nonexistent')
+
     def test_harmonic_average_returns_expected_val(self):
         p_vals = [0.1, 0.2, 0.3, np.nan]
         expected = 0.16363636363636364
@@ -348,6 +456,171 @@ class TestPathwayAssessor(unittest.TestCase):
         self.assertIsNone(results['geometric'])
         self.assertIsNone(results['min_p_val'])
 
+    def test_pathway_assessor_returns_extra_aggregates(self):
+        results = _.all(
+            expression_table=self.expression_table,
+            pathways=self.user_pathway_db,
+            extra_aggregates=['fisher', 'cauchy']
+        )
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results['fisher'].shape, (4, 3))
+        pd.testing.assert_frame_equal(
+            results['cauchy'],
+            _.pa_stats(self.expression_table, mode='cauchy', pathways=self.user_pathway_db)
+        )
+
+    def test_pathway_assessor_loop_matches_batched_results(self):
+        batched = _.all(self.expression_table, pathways=self.user_pathway_db, extra_aggregates=['fisher'])
+        loop = _.all(self.expression_table, pathways=self.user_pathway_db, extra_aggregates=['fisher'], batched=False)
+        for stat in ['harmonic', 'geometric', 'min_p_val', 'fisher']:
+            np.testing.assert_allclose(loop[stat].values, batched[stat].values, rtol=1e-12)
+
+    def test_pathway_assessor_log_p_matches_linear_results(self):
+        linear = _.all(self.expression_table, pathways=self.user_pathway_db)
+        log_space = _.all(self.expression_table, pathways=self.user_pathway_db, log_p=True)
+        log_space_loop = _.all(self.expression_table, pathways=self.user_pathway_db, log_p=True, batched=False)
+        for stat in ['harmonic', 'geometric', 'min_p_val']:
+            np.testing.assert_allclose(log_space[stat].values, linear[stat].values, rtol=1e-9)
+            np.testing.assert_allclose(log_space_loop[stat].values, linear[stat].values, rtol=1e-9)
+
+    def test_single_precision_matches_double_precision(self):
+        for direction in [None, 'both']:
+            double = _.all(
+                self.expression_table, pathways=self.user_pathway_db, direction=direction, log_p=True,
+                extra_aggregates=['fisher', 'cauchy']
+            )
+            single = _.all(
+                self.expression_table, pathways=self.user_pathway_db, direction=direction, log_p=True,
+                extra_aggregates=['fisher', 'cauchy'], precision='single'
+            )
+            for key in (['suppression', 'activation'] if direction else [None]):
+                for stat in ['harmonic', 'geometric', 'min_p_val', 'fisher', 'cauchy']:
+                    expected = double[key][stat] if key else double[stat]
+                    results = single[key][stat] if key else single[stat]
+                    self.assertEqual(results.values.dtype, np.float64)
+                    np.testing.assert_allclose(results.values, expected.values, rtol=1e-4, atol=1e-6)
+
+    def test_precision_raises_error_if_not_available(self):
+        with self.assertRaises(ValueError):
+            _.all(self.expression_table, pathways=self.user_pathway_db, precision='half')
+        with self.assertRaises(ValueError):
+            _.all(self.expression_table, pathways=self.user_pathway_db, precision='single', batched=False)
+
+    def test_pathways_with_the_same_present_genes_share_scores(self):
+        pathways = dict(self.user_pathway_db, alias=self.user_pathway_db['Sample_pathway'] | {'NOT_A_GENE'})
+        for direction in [None, 'both']:
+            results = _.all(self.expression_table, pathways=pathways, direction=direction)
+            expected = _.all(self.expression_table, pathways=self.user_pathway_db, direction=direction)
+            for key in (['suppression', 'activation'] if direction else [None]):
+                for stat in ['harmonic', 'geometric', 'min_p_val']:
+                    scores = results[key][stat] if key else results[stat]
+                    pd.testing.assert_frame_equal(scores.drop('alias'), expected[key][stat] if key else expected[stat])
+                    pd.testing.assert_series_equal(scores.loc['alias'], scores.loc['Sample_pathway'], check_names=False)
+
+    def test_array_scores_match_all_without_labels(self):
+        genes = self.expression_table.index
+        pathway_indices = [genes.get_indexer(list(pathway)) for pathway in self.user_pathway_db.values()]
+        pathway_indices = [indices[indices >= 0] for indices in pathway_indices]
+        for direction in [None, 'activation', 'both']:
+            scores = _.array_scores(self.expression_table.values, pathway_indices, direction=direction)
+            expected = _.all(self.expression_table, pathways=self.user_pathway_db, direction=direction)
+            for key in (['suppression', 'activation'] if direction == 'both' else [None]):
+                for aggregate, stat in [('harmonic', 'harmonic'), ('geometric', 'geometric'), ('min', 'min_p_val')]:
+                    values = scores[key][aggregate] if key else scores[aggregate]
+                    self.assertIsInstance(values, np.ndarray)
+                    np.testing.assert_array_equal(values, (expected[key] if key else expected)[stat].values)
+
+        membership = _.index_membership(pathway_indices, len(genes))
+        np.testing.assert_array_equal(
+            _.array_scores(self.expression_table.values, membership, aggregates=['harmonic'])['harmonic'],
+            scores['suppression']['harmonic']
+        )
+
+    def test_array_scores_match_all_on_float_values(self):
+        table = self.expression_table.copy()
+        # near-equal values on the genes of a pathway, far from the smallest value
+        rows = np.flatnonzero(table.index.isin(self.user_pathway_db['Sample_pathway']))
+        others = np.setdiff1d(np.arange(len(table)), rows)
+        table.iloc[others[0]] = -1e6
+        table.iloc[rows] = 0.1 + np.arange(len(rows))[:, None] * np.array([1e-11, -1e-11, 2e-11])
+        table.iloc[others[1:3]] = 0.1
+        genes = table.index
+        pathway_indices = [genes.get_indexer(list(pathway)) for pathway in self.user_pathway_db.values()]
+        pathway_indices = [indices[indices >= 0] for indices in pathway_indices]
+        for rank_method in ['max', 'average']:
+            for direction in [None, 'both']:
+                scores = _.array_scores(table.values, pathway_indices, direction=direction, rank_method=rank_method)
+                expected = _.all(table, pathways=self.user_pathway_db, direction=direction, rank_method=rank_method)
+                for key in (['suppression', 'activation'] if direction == 'both' else [None]):
+                    for aggregate, stat in [('harmonic', 'harmonic'), ('geometric', 'geometric'), ('min', 'min_p_val')]:
+                        np.testing.assert_array_equal(
+                            scores[key][aggregate] if key else scores[aggregate],
+                            (expected[key] if key else expected)[stat].values
+                        )
+
+    def test_array_scores_raise_error_if_indices_are_not_row_positions(self):
+        values = self.expression_table.values
+        with self.assertRaises(ValueError):
+            _.array_scores(values, [np.array([0, len(values)])])
+        with self.assertRaises(TypeError):
+            _.array_scores(values, [np.array([0.5])])
+        with self.assertRaises(ValueError):
+            _.array_scores(values[:, 0], [np.array([0])])
+
+    def test_prepared_expression_reuses_rank_tables(self):
+        prepared = _.PreparedExpression(self.expression_table_unprocessed.copy())
+        ranks = prepared.expression_ranks(ascending=True, rank_method='max')
+        self.assertIs(prepared.expression_ranks(ascending=True, rank_method='max'), ranks)
+        pd.testing.assert_frame_equal(ranks, self.expression_ranks)
+        self.assertDictEqual(prepared.bg_genes.to_dict(), self.bg_genes.to_dict())
+
+        for ascending in [True, False]:
+            results = _.all(prepared, pathways=self.user_pathway_db, ascending=ascending)
+            expected = _.all(self.expression_table, pathways=self.user_pathway_db, ascending=ascending)
+            pd.testing.assert_frame_equal(results['harmonic'], expected['harmonic'])
+        self.assertEqual(len(prepared.rank_tables), 2)
+
+    def test_direction_both_matches_separate_directions(self):
+        for batched in [True, False]:
+            both = _.all(self.expression_table, pathways=self.user_pathway_db, direction='both', batched=batched)
+            for direction, ascending in [('suppression', True), ('activation', False)]:
+                expected = _.all(self.expression_table, pathways=self.user_pathway_db, ascending=ascending)
+                for stat in ['harmonic', 'geometric', 'min_p_val']:
+                    np.testing.assert_allclose(both[direction][stat].values, expected[stat].values, rtol=1e-12)
+
+        activation = _.harmonic(self.expression_table, pathways=self.user_pathway_db, direction='activation')
+        pd.testing.assert_frame_equal(
+            activation, _.harmonic(self.expression_table, pathways=self.user_pathway_db, ascending=False)
+        )
+        with self.assertRaises(ValueError):
+            _.all(self.expression_table, pathways=self.user_pathway_db, direction='sideways')
+
+    def test_prepared_expression_ranks_both_directions_from_one_sort(self):
+        prepared = _.PreparedExpression(self.expression_table_unprocessed.copy())
+        ascending, descending = prepared.expression_ranks_both(rank_method='first')
+        pd.testing.assert_frame_equal(ascending, self.expression_table.rank(method='first'))
+        pd.testing.assert_frame_equal(descending, self.expression_table.rank(method='first', ascending=False))
+        self.assertIs(prepared.expression_ranks(ascending=False, rank_method='first'), descending)
+
+    def test_prepared_expression_cache_is_keyed_on_content_with_lru_eviction(self):
+        cache = _.PreparedExpressionCache(maxsize=2)
+        prepared = cache.get(self.expression_table_unprocessed.copy())
+        self.assertIs(cache.get(self.expression_table_unprocessed.copy()), prepared)
+
+        changed = self.expression_table_unprocessed.copy()
+        changed.iloc[0, 0] += 1
+        self.assertIsNot(cache.get(changed), prepared)
+        cache.get(changed * 2)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNot(cache.get(self.expression_table_unprocessed.copy()), prepared)
+
+    def test_min_p_val_accepts_cache(self):
+        cache = _.PreparedExpressionCache()
+        results = _.min_p_val(self.expression_table, pathways=self.user_pathway_db, cache=cache)
+        expected = _.min_p_val(self.expression_table, pathways=self.user_pathway_db)
+        pd.testing.assert_frame_equal(results, expected)
+        self.assertEqual(len(cache), 1)
+
     def test_db_pathways_returns_dict_of_expected_length(self):
         expected_len = 369
         self.assertIsInstance(self.db_pathway, dict)
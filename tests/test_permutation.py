@@ -0,0 +1,129 @@
+import unittest
+import io
+import sys
+
+import numpy as np
+import pandas as pd
+
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pathway_assessor as _
+from pathway_assessor import permutation
+
+
+class TestPermutation(unittest.TestCase):
+
+    def setUp(self):
+
+        self.test_dir = os.path.dirname(os.path.abspath(__file__))
+        self.expression_table_f = '{}/expression_table.tsv'.format(self.test_dir)
+        self.expression_table = pd.read_csv(self.expression_table_f, sep='\t', header=0, index_col=0)
+
+        genes = sorted(set(self.expression_table.index))
+        self.pathways = {
+            'first_5': genes[:5],
+            'last_5': genes[-5:],
+            'middle_12': genes[40:52],
+            'missing': ['NOT_A_GENE'],
+        }
+        self.n_permutations = 50
+
+    def test_permutation_all_adds_empirical_p_values_and_z_scores(self):
+        results = _.permutation_all(self.expression_table, pathways=self.pathways, n_permutations=self.n_permutations)
+        expected = _.all(self.expression_table, pathways=self.pathways)
+        for key in ['harmonic', 'geometric', 'min_p_val']:
+            pd.testing.assert_frame_equal(results[key], expected[key])
+            empirical_p = results['{}_empirical_p'.format(key)]
+            self.assertTrue(empirical_p.loc['missing'].isna().all())
+            self.assertTrue(results['{}_z'.format(key)].loc['missing'].isna().all())
+            values = empirical_p.drop('missing').values
+            self.assertTrue(((values >= 1 / (self.n_permutations + 1)) & (values <= 1)).all())
+
+    def test_empirical_statistics_compare_scores_with_null_of_same_size(self):
+        null = np.arange(1., 11.)[:, None]
+        empirical_p, z_scores = permutation.empirical_statistics(
+            np.array([[10.], [0.], [np.nan], [5.]]), np.array([3, 3, 3, 0]), {3: null}
+        )
+        np.testing.assert_allclose(empirical_p[:, 0], [2 / 11, 1., np.nan, np.nan])
+        self.assertAlmostEqual(z_scores[0, 0], (10 - 5.5) / np.std(null, ddof=1))
+
+    def test_null_sets_only_depend_on_permutation_and_size(self):
+        positions = permutation.null_gene_positions(100, 10, 20, random_state=1)
+        self.assertTrue(all(len(set(row)) == 10 for row in positions))
+        np.testing.assert_array_equal(permutation.null_gene_positions(100, 5, 10, random_state=1), positions[:10, :5])
+        membership = permutation.null_membership(positions, [3, 10], 100)
+        self.assertEqual(membership.shape, (40, 100))
+        np.testing.assert_array_equal(np.diff(membership.indptr), [3] * 20 + [10] * 20)
+
+    def test_null_cache_is_reused_across_runs_and_samples(self):
+        null_cache = _.NullCache()
+        results = _.permutation_all(
+            self.expression_table, pathways=self.pathways, n_permutations=self.n_permutations, null_cache=null_cache
+        )
+        sizes, samples = 2, self.expression_table.shape[1]
+        self.assertEqual((null_cache.hits, null_cache.misses), (0, sizes * samples))
+
+        cached = _.permutation_all(
+            self.expression_table, pathways=self.pathways, n_permutations=self.n_permutations, null_cache=null_cache
+        )
+        self.assertEqual((null_cache.hits, null_cache.misses), (sizes * samples, sizes * samples))
+        for key in results:
+            pd.testing.assert_frame_equal(cached[key], results[key])
+
+        expression_table = self.expression_table.assign(Sample_D=self.expression_table['Sample_A'] * 2 + 1)
+        extended = _.permutation_all(
+            expression_table, pathways=self.pathways, n_permutations=self.n_permutations, null_cache=null_cache
+        )
+        self.assertEqual(null_cache.misses, sizes * samples + sizes)
+        pd.testing.assert_frame_equal(extended['harmonic_z'][results['harmonic_z'].columns], results['harmonic_z'])
+
+    def test_saved_null_cache_gives_same_results(self):
+        null_cache = _.NullCache()
+        results = _.permutation_all(
+            self.expression_table, pathways=self.pathways, n_permutations=self.n_permutations, null_cache=null_cache,
+            direction='both'
+        )
+        f = io.BytesIO()
+        null_cache.save(f)
+        f.seek(0)
+        loaded = _.NullCache.load(f)
+        self.assertEqual(len(loaded), len(null_cache))
+        reloaded = _.permutation_all(
+            self.expression_table, pathways=self.pathways, n_permutations=self.n_permutations, null_cache=loaded,
+            direction='both'
+        )
+        self.assertEqual(loaded.misses, 0)
+        for direction in ['suppression', 'activation']:
+            for key in results[direction]:
+                pd.testing.assert_frame_equal(reloaded[direction][key], results[direction][key])
+
+    def test_sparse_expression_matches_dense_table(self):
+        rng = np.random.default_rng(0)
+        expression_table = self.expression_table.where(rng.random(self.expression_table.shape) > 0.7, 0.)
+        null_cache = _.NullCache()
+        expected = _.permutation_all(
+            expression_table, pathways=self.pathways, n_permutations=self.n_permutations, null_cache=null_cache
+        )
+        # the samples of the sparse table reuse the nulls of the dense one
+        results = _.permutation_all(
+            expression_table.astype(pd.SparseDtype(float, 0.)), pathways=self.pathways,
+            n_permutations=self.n_permutations, null_cache=null_cache
+        )
+        self.assertEqual(null_cache.hits, null_cache.misses)
+        for key in expected:
+            pd.testing.assert_frame_equal(results[key], expected[key])
+        results = _.permutation_all(
+            expression_table.astype(pd.SparseDtype(float, 0.)), pathways=self.pathways,
+            n_permutations=self.n_permutations
+        )
+        for key in expected:
+            pd.testing.assert_frame_equal(results[key], expected[key])
+
+    def test_n_permutations_raises_error_if_not_positive(self):
+        with self.assertRaises(ValueError):
+            _.permutation_all(self.expression_table, pathways=self.pathways, n_permutations=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
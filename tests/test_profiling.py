@@ -0,0 +1,107 @@
+import unittest
+import contextlib
+import csv
+import io
+import json
+import sys
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pathway_assessor as _
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+
+        self.test_dir = os.path.dirname(os.path.abspath(__file__))
+        self.expression_table_f = '{}/expression_table.tsv'.format(self.test_dir)
+        self.expression_table = pd.read_csv(self.expression_table_f, sep='\t', header=0, index_col=0)
+
+        self.user_pathway_f = '{}/user_pathways.txt'.format(self.test_dir)
+        self.user_pathway_db, _pw_data = _.user_pathways(self.user_pathway_f)
+        self.stages = ['dedup', 'ranking', 'pathway_ranks', 'contingency', 'p_values', 'aggregation']
+
+    def test_profiler_records_stages_and_pathways(self):
+        events = []
+        with _.Profiler(callback=lambda event, fields: events.append(event), trace_memory=True) as profiler:
+            _.all(self.expression_table, pathways=self.user_pathway_db)
+        self.assertEqual(set(profiler.stages), set(self.stages + ['membership']))
+        self.assertTrue(all(fields['peak_memory'] > 0 for fields in profiler.stages.values()))
+        self.assertGreater(profiler.peak_memory, 0)
+        self.assertGreater(profiler.process_peak_rss, 0)
+        self.assertEqual(
+            [(fields['pathway'], fields['genes'], fields['present_genes']) for fields in profiler.pathways],
+            [('EMT_kircUp', 3, 0), ('EMT_kircDwn', 3, 0), ('EMT_kirc', 7, 0), ('Sample_pathway', 4, 3)]
+        )
+        self.assertEqual(events.count('pathway'), 4)
+        self.assertEqual(events.count('stage'), sum(fields['calls'] for fields in profiler.stages.values()))
+
+    def test_profiler_counts_work_saved_by_duplicate_gene_sets(self):
+        with self.assertLogs('pathway_assessor', level='INFO') as logs, _.Profiler() as profiler:
+            _.all(self.expression_table, pathways=self.user_pathway_db)
+        samples = self.expression_table.shape[1]
+        self.assertEqual(profiler.counts, {
+            'pathways': 4, 'unique_pathways': 2, 'pathway_cells': 3 * samples, 'unique_pathway_cells': 3 * samples
+        })
+        self.assertTrue(any('4 pathways have 2 distinct gene sets' in line for line in logs.output))
+
+    def test_pathway_loop_logs_instead_of_printing(self):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), self.assertLogs('pathway_assessor', level='INFO') as logs:
+            with _.Profiler() as profiler:
+                _.all(self.expression_table, pathways=self.user_pathway_db, batched=False)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertIn('INFO:pathway_assessor:starting: EMT_kircUp', logs.output)
+        self.assertEqual(set(profiler.stages), set(self.stages))
+        self.assertTrue(all('seconds' in fields for fields in profiler.pathways))
+
+    def test_profile_exports_to_json_and_csv(self):
+        with _.Profiler() as profiler:
+            _.harmonic(self.expression_table, pathways=self.user_pathway_db)
+        with tempfile.TemporaryDirectory() as out_dir:
+            json_f = os.path.join(out_dir, 'profile.json')
+            profiler.to_json(json_f)
+            with open(json_f) as f:
+                self.assertEqual(set(json.load(f)['stages']), set(profiler.stages))
+
+            csv_f = profiler.to_csv(os.path.join(out_dir, 'profile.csv'))
+            with open(csv_f) as f:
+                rows = list(csv.DictReader(f))
+        self.assertEqual([row['name'] for row in rows if row['kind'] == 'pathway'], list(self.user_pathway_db))
+
+    def test_peak_memory_is_the_peak_of_its_own_run(self):
+        large_bytes = 2 ** 27
+        with _.Profiler(trace_memory=True) as first:
+            large = np.ones(large_bytes // 8)
+            _.harmonic(self.expression_table, pathways=self.user_pathway_db)
+        del large
+        with _.Profiler(trace_memory=True) as second:
+            _.harmonic(self.expression_table, pathways=self.user_pathway_db)
+        self.assertGreaterEqual(first.peak_memory, large_bytes)
+        self.assertLess(second.peak_memory, large_bytes)
+        self.assertIn('process_peak_rss', second.to_dict())
+
+    def test_stages_on_other_threads_are_not_recorded(self):
+        with _.Profiler() as profiler:
+            thread = threading.Thread(
+                target=_.harmonic, args=(self.expression_table,), kwargs={'pathways': self.user_pathway_db}
+            )
+            thread.start()
+            thread.join()
+        self.assertEqual(profiler.stages, {})
+
+    def test_stages_are_not_recorded_without_an_active_profiler(self):
+        profiler = _.Profiler()
+        _.harmonic(self.expression_table, pathways=self.user_pathway_db)
+        self.assertEqual(profiler.stages, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
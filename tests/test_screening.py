@@ -0,0 +1,113 @@
+import unittest
+import sys
+
+import numpy as np
+import pandas as pd
+
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pathway_assessor as _
+from pathway_assessor import batched, screening
+
+
+class TestScreening(unittest.TestCase):
+
+    def setUp(self):
+
+        rng = np.random.default_rng(0)
+        genes = ['g{}'.format(i) for i in range(400)]
+        values = rng.normal(size=(400, 6))
+        values[rng.random(values.shape) < 0.05] = np.nan
+        self.pathways = {
+            'pathway_{}'.format(i): list(rng.choice(genes, rng.integers(3, 40), replace=False)) for i in range(30)
+        }
+        # enriched pathways, and an alias that shares the genes of pathway_0
+        values[:25, :3] -= 2
+        self.pathways['enriched'] = genes[:25]
+        self.pathways['alias'] = self.pathways['pathway_0']
+        self.expression_table = pd.DataFrame(values, index=genes, columns=['s{}'.format(j) for j in range(6)])
+
+    # the pairs of the full scores that make the top_k of their sample and reach min_score
+    def expected_pairs(self, scores_df, top_k=None, min_score=None):
+        long_df = scores_df.stack().rename('score').rename_axis(['pathway', 'sample']).reset_index()
+        if min_score is not None:
+            long_df = long_df[long_df['score'] >= min_score]
+        long_df = long_df.assign(order=long_df['pathway'].map({name: i for i, name in enumerate(scores_df.index)}))
+        long_df = long_df.assign(sample_order=long_df['sample'].map(list(scores_df.columns).index))
+        long_df = long_df.sort_values(['sample_order', 'score', 'order'], ascending=[True, False, True])
+        if top_k is not None:
+            long_df = long_df.groupby('sample', sort=False).head(top_k)
+        return long_df[['sample', 'pathway', 'score']].reset_index(drop=True)
+
+    def test_log_sf_bound_is_below_hypergeom_log_sf(self):
+        rng = np.random.default_rng(1)
+        M = rng.integers(1, 20000, 50000)
+        K = rng.integers(0, M + 1)
+        n = rng.integers(0, M + 1)
+        lowest = np.maximum(0, n + K - M)
+        a = lowest + rng.integers(0, np.minimum(n, K) - lowest + 1)
+        tables = (a, n - a, K - a, M - K - n + a)
+        bound = screening.hypergeom_log_sf_bound(*tables)
+        self.assertTrue((bound <= _.hypergeom_log_sf(*tables)).all())
+
+    def test_screened_scores_match_full_scores(self):
+        for mode in screening.screening_aggregates:
+            expected = _.pa_stats(self.expression_table, mode, pathways=self.pathways)
+            for options in [{'top_k': 3}, {'min_score': 2.}, {'top_k': 2, 'min_score': 1.}, {'top_k': 40}]:
+                pd.testing.assert_frame_equal(
+                    _.pa_stats(self.expression_table, mode, pathways=self.pathways, **options),
+                    self.expected_pairs(expected, **options),
+                    rtol=1e-12
+                )
+
+    def test_screened_scores_skip_pairs(self):
+        with _.Profiler() as profiler:
+            results = _.harmonic(self.expression_table, pathways=self.pathways, top_k=1, log_p=True)
+        self.assertEqual(list(results.loc[:2, 'pathway']), ['enriched'] * 3)
+        self.assertLess(profiler.counts['screened_pairs'], profiler.counts['bounded_pairs'])
+
+    def test_screening_across_blocks_and_precisions(self):
+        prepared = _.PreparedExpression(self.expression_table)
+        membership = _.pathway_membership(self.pathways, prepared.genes)
+        for precision in ['double', 'single']:
+            for rank_method in ['max', 'average']:
+                ranks = prepared.expression_ranks(rank_method=rank_method, precision=precision).values
+                function = _.p_value_function('hypergeom', True, precision=precision)
+                full = batched.pathway_scores(
+                    ranks, prepared.bg_genes.values, membership, function, rank_method, ['harmonic'], True,
+                    precision=precision
+                )['harmonic']
+                pathways, samples, scores = screening.top_pairs(*screening.screened_pathway_scores(
+                    ranks, prepared.bg_genes.values, membership, function, top_k=4, rank_method=rank_method,
+                    log_p=True, max_cells=60, precision=precision
+                ), top_k=4)
+                expected = -np.sort(-np.nan_to_num(full, nan=-np.inf), axis=0)[:4].T.ravel()
+                np.testing.assert_allclose(scores, expected, rtol=1e-12)
+                np.testing.assert_allclose(full[pathways, samples], scores, rtol=1e-12)
+
+    def test_screened_scores_of_both_directions_and_sparse_expression(self):
+        results = _.geometric(self.expression_table, pathways=self.pathways, direction='both', top_k=3)
+        for direction in ['suppression', 'activation']:
+            expected = _.geometric(self.expression_table, pathways=self.pathways, direction=direction)
+            pd.testing.assert_frame_equal(results[direction], self.expected_pairs(expected, top_k=3), rtol=1e-12)
+        counts = self.expression_table.clip(lower=0).fillna(0).astype(pd.SparseDtype(float, 0.))
+        pd.testing.assert_frame_equal(
+            _.harmonic(counts, pathways=self.pathways, min_score=1.),
+            self.expected_pairs(_.harmonic(counts.sparse.to_dense(), pathways=self.pathways), min_score=1.),
+            rtol=1e-12
+        )
+
+    def test_screening_raises_error_if_option_not_available(self):
+        for options in [
+            {'top_k': 0}, {'top_k': 2.5}, {'min_score': np.nan}, {'top_k': 3, 'batched': False},
+            {'top_k': 3, 'p_value_method': 'fisher'}, {'top_k': 3, 'n_jobs': 2}, {'top_k': 3, 'backend': 'numba'}
+        ]:
+            with self.assertRaises(ValueError):
+                _.harmonic(self.expression_table, pathways=self.pathways, **options)
+        with self.assertRaises(ValueError):
+            _.pa_stats(self.expression_table, 'fisher', pathways=self.pathways, top_k=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
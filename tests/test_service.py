@@ -0,0 +1,165 @@
+import asyncio
+import tempfile
+import unittest
+import sys
+
+import numpy as np
+import pandas as pd
+
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pathway_assessor as _
+from pathway_assessor import service
+
+
+class TestService(unittest.TestCase):
+
+    def setUp(self):
+
+        self.test_dir = os.path.dirname(os.path.abspath(__file__))
+        self.expression_table_f = '{}/expression_table.tsv'.format(self.test_dir)
+        self.expression_table = pd.read_csv(self.expression_table_f, sep='\t', header=0, index_col=0)
+
+        self.user_pathway_f = '{}/user_pathways.txt'.format(self.test_dir)
+        self.user_pathway_db, _pw_data = _.user_pathways(self.user_pathway_f)
+
+        self.tmp = tempfile.TemporaryDirectory()
+        genes = list(self.expression_table.index)
+        self.other_pathways = {'first_genes': genes[:30], 'last_genes': genes[-40:]}
+        self.other_pathway_f = os.path.join(self.tmp.name, 'other.gmt')
+        with open(self.other_pathway_f, 'w') as f:
+            for name, pathway_genes in self.other_pathways.items():
+                f.write('\t'.join([name, 'na'] + pathway_genes) + '\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def inline(self, table):
+        return {'genes': list(table.index), 'samples': list(table.columns), 'values': table.values.tolist()}
+
+    # runs requests against a service on a free localhost port
+    def run_service(self, requests, **options):
+        async def run():
+            scoring_service = service.ScoringService(dbs=[self.user_pathway_f], **options)
+            server = await scoring_service.start(port=0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                async with server:
+                    results = []
+                    for batch in requests:
+                        results += await asyncio.gather(*(
+                            service.service_scores(request, port=port) for request in batch
+                        ))
+                    return results, scoring_service.info()
+            finally:
+                scoring_service.close()
+        return asyncio.run(run())
+
+    def assert_scores_equal(self, results, expected):
+        for key, value in expected.items():
+            if isinstance(value, dict):
+                self.assert_scores_equal(results[key], value)
+            elif value is not None:
+                pd.testing.assert_frame_equal(results[key], value, check_names=False, check_column_type=False)
+
+    def test_service_scores_match_all(self):
+        request = {
+            'expression': {'path': self.expression_table_f}, 'dbs': [self.user_pathway_f], 'direction': 'both',
+            'settings': {'rank_method': 'average', 'extra_aggregates': ['fisher']}
+        }
+        (results,), info = self.run_service([[request]])
+        expected = _.all(
+            self.expression_table, pathways=self.user_pathway_db, direction='both', rank_method='average',
+            extra_aggregates=['fisher']
+        )
+        self.assert_scores_equal(results, expected)
+        self.assertEqual(info['dbs'], 1)
+
+    def test_concurrent_requests_are_scored_in_one_pass(self):
+        table = self.expression_table.copy()
+        table.iloc[::7, 1] = np.nan
+        first = table.iloc[:, :2]
+        # the second cohort lacks some genes of the first
+        second = table.iloc[10:, 1:]
+        requests = [
+            {'expression': self.inline(first), 'dbs': [self.user_pathway_f]},
+            {'expression': self.inline(second), 'dbs': [self.other_pathway_f, self.user_pathway_f]},
+            {'expression': self.inline(first), 'dbs': [self.other_pathway_f]},
+        ]
+        results, info = self.run_service([requests], batch_delay=0.2, block_size=1)
+        self.assertEqual(info['passes'], 1)
+        self.assertEqual(info['cohorts'], 2)
+        pathways = dict(self.other_pathways, **self.user_pathway_db)
+        for result, cohort, names in zip(
+            results, [first, second, first], [list(self.user_pathway_db), list(pathways), list(self.other_pathways)]
+        ):
+            expected = _.all(cohort, pathways={name: pathways[name] for name in names})
+            self.assert_scores_equal(result, expected)
+
+    def test_malformed_cohort_fails_only_its_requests(self):
+        malformed_f = os.path.join(self.tmp.name, 'malformed.tsv')
+        self.expression_table.astype(object).where(self.expression_table.notna(), 'high').to_csv(malformed_f, sep='\t')
+        good = {'expression': {'path': self.expression_table_f}, 'dbs': [self.user_pathway_f]}
+        bad = {'expression': {'path': malformed_f}, 'dbs': [self.user_pathway_f]}
+
+        async def run():
+            scoring_service = service.ScoringService(dbs=[self.user_pathway_f])
+            server = await scoring_service.start(port=0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                async with server:
+                    results = await asyncio.gather(
+                        service.service_scores(good, port=port), service.service_scores(bad, port=port),
+                        return_exceptions=True
+                    )
+                    return results, scoring_service.info()
+            finally:
+                scoring_service.close()
+        (results, error), info = asyncio.run(run())
+        self.assertEqual(info['passes'], 1)
+        self.assertIsInstance(error, ValueError)
+        self.assert_scores_equal(results, _.all(self.expression_table, pathways=self.user_pathway_db))
+
+    def test_prepared_cohorts_stay_resident(self):
+        request = {'expression': {'path': self.expression_table_f}, 'dbs': [self.user_pathway_f]}
+        other = {'expression': self.inline(self.expression_table.iloc[:, :1]), 'dbs': [self.user_pathway_f]}
+        results, info = self.run_service([[request], [request], [other], [request]], max_cohorts=1)
+        self.assert_scores_equal(results[1], results[0])
+        self.assertEqual(info['passes'], 4)
+        self.assertEqual((info['cohort_hits'], info['cohort_misses']), (1, 3))
+
+    def test_service_streams_pathways_before_done(self):
+        async def run():
+            scoring_service = service.ScoringService(dbs=[self.user_pathway_f], block_size=1)
+            server = await scoring_service.start(port=0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                async with server:
+                    request = {'expression': {'path': self.expression_table_f}, 'dbs': [self.user_pathway_f]}
+                    return [event async for event in service.request_events(request, port=port)]
+            finally:
+                scoring_service.close()
+        events = asyncio.run(run())
+        self.assertEqual([event['event'] for event in events], ['samples'] + ['pathway'] * 4 + ['done'])
+        self.assertEqual(events[0]['samples'], list(self.expression_table.columns))
+        self.assertEqual([event['pathway'] for event in events[1:-1]], list(self.user_pathway_db))
+
+    def test_service_reports_errors_and_keeps_serving(self):
+        good = {'expression': {'path': self.expression_table_f}, 'dbs': [self.user_pathway_f]}
+        for bad in [
+            {'expression': {'path': self.expression_table_f}, 'settings': {'rank_method': 'middle'}},
+            {'expression': {'path': self.expression_table_f}, 'dbs': ['not_a_db']},
+            {'expression': {'path': os.path.join(self.tmp.name, 'missing.tsv')}},
+            {'expression': {'genes': ['a'], 'samples': ['s'], 'values': [[1, 2]]}},
+            {'expression': {'genes': ['a'], 'values': [[1]]}},
+            {'dbs': ['kegg']},
+        ]:
+            with self.assertRaises(ValueError):
+                self.run_service([[bad]])
+        (results,), info = self.run_service([[good]])
+        self.assert_scores_equal(results, _.all(self.expression_table, pathways=self.user_pathway_db))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+import sys
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pathway_assessor as _
+from pathway_assessor import batched
+
+
+class TestSparseExpression(unittest.TestCase):
+
+    def setUp(self):
+
+        self.test_dir = os.path.dirname(os.path.abspath(__file__))
+        self.expression_table_f = '{}/expression_table.tsv'.format(self.test_dir)
+        expression_table = pd.read_csv(self.expression_table_f, sep='\t', header=0, index_col=0)
+        rng = np.random.default_rng(0)
+        # zero-inflated copy of the test table
+        self.expression_table = expression_table.where(rng.random(expression_table.shape) > 0.7, 0.)
+        self.sparse_table = self.expression_table.astype(pd.SparseDtype(float, 0.))
+
+        self.user_pathway_f = '{}/user_pathways.txt'.format(self.test_dir)
+        self.user_pathway_db, _pw_data = _.user_pathways(self.user_pathway_f)
+
+        values = rng.poisson(0.5, size=(200, 6)) * rng.choice([-1., 1.], size=(200, 6))
+        values[rng.random(values.shape) < 0.05] = np.nan
+        self.values = values
+
+    def test_sparse_ranks_match_dense_ranks(self):
+        matrix = sparse.csr_matrix(self.values)
+        rows = np.arange(len(self.values))
+        for rank_method in batched.sparse_rank_methods:
+            for ascending in [True, False]:
+                expected = pd.DataFrame(self.values).rank(method=rank_method, ascending=ascending).values
+                ranks = batched.sparse_expression_ranks(matrix, ascending=ascending, rank_method=rank_method)
+                np.testing.assert_array_equal(ranks[rows], expected)
+                single = batched.sparse_expression_ranks(
+                    matrix, ascending=ascending, rank_method=rank_method, precision='single'
+                )
+                np.testing.assert_array_equal(single[rows], np.nan_to_num(expected).astype(single.dtype))
+        np.testing.assert_array_equal(batched.sparse_bg_genes(matrix), (~np.isnan(self.values)).sum(axis=0))
+
+    def test_sparse_ranks_match_dense_ranks_on_float_values(self):
+        rng = np.random.default_rng(1)
+        values = np.where(rng.random(self.values.shape) < 0.6, 0., rng.normal(size=self.values.shape))
+        values[np.isnan(self.values)] = np.nan
+        # near-equal values far from the smallest value
+        values[0] = -1e6
+        values[1:9] = 0.1 + np.arange(8)[:, None] * np.array([1e-11, -1e-11, 2e-11, 1e-12, -3e-11, 1e-11])
+        matrix = sparse.csr_matrix(values)
+        rows = np.arange(len(values))
+        for rank_method in batched.sparse_rank_methods:
+            for ascending in [True, False]:
+                expected = pd.DataFrame(values).rank(method=rank_method, ascending=ascending).values
+                ranks = batched.sparse_expression_ranks(matrix, ascending=ascending, rank_method=rank_method)
+                np.testing.assert_array_equal(ranks[rows], expected)
+
+        pathway_indices = [np.arange(1, 9), np.arange(0, 40, 3), np.arange(100, 160)]
+        for rank_method in ['max', 'average']:
+            scores = _.array_scores(sparse.csc_matrix(values), pathway_indices, rank_method=rank_method)
+            expected = _.array_scores(values, pathway_indices, rank_method=rank_method)
+            for aggregate in scores:
+                np.testing.assert_array_equal(scores[aggregate], expected[aggregate])
+
+    def test_sparse_frame_scores_match_dense_table(self):
+        for direction in [None, 'both']:
+            results = _.all(self.sparse_table, pathways=self.user_pathway_db, direction=direction)
+            expected = _.all(self.expression_table, pathways=self.user_pathway_db, direction=direction)
+            for key in (['suppression', 'activation'] if direction else [None]):
+                for stat in ['harmonic', 'geometric', 'min_p_val']:
+                    pd.testing.assert_frame_equal(
+                        results[key][stat] if key else results[stat], expected[key][stat] if key else expected[stat]
+                    )
+
+    def test_array_scores_accept_scipy_sparse_matrices(self):
+        pathway_indices = [np.arange(0, 40, 3), np.arange(100, 160), np.array([5, 7, 9])]
+        for rank_method in ['max', 'average']:
+            scores = _.array_scores(sparse.csc_matrix(self.values), pathway_indices, rank_method=rank_method)
+            expected = _.array_scores(self.values, pathway_indices, rank_method=rank_method)
+            for aggregate in scores:
+                np.testing.assert_array_equal(scores[aggregate], expected[aggregate])
+
+    def test_sparse_expression_averages_duplicated_genes(self):
+        table = self.expression_table.iloc[:20].set_axis(['g{}'.format(i % 7) for i in range(20)])
+        prepared = _.SparseExpression(sparse.csr_matrix(table.values), table.index, table.columns)
+        self.assertEqual(list(prepared.genes), sorted(set(table.index)))
+        np.testing.assert_allclose(prepared.matrix.toarray(), _.processed_expression_table(table).values)
+
+    def test_sparse_expression_raises_error_if_option_not_available(self):
+        prepared = _.SparseExpression.from_frame(self.sparse_table)
+        with self.assertRaises(ValueError):
+            _.all(prepared, pathways=self.user_pathway_db, rank_method='first')
+        with self.assertRaises(ValueError):
+            _.all(prepared, pathways=self.user_pathway_db, batched=False)
+        with self.assertRaises(ValueError):
+            _.all(prepared, pathways=self.user_pathway_db, n_jobs=2)
+        with self.assertRaises(ValueError):
+            _.SparseExpression.from_frame(self.expression_table.astype(pd.SparseDtype(float, np.nan)))
+        with self.assertRaises(ValueError):
+            _.SparseExpression(sparse.csr_matrix(self.values), range(200), range(6), dedup='median')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+import sys
+import tempfile
+
+from unittest import mock
+
+import pandas as pd
+
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pathway_assessor as _
+from pathway_assessor import store
+
+
+class TestStore(unittest.TestCase):
+
+    def setUp(self):
+
+        self.test_dir = os.path.dirname(os.path.abspath(__file__))
+        self.expression_table_f = '{}/expression_table.tsv'.format(self.test_dir)
+        self.expression_table = pd.read_csv(self.expression_table_f, sep='\t', header=0, index_col=0)
+
+        self.user_pathway_f = '{}/user_pathways.txt'.format(self.test_dir)
+        self.user_pathway_db, _pw_data = _.user_pathways(self.user_pathway_f)
+        self.expected = _.all(self.expression_table.copy(), pathways=self.user_pathway_db, geometric=False)
+        self.store_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.store_dir.cleanup()
+
+    def run_all(self, **kwargs):
+        return _.checkpointed_all(
+            self.expression_table.copy(),
+            self.store_dir.name,
+            pathways=self.user_pathway_db,
+            block_size=1,
+            geometric=False,
+            **kwargs
+        )
+
+    def test_checkpointed_all_matches_all(self):
+        results = self.run_all()
+        self.assertEqual(list(results), ['harmonic', 'geometric', 'min_p_val'])
+        self.assertIsNone(results['geometric'])
+        for stat in ['harmonic', 'min_p_val']:
+            pd.testing.assert_frame_equal(results[stat], self.expected[stat])
+
+    def test_rerun_resumes_after_the_last_flushed_block(self):
+        scores = store.expression_scores
+        calls = []
+
+        def fail_on_third_block(*args, **kwargs):
+            calls.append(list(args[1]))
+            if len(calls) == 3:
+                raise MemoryError
+            return scores(*args, **kwargs)
+
+        with mock.patch.object(store, 'expression_scores', side_effect=fail_on_third_block):
+            with self.assertRaises(MemoryError):
+                self.run_all()
+        self.assertEqual(_.ResultStore(self.store_dir.name).manifest['completed'], [0, 1])
+
+        calls.clear()
+        with mock.patch.object(store, 'expression_scores', side_effect=fail_on_third_block):
+            results = self.run_all()
+        self.assertEqual(calls, [['EMT_kirc'], ['Sample_pathway']])
+        self.assertTrue(_.ResultStore(self.store_dir.name).complete())
+        pd.testing.assert_frame_equal(results['harmonic'], self.expected['harmonic'])
+
+    def test_changed_inputs_start_the_store_over(self):
+        self.run_all()
+        results = self.run_all(rank_method='min')
+        expected = _.all(self.expression_table.copy(), pathways=self.user_pathway_db, rank_method='min')
+        pd.testing.assert_frame_equal(results['harmonic'], expected['harmonic'])
+
+    def test_checkpointed_all_with_both_directions(self):
+        results = self.run_all(direction='both')
+        self.assertEqual(list(results), ['suppression', 'activation'])
+        expected = _.all(self.expression_table.copy(), pathways=self.user_pathway_db, ascending=False)
+        pd.testing.assert_frame_equal(results['activation']['min_p_val'], expected['min_p_val'])
+
+    def test_checkpointed_all_accepts_sparse_expression(self):
+        expression_table = self.expression_table.fillna(0.).astype(pd.SparseDtype(float, 0.))
+        expected = _.all(expression_table, pathways=self.user_pathway_db, geometric=False)
+        results = _.checkpointed_all(
+            expression_table, self.store_dir.name, pathways=self.user_pathway_db, block_size=1, geometric=False
+        )
+        pd.testing.assert_frame_equal(results['harmonic'], expected['harmonic'])
+
+        with mock.patch.object(store, 'expression_scores') as expression_scores:
+            _.checkpointed_all(
+                expression_table, self.store_dir.name, pathways=self.user_pathway_db, block_size=1, geometric=False
+            )
+        expression_scores.assert_not_called()
+        other = expression_table.sparse.to_dense().mul(-1).astype(pd.SparseDtype(float, 0.))
+        results = _.checkpointed_all(
+            other, self.store_dir.name, pathways=self.user_pathway_db, block_size=1, geometric=False
+        )
+        pd.testing.assert_frame_equal(
+            results['harmonic'], _.all(other, pathways=self.user_pathway_db, geometric=False)['harmonic']
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
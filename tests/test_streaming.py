@@ -0,0 +1,103 @@
+import unittest
+import importlib.util
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pathway_assessor as _
+from pathway_assessor import streaming
+
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+
+        self.test_dir = os.path.dirname(os.path.abspath(__file__))
+        self.expression_table_f = '{}/expression_table.tsv'.format(self.test_dir)
+        self.expression_table = pd.read_csv(self.expression_table_f, sep='\t', header=0, index_col=0)
+
+        self.user_pathway_f = '{}/user_pathways.txt'.format(self.test_dir)
+        self.user_pathway_db, _pw_data = _.user_pathways(self.user_pathway_f)
+        self.expected = _.all(self.expression_table.copy(), pathways=self.user_pathway_db, extra_aggregates=['fisher'])
+        self.out_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.out_dir.cleanup()
+
+    def assertStreamedTsvEqual(self, files, expected):
+        for stat, expected_df in expected.items():
+            streamed = pd.read_csv(files[stat], sep='\t', index_col=0).T
+            pd.testing.assert_frame_equal(streamed, expected_df, check_names=False)
+
+    def test_tsv_stream_matches_all(self):
+        files = _.stream_scores(
+            self.expression_table_f,
+            self.out_dir.name,
+            pathways=self.user_pathway_db,
+            chunk_size=2,
+            extra_aggregates=['fisher']
+        )
+        self.assertEqual(sorted(files), ['fisher', 'geometric', 'harmonic', 'min_p_val'])
+        self.assertStreamedTsvEqual(files, self.expected)
+
+    def test_npy_stream_writes_npy_scores(self):
+        npy_f = os.path.join(self.out_dir.name, 'expression.npy')
+        np.save(npy_f, self.expression_table.values)
+        out_dir = os.path.join(self.out_dir.name, 'scores')
+        files = _.stream_scores(
+            npy_f,
+            out_dir,
+            pathways=self.user_pathway_db,
+            chunk_size=1,
+            genes=self.expression_table.index,
+            samples=self.expression_table.columns,
+            output_format='npy',
+            geometric=False
+        )
+        self.assertEqual(sorted(files), ['harmonic', 'min_p_val'])
+        np.testing.assert_array_equal(np.load(files['harmonic']), self.expected['harmonic'].values)
+        with open(os.path.join(out_dir, 'samples.txt')) as f:
+            self.assertEqual(f.read().split(), list(self.expression_table.columns))
+
+    def test_stream_both_directions(self):
+        source = streaming.array_source(
+            self.expression_table.values, self.expression_table.index, self.expression_table.columns
+        )
+        files = _.stream_scores(source, self.out_dir.name, pathways=self.user_pathway_db, direction='both')
+        expected = _.all(self.expression_table.copy(), pathways=self.user_pathway_db, ascending=False)
+        self.assertStreamedTsvEqual(
+            {stat: files['activation_{}'.format(stat)] for stat in expected}, expected
+        )
+
+    def test_stream_raises_error_if_format_not_available(self):
+        with self.assertRaises(ValueError):
+            _.stream_scores(self.expression_table_f, self.out_dir.name, output_format='xlsx')
+        with self.assertRaises(ValueError):
+            _.expression_source(self.expression_table_f, source_format='xlsx')
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_parquet_stream_matches_all(self):
+        parquet_f = os.path.join(self.out_dir.name, 'expression.parquet')
+        self.expression_table.to_parquet(parquet_f)
+        files = _.stream_scores(parquet_f, self.out_dir.name, pathways=self.user_pathway_db, chunk_size=2)
+        self.assertStreamedTsvEqual(files, {stat: self.expected[stat] for stat in ['harmonic', 'min_p_val']})
+
+    @unittest.skipUnless(importlib.util.find_spec('h5py'), 'h5py is not installed')
+    def test_hdf5_stream_matches_all(self):
+        import h5py
+        hdf5_f = os.path.join(self.out_dir.name, 'expression.h5')
+        with h5py.File(hdf5_f, 'w') as f:
+            f['expression'] = self.expression_table.values
+            f['genes'] = np.array(self.expression_table.index, dtype='S')
+            f['samples'] = np.array(self.expression_table.columns, dtype='S')
+        files = _.stream_scores(hdf5_f, self.out_dir.name, pathways=self.user_pathway_db, chunk_size=2)
+        self.assertStreamedTsvEqual(files, {stat: self.expected[stat] for stat in ['harmonic', 'min_p_val']})
+
+
+if __name__ == '__main__':
+    unittest.main()